@@ -0,0 +1,91 @@
+"""Mide el coste de identificar al usuario de cada petición a partir de su JWT.
+
+Compara la política de more.jwtauth, que verifica y decodifica el token en
+cada petición, con wexam.sesiones.PoliticaJWT, que sólo lo hace la primera
+vez que lo ve y después sólo comprueba la versión del token del profesor.
+Sin redis, esa versión se lee de la base de datos (una SQLite en memoria con
+un solo profesor), por lo que la medida incluye esa consulta.
+
+Compara también el coste de obtener un token nuevo con /login (que verifica
+la clave con bcrypt) y con /login/refresh (que sólo verifica el token).
+
+Uso (desde la carpeta que contiene setup.py):
+
+    $ python -m benchmarks.bench_auth [--repeticiones N] [--coste C]
+"""
+import argparse
+from datetime import datetime
+import timeit
+import types
+
+from more.jwtauth import JWTIdentityPolicy
+import morepath
+from pony.orm import db_session
+from webob import Request
+
+# Como en la app, instance_app se importa antes que model
+from wexam.instance_app import instance_app  # pylint: disable=unused-import
+from wexam import claves, model, sesiones
+
+AJUSTES = {"master_secret": "secreto", "leeway": 10, "expiration_delta": 3600}
+
+
+def crear_db():
+    """Base de datos en memoria con el profesor de las peticiones"""
+    model.db.bind("sqlite", ":memory:")
+    model.db.generate_mapping(create_tables=True)
+    with db_session:
+        ahora = datetime.now()
+        model.Profesor(id=1, nombre="Jose Luis Díaz", email="jldiaz@uniovi.es",
+                       password="*", role="profesor",
+                       fecha_creacion=ahora, fecha_modificacion=ahora)
+
+
+def crear_peticion(politica):
+    """Petición con el token de un profesor, emitido por la política dada"""
+    identidad = morepath.Identity("jldiaz@uniovi.es", nombre="Jose Luis Díaz", id=1,
+                                  role="profesor", ver=0)
+    claims = identidad.as_dict()
+    userid = claims.pop("userid")
+    token = politica.encode_jwt(politica.create_claims_set(None, userid, claims))
+    peticion = Request.blank("/profesor/1", headers={"Authorization": "JWT " + token})
+    # Sin redis, la versión del token se consulta en la base de datos
+    peticion.app = types.SimpleNamespace(redis=None)
+    return peticion
+
+
+def medir(nombre, politica, repeticiones):
+    peticion = crear_peticion(politica)
+    assert politica.identify(peticion).userid == "jldiaz@uniovi.es"
+    segundos = timeit.timeit(lambda: politica.identify(peticion), number=repeticiones)
+    print("{:<30} {:8.2f} µs/petición".format(nombre, segundos / repeticiones * 1e6))
+
+
+def medir_renovacion(repeticiones, coste):
+    """Coste de la verificación de /login frente a la de /login/refresh"""
+    contexto = claves.crear_contexto(types.SimpleNamespace(esquemas=["bcrypt"], coste=coste))
+    hash_ = contexto.hash("0000")
+    veces = max(1, repeticiones // 1000)
+    segundos = timeit.timeit(lambda: contexto.verify("0000", hash_), number=veces)
+    print("{:<30} {:8.2f} µs/petición".format("login (bcrypt, coste {})".format(coste),
+                                              segundos / veces * 1e6))
+    politica = sesiones.PoliticaJWT(**AJUSTES)
+    peticion = crear_peticion(politica)
+    assert politica.renovable(peticion) is not None
+    segundos = timeit.timeit(lambda: politica.renovable(peticion), number=repeticiones)
+    print("{:<30} {:8.2f} µs/petición".format("login/refresh", segundos / repeticiones * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeticiones", type=int, default=20000)
+    parser.add_argument("--coste", type=int, default=12, help="coste de bcrypt")
+    args = parser.parse_args()
+    crear_db()
+    medir("JWTIdentityPolicy", JWTIdentityPolicy(**AJUSTES), args.repeticiones)
+    medir("PoliticaJWT (con caché)", sesiones.PoliticaJWT(**AJUSTES), args.repeticiones)
+    medir_renovacion(args.repeticiones, args.coste)
+
+
+if __name__ == '__main__':
+    main()
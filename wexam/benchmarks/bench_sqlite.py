@@ -0,0 +1,114 @@
+"""Mide el rendimiento de SQLite con varios procesos leyendo y escribiendo a
+la vez, como los workers de uwsgi, con los ajustes por defecto de SQLite y
+con los de la sección sqlite de la configuración (wexam.conexiones).
+
+Cada proceso repite durante unos segundos lecturas (una consulta que
+recorre la tabla de problemas de un profesor) y, en una de cada N
+operaciones, una escritura (insertar y actualizar un problema en una
+transacción). Se muestran las operaciones por segundo y cuántas fallaron con
+"database is locked".
+
+Uso (desde la carpeta que contiene setup.py):
+
+    $ python -m benchmarks.bench_sqlite [--procesos P] [--segundos S] [--escrituras N]
+"""
+import argparse
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import time
+import types
+
+from wexam import conexiones
+
+AJUSTADO = types.SimpleNamespace(journal_mode="wal", synchronous="normal", busy_timeout=5,
+                                 mmap_size=268435456, cache_size=65536)
+# Lo que pony hace sin ajustes: journal de rollback, y el timeout por
+# defecto de sqlite3.connect (5 segundos)
+POR_DEFECTO = None
+
+
+def preparar(fichero, filas=5000):
+    con = sqlite3.connect(fichero)
+    con.execute("CREATE TABLE problema (id INTEGER PRIMARY KEY, creador INTEGER, "
+                "resumen TEXT, enunciado TEXT, fecha_modificacion REAL)")
+    con.execute("CREATE INDEX idx_creador ON problema (creador)")
+    con.executemany("INSERT INTO problema (creador, resumen, enunciado, fecha_modificacion) "
+                    "VALUES (?, ?, ?, ?)",
+                    [(i % 50, "resumen {}".format(i), "enunciado " * 50, time.time())
+                     for i in range(filas)])
+    con.commit()
+    con.close()
+
+
+def trabajar(fichero, config, segundos, escrituras, semilla, resultados):
+    """Cuerpo de cada proceso: como pony, conexión en modo autocommit y
+    transacciones de escritura con BEGIN IMMEDIATE"""
+    con = sqlite3.connect(fichero, isolation_level=None)
+    if config is not None:
+        for pragma in conexiones.pragmas_sqlite(config):
+            con.execute(pragma)
+    operaciones = bloqueos = 0
+    limite = time.monotonic() + segundos
+    n = semilla
+    while time.monotonic() < limite:
+        n += 1
+        try:
+            if n % escrituras == 0:
+                con.execute("BEGIN IMMEDIATE")
+                cursor = con.execute("INSERT INTO problema (creador, resumen, enunciado, "
+                                     "fecha_modificacion) VALUES (?, ?, ?, ?)",
+                                     (n % 50, "nuevo", "enunciado " * 50, time.time()))
+                con.execute("UPDATE problema SET fecha_modificacion = ? WHERE id = ?",
+                            (time.time(), cursor.lastrowid))
+                con.execute("COMMIT")
+            else:
+                con.execute("SELECT id, resumen, enunciado FROM problema WHERE creador = ? "
+                            "ORDER BY fecha_modificacion DESC", (n % 50,)).fetchall()
+            operaciones += 1
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e):
+                raise
+            bloqueos += 1
+            if con.in_transaction:
+                con.execute("ROLLBACK")
+    con.close()
+    resultados.put((operaciones, bloqueos))
+
+
+def medir(nombre, config, procesos, segundos, escrituras):
+    with tempfile.TemporaryDirectory() as carpeta:
+        fichero = os.path.join(carpeta, "bench.sqlite")
+        preparar(fichero)
+        resultados = multiprocessing.Queue()
+        hijos = [multiprocessing.Process(target=trabajar,
+                                         args=(fichero, config, segundos, escrituras, i * 7,
+                                               resultados))
+                 for i in range(procesos)]
+        for hijo in hijos:
+            hijo.start()
+        totales = [resultados.get() for _ in hijos]
+        for hijo in hijos:
+            hijo.join()
+    operaciones = sum(o for o, _ in totales)
+    bloqueos = sum(b for _, b in totales)
+    print("{:<12} {:10.0f} operaciones/s {:8d} bloqueos".format(
+        nombre, operaciones / segundos, bloqueos))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--procesos", type=int, default=4)
+    parser.add_argument("--segundos", type=float, default=5)
+    parser.add_argument("--escrituras", type=int, default=10,
+                        help="una de cada N operaciones es una escritura")
+    args = parser.parse_args()
+    print("{} procesos, {} s, una escritura cada {} operaciones".format(
+        args.procesos, args.segundos, args.escrituras))
+    medir("por defecto", POR_DEFECTO, args.procesos, args.segundos, args.escrituras)
+    medir("ajustado", AJUSTADO, args.procesos, args.segundos, args.escrituras)
+
+
+if __name__ == '__main__':
+    main()
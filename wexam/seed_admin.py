@@ -1,11 +1,11 @@
 import os.path
 import os
 from datetime import datetime
-from passlib.hash import bcrypt
 
 from pony.orm import db_session, commit
 from wexam.instance_app import instance_app
 from wexam.model import Profesor, db
+from wexam.claves import cifrar
 
 def crear_admin_user(name, email, password):
     with db_session():
@@ -13,7 +13,7 @@ def crear_admin_user(name, email, password):
         admin = Profesor(nombre=name, email=email,
                     username="admin", role="admin",
                     fecha_creacion=now, fecha_modificacion=now,
-                    password=bcrypt.hash(password))
+                    password=cifrar(password))
         commit()
 
 
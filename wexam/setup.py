@@ -40,7 +40,8 @@ setup(
             'pytest',
             'webtest',
             'ruamel.yaml',
-            'jsonschema'
+            'jsonschema',
+            'fakeredis',
         ],
         development=[
             'werkzeug'
@@ -50,6 +51,7 @@ setup(
         console_scripts=[
             'run-app = wexam.run:run',
             'morepathq = wexam.query:query_tool',
+            'wexam-mantenimiento = wexam.mantenimiento:main',
         ],
     ),
     classifiers=[
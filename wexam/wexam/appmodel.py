@@ -22,6 +22,23 @@ class ResetDB(object):   # pylint: disable=too-few-public-methods
     """Ruta para restaurar la base de datos a una colección de exámenes de ejemplo"""
     pass
 
+class Colas(object):    # pylint: disable=too-few-public-methods
+    """Ruta para consultar el estado de las colas de compilación"""
+    pass
+
+class Metricas(object):    # pylint: disable=too-few-public-methods
+    """Ruta con las métricas del servidor para Prometheus. Guarda la cabecera
+    Authorization de la petición, pues el recolector no se identifica con un
+    JWT sino con un token fijo (véase metricas.token_valido)"""
+    def __init__(self, autorizacion=None):
+        self.autorizacion = autorizacion
+
+class Muestras(object):    # pylint: disable=too-few-public-methods
+    """Ruta con las pilas que ha muestreado el perfil por muestreo en las
+    últimas horas (0 para todas las que se conservan)"""
+    def __init__(self, horas=0):
+        self.horas = horas
+
 class ResetPassword(object):
     """Clase que agrupa las funciones relacionadas con cambiar la clave
     de forma segura mediante un enlace enviado por email al usuario"""
@@ -0,0 +1,111 @@
+"""Caché en disco de los resultados de compilación de exámenes.
+
+Cada resultado se guarda en un fichero cuyo nombre es un hash del contenido
+que lo generó (JSON del examen, formato y modo de resolución), de modo que dos
+peticiones idénticas comparten el mismo fichero. El tamaño total de la caché
+está acotado: cuando se supera, se borran los ficheros usados hace más tiempo.
+"""
+
+import hashlib
+import os
+import tempfile
+
+from .metricas import contar
+
+
+class CacheCompilacion(object):
+    """Almacén de resultados de compilación direccionado por contenido.
+
+    La carpeta puede compartirse entre todos los procesos uwsgi de un mismo
+    nodo, ya que las escrituras son atómicas (se escribe a un fichero temporal
+    que después se renombra). Si es compartida, los workers de compilación
+    también pueden escribir en ella (véase ProfesorMixin.lanzar_tarea)"""
+
+    def __init__(self, carpeta, max_bytes, compartida=False):
+        self.carpeta = carpeta
+        self.max_bytes = max_bytes
+        self.compartida = compartida
+        os.makedirs(carpeta, exist_ok=True)
+
+    @staticmethod
+    def calcular_clave(examen_json, formato, resuelto):
+        """Calcula la clave (hash sha256) bajo la que se guarda el resultado de
+        compilar el examen dado (ya serializado en JSON) en el formato y modo
+        de resolución especificados"""
+        h = hashlib.sha256()
+        for parte in (formato, resuelto, examen_json):
+            h.update(parte.encode("utf-8"))
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def ruta(self, clave, formato):
+        """Ruta del fichero que contiene (o contendrá) el resultado"""
+        return os.path.join(self.carpeta, "{}.{}".format(clave, formato))
+
+    def get(self, clave, formato):
+        """Retorna la ruta del resultado si está en la caché, o None si no está.
+        Consultarlo (como hace cada sondeo del estado de una tarea) no cuenta
+        como uso para la purga, sólo entregarlo (véase usar)"""
+        ruta = self.ruta(clave, formato)
+        if not os.path.isfile(ruta):
+            contar("wexam_cache_total", cache="compilacion", resultado="fallo")
+            return None
+        contar("wexam_cache_total", cache="compilacion", resultado="acierto")
+        return ruta
+
+    @staticmethod
+    def usar(ruta):
+        """Actualiza la fecha del resultado, que se está entregando, para que
+        la purga lo considere recién usado"""
+        try:
+            os.utime(ruta, None)
+        except FileNotFoundError:
+            pass
+
+    def leer(self, clave, formato):
+        """Retorna el contenido del resultado, o None si no está en la caché"""
+        ruta = self.get(clave, formato)
+        if ruta is None:
+            return None
+        try:
+            with open(ruta, "rb") as fichero:
+                contenido = fichero.read()
+        except FileNotFoundError:
+            # Pudo ser purgado por otro proceso entre get() y open()
+            return None
+        self.usar(ruta)
+        return contenido
+
+    def put(self, clave, formato, contenido):
+        """Guarda en la caché el resultado de una compilación y purga los
+        más antiguos si se excede el tamaño máximo"""
+        descriptor, temporal = tempfile.mkstemp(dir=self.carpeta, suffix=".tmp")
+        with os.fdopen(descriptor, "wb") as fichero:
+            fichero.write(contenido)
+        ruta = self.ruta(clave, formato)
+        os.replace(temporal, ruta)
+        self.purgar()
+        return ruta
+
+    def purgar(self):
+        """Elimina los resultados usados hace más tiempo hasta que el tamaño
+        total de la caché no supere max_bytes"""
+        ficheros = []
+        with os.scandir(self.carpeta) as entradas:
+            for entrada in entradas:
+                if not entrada.is_file() or entrada.name.endswith(".tmp"):
+                    continue
+                try:
+                    info = entrada.stat()
+                except FileNotFoundError:
+                    continue
+                ficheros.append((info.st_mtime, info.st_size, entrada.path))
+        total = sum(tamaño for _, tamaño, _ in ficheros)
+        for _, tamaño, ruta in sorted(ficheros):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(ruta)
+            except FileNotFoundError:
+                pass
+            total -= tamaño
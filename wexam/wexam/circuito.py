@@ -0,0 +1,158 @@
+"""Conexión a redis con un pool acotado y un interruptor (circuit breaker).
+
+Si redis deja de responder, cada operación esperaría hasta agotar su timeout
+y todos los hilos del servidor acabarían bloqueados en ellas. Para evitarlo,
+tras varios fallos consecutivos el interruptor se abre y las operaciones
+fallan de inmediato (con CircuitoAbierto) sin intentar conectar. Pasado un
+tiempo se deja pasar una única operación de prueba: si tiene éxito el
+interruptor se cierra de nuevo, y si falla vuelve a abrirse.
+
+El interruptor actúa sobre cada conexión del pool, por lo que protege por
+igual los comandos sueltos, los pipelines y las suscripciones pub/sub.
+"""
+
+import threading
+import time
+
+import redis
+from redis.backoff import NoBackoff
+from redis.retry import Retry
+
+from .tiempos import anotar_redis
+
+CERRADO = "cerrado"
+ABIERTO = "abierto"
+SEMIABIERTO = "semiabierto"
+
+
+class CircuitoAbierto(redis.exceptions.ConnectionError):
+    """Redis se considera caído y no se intenta la operación. reintentar es
+    el número de segundos que faltan para la siguiente prueba"""
+    def __init__(self, reintentar):
+        super().__init__("El backend redis no está disponible")
+        self.reintentar = reintentar
+
+
+class Interruptor(object):
+    """Estado del circuit breaker, compartido por todos los hilos del proceso.
+
+    Se abre tras umbral fallos consecutivos, y permanece abierto espera
+    segundos antes de dejar pasar una operación de prueba"""
+
+    def __init__(self, umbral=3, espera=5):
+        self.umbral = umbral
+        self.espera = espera
+        self.estado = CERRADO
+        self.fallos = 0
+        self.abierto_en = 0
+        self.cerrojo = threading.Lock()
+
+    def comprobar(self):
+        """Eleva CircuitoAbierto si no se debe intentar la operación"""
+        if self.estado == CERRADO:
+            return
+        with self.cerrojo:
+            if self.estado == ABIERTO:
+                restante = self.abierto_en + self.espera - time.monotonic()
+                if restante > 0:
+                    raise CircuitoAbierto(restante)
+                # Esta operación es la prueba. Las demás siguen fallando hasta
+                # conocer su resultado
+                self.estado = SEMIABIERTO
+                return
+            if self.estado == SEMIABIERTO:
+                raise CircuitoAbierto(self.espera)
+
+    def exito(self):
+        """Anota una operación correcta, que cierra el interruptor"""
+        if self.estado == CERRADO and self.fallos == 0:
+            return
+        with self.cerrojo:
+            self.estado = CERRADO
+            self.fallos = 0
+
+    def fallo(self):
+        """Anota un fallo de conexión o timeout, que puede abrir el interruptor"""
+        with self.cerrojo:
+            self.fallos += 1
+            if self.estado == SEMIABIERTO or self.fallos >= self.umbral:
+                self.estado = ABIERTO
+                self.abierto_en = time.monotonic()
+
+    def reintentar(self):
+        """Segundos que faltan para la siguiente prueba, o 0 si está cerrado"""
+        if self.estado == CERRADO:
+            return 0
+        return max(0, self.abierto_en + self.espera - time.monotonic())
+
+
+class ConexionProtegida(redis.connection.Connection):
+    """Conexión que consulta al interruptor antes de usar el socket, y le
+    informa del resultado. El interruptor es un atributo de clase, por lo que
+    se crea una subclase para cada uno (véase clase_conexion)"""
+    interruptor = None
+    vigilando = False
+
+    def vigilar(self, operacion, *args, llamada=False, **kwargs):
+        """Ejecuta la operación si el interruptor lo permite, anotando su resultado
+        y su duración (véase tiempos). Las operaciones anidadas (como el connect que
+        hace send_packed_command) cuentan como parte de la exterior"""
+        if self.vigilando:
+            return operacion(*args, **kwargs)
+        self.interruptor.comprobar()
+        self.vigilando = True
+        inicio = time.perf_counter()
+        try:
+            resultado = operacion(*args, **kwargs)
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError):
+            self.interruptor.fallo()
+            raise
+        finally:
+            self.vigilando = False
+            anotar_redis(time.perf_counter() - inicio, llamada)
+        self.interruptor.exito()
+        return resultado
+
+    def connect(self, *args, **kwargs):
+        if self._sock:
+            return None
+        return self.vigilar(super().connect, *args, **kwargs)
+
+    def send_packed_command(self, *args, **kwargs):
+        return self.vigilar(super().send_packed_command, *args, llamada=True, **kwargs)
+
+    def read_response(self, *args, **kwargs):
+        return self.vigilar(super().read_response, *args, **kwargs)
+
+
+def clase_conexion(interruptor, base=redis.connection.Connection):
+    """Subclase de la clase de conexión dada protegida por el interruptor"""
+    if base is redis.connection.Connection:
+        bases = (ConexionProtegida,)
+    else:
+        bases = (ConexionProtegida, base)
+    return type("ConexionProtegida", bases, {"interruptor": interruptor})
+
+
+def crear_conexion(url, config=None):
+    """Retorna un cliente redis para la url dada, con un pool de conexiones
+    acotado y protegido por un interruptor. Los parámetros se toman de la
+    configuración (sección redis), con valores por defecto pensados para
+    fallar pronto. El interruptor queda en el atributo interruptor"""
+    interruptor = Interruptor(umbral=getattr(config, "fallos_maximos", 3),
+                              espera=getattr(config, "espera_reintento", 5))
+    base = (redis.connection.SSLConnection if url.startswith("rediss:")
+            else redis.connection.Connection)
+    pool = redis.BlockingConnectionPool.from_url(
+        url,
+        connection_class=clase_conexion(interruptor, base),
+        max_connections=getattr(config, "max_conexiones", 20),
+        # Segundos que se espera a que haya una conexión libre en el pool
+        timeout=getattr(config, "espera_pool", 1),
+        socket_connect_timeout=getattr(config, "timeout_conexion", 0.5),
+        socket_timeout=getattr(config, "timeout", 2),
+        # Los reintentos los gestiona el interruptor
+        retry=Retry(NoBackoff(), 0))
+    cliente = redis.Redis(connection_pool=pool)
+    cliente.interruptor = interruptor
+    return cliente
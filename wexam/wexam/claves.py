@@ -0,0 +1,101 @@
+"""Cifrado y verificación de las claves de los profesores.
+
+Las claves se cifran con un CryptContext de passlib cuyo esquema y coste se
+toman de la configuración (sección claves), de modo que cada entorno puede
+usar el suyo: alto en producción, mínimo en los test. Si se cambia, los hash
+existentes se recalculan con el nuevo coste la siguiente vez que su dueño
+hace login (véase verificar).
+
+Verificar una clave con bcrypt cuesta cientos de milisegundos de CPU. Para
+que una avalancha de logins (al comienzo de una clase) no ocupe todos los
+hilos del servidor, las verificaciones se ejecutan en un pool acotado de
+hilos, y si ya hay demasiadas pendientes se rechazan (Saturado) para que el
+cliente reintente. Como el hilo de la petición espera el resultado, el número
+de pendientes debe quedar por debajo de los hilos del servidor.
+
+El contexto y el pool son globales del proceso, pues las claves se cifran
+también desde código que no tiene acceso a la app. configurar() los crea a
+partir de la configuración, y hasta entonces se usan valores por defecto.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+from passlib.context import CryptContext
+
+from .metricas import observar
+
+
+class Saturado(Exception):
+    """Hay demasiadas verificaciones de claves pendientes. reintentar es el
+    número de segundos tras los que se sugiere reintentarlo"""
+    def __init__(self, reintentar):
+        super().__init__("Demasiados inicios de sesión simultáneos. Reintenta en unos segundos")
+        self.reintentar = reintentar
+
+
+class Verificador(object):
+    """Verifica claves en un pool de max_hilos hilos, admitiendo como mucho
+    max_pendientes verificaciones a la vez (en curso o esperando)"""
+
+    def __init__(self, contexto, max_hilos=1, max_pendientes=1, reintentar=2):
+        self.contexto = contexto
+        self.pool = ThreadPoolExecutor(max_hilos)
+        self.plazas = threading.BoundedSemaphore(max_pendientes)
+        self.reintentar = reintentar
+
+    def verificar(self, clave, hash_):
+        """Retorna una tupla (válida, nuevo_hash). nuevo_hash es None salvo si
+        la clave es válida pero su hash usa otro esquema o coste que el
+        configurado, en cuyo caso es el hash recalculado que debe guardarse.
+        Eleva Saturado si hay demasiadas verificaciones pendientes"""
+        if not self.plazas.acquire(blocking=False):
+            raise Saturado(self.reintentar)
+        try:
+            return self.pool.submit(self.verificar_en_pool, clave, hash_).result()
+        finally:
+            self.plazas.release()
+
+    def verificar_en_pool(self, clave, hash_):
+        """Verificación propiamente dicha, de la que se mide la duración"""
+        inicio = time.perf_counter()
+        try:
+            return self.contexto.verify_and_update(clave, hash_)
+        finally:
+            observar("wexam_verificacion_clave_segundos", time.perf_counter() - inicio)
+
+
+def crear_contexto(config=None):
+    """CryptContext según la configuración (sección claves). Los hash de
+    esquemas distintos del primero, o con otro coste, se consideran obsoletos"""
+    esquemas = getattr(config, "esquemas", ["bcrypt"])
+    opciones = {"{}__rounds".format(esquemas[0]): getattr(config, "coste", 12)}
+    return CryptContext(schemes=esquemas, deprecated="auto", **opciones)
+
+
+def configurar(config=None):
+    """Prepara el contexto y el verificador a partir de la configuración"""
+    global contexto, verificador    # pylint: disable=global-statement
+    if verificador is not None:
+        verificador.pool.shutdown(wait=False)
+    contexto = crear_contexto(config)
+    verificador = Verificador(contexto,
+                              max_hilos=getattr(config, "max_hilos", 1),
+                              max_pendientes=getattr(config, "max_pendientes", 1),
+                              reintentar=getattr(config, "reintentar", 2))
+
+
+def cifrar(clave):
+    """Retorna el hash de la clave, con el esquema y coste configurados"""
+    return contexto.hash(clave)
+
+
+def verificar(clave, hash_):
+    """Véase Verificador.verificar"""
+    return verificador.verificar(clave, hash_)
+
+
+contexto = None
+verificador = None
+configurar()
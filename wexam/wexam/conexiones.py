@@ -0,0 +1,254 @@
+"""Pool de conexiones a postgres compartido por los hilos de cada proceso.
+
+Pony abre una conexión por hilo y la mantiene abierta mientras el hilo vive,
+sin límite en su número ni control sobre su antigüedad. Bajo uwsgi, con
+varios procesos y varios hilos en cada uno, eso hace imposible acotar las
+conexiones que recibe el servidor postgres, y una conexión cortada por el
+servidor (o por un cortafuegos tras estar inactiva) sólo se detecta al
+fallar la siguiente consulta.
+
+PoolConexiones sustituye al pool de pony (se le pasa en db.bind como
+pony_pool_mockup) y reparte entre los hilos un conjunto acotado de
+conexiones:
+
+* Mantiene abiertas como mucho `conexiones`, y en momentos de carga abre
+  hasta `extra` más, que se cierran al liberarse. Si están todas en uso se
+  espera `espera` segundos por una libre, y después se eleva PoolAgotado
+* Cierra las conexiones que llevan más de `max_inactividad` segundos sin
+  usarse, y comprueba (con SELECT 1) las que llevan más de `comprobar_tras`
+  antes de entregarlas
+* Es seguro frente a fork: uwsgi carga la aplicación y después crea los
+  workers, que heredarían las conexiones del proceso padre. Cada proceso
+  usa sólo las que abrió él, y las heredadas no se cierran (cerrarlas
+  cortaría también las del padre)
+
+Las opciones de cada conexión (statement_timeout y timeout_conexion) se
+aplican al abrirla, tanto si los parámetros vienen de la configuración como
+de la variable DATABASE_URL.
+
+Con SQLite (instalaciones de un solo nodo) no hay pool, pero cada conexión se
+ajusta según la sección sqlite de la configuración (véase ajustar_sqlite).
+Por defecto SQLite usa un journal de rollback, con el que los lectores
+bloquean a los escritores y viceversa, y los procesos de uwsgi acaban
+fallando con "database is locked". En modo WAL las lecturas no esperan a las
+escrituras, y con synchronous=NORMAL cada commit no espera a que el disco
+confirme la escritura (sigue siendo seguro frente a caídas del proceso, y
+sólo una caída del sistema puede perder los últimos commits).
+"""
+
+from collections import deque
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+
+class PoolAgotado(Exception):
+    """No hay conexiones libres con la base de datos. reintentar es el número
+    de segundos tras los que se sugiere reintentarlo"""
+    def __init__(self, reintentar):
+        super().__init__("La base de datos está saturada. Reintenta en unos segundos")
+        self.reintentar = reintentar
+
+
+class PoolConexiones(object):
+    """Pool de conexiones DB-API con la interfaz que pony espera de los suyos
+    (connect, release, drop y disconnect). conectar() abre una conexión"""
+
+    def __init__(self, conectar, conexiones=5, extra=5, espera=2,
+                 max_inactividad=300, comprobar_tras=30):
+        self.conectar = conectar
+        self.conexiones = conexiones
+        self.extra = extra
+        self.espera = espera
+        self.max_inactividad = max_inactividad
+        self.comprobar_tras = comprobar_tras
+        self.cerrojo = threading.Condition()
+        self.libres = deque()    # (conexión, instante en que se liberó)
+        self.abiertas = 0
+        self.heredadas = []
+        self.pid = os.getpid()
+
+    def comprobar_proceso(self):
+        """Tras un fork descarta las conexiones del proceso padre, pero sin
+        cerrarlas, y conserva una referencia para que no las cierre el
+        recolector de basura. Debe llamarse con el cerrojo adquirido"""
+        if self.pid == os.getpid():
+            return
+        self.heredadas.extend(con for con, _ in self.libres)
+        self.libres.clear()
+        self.abiertas = 0
+        self.pid = os.getpid()
+
+    def cerrar(self, con):
+        try:
+            con.close()
+        except Exception:     # pylint: disable=broad-except
+            pass
+
+    def sana(self, con):
+        """Comprueba que la conexión sigue viva"""
+        try:
+            cursor = con.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+            con.rollback()
+            return True
+        except Exception:     # pylint: disable=broad-except
+            return False
+
+    def connect(self):
+        """Retorna una tupla (conexión, es_nueva), como los pool de pony.
+        Eleva PoolAgotado si no queda ninguna libre tras la espera"""
+        limite = time.monotonic() + self.espera
+        while True:
+            with self.cerrojo:
+                self.comprobar_proceso()
+                while not self.libres and self.abiertas >= self.conexiones + self.extra:
+                    restante = limite - time.monotonic()
+                    if restante <= 0:
+                        raise PoolAgotado(max(1, round(self.espera)))
+                    self.cerrojo.wait(restante)
+                    self.comprobar_proceso()
+                if self.libres:
+                    # La usada más recientemente, que es la que menos probablemente ha caducado
+                    con, liberada = self.libres.pop()
+                else:
+                    con, liberada = None, None
+                    self.abiertas += 1
+            if con is None:
+                try:
+                    return self.conectar(), True
+                except Exception:
+                    self.descontar()
+                    raise
+            inactiva = time.monotonic() - liberada
+            if inactiva <= self.max_inactividad and (inactiva <= self.comprobar_tras
+                                                     or self.sana(con)):
+                return con, False
+            self.cerrar(con)
+            self.descontar()
+
+    def descontar(self):
+        """Anota que se ha cerrado una conexión, dejando sitio para otra"""
+        with self.cerrojo:
+            self.abiertas -= 1
+            self.cerrojo.notify()
+
+    def release(self, con):
+        """Devuelve la conexión al pool, deshaciendo lo que quedase pendiente.
+        Las que superan el número de conexiones a mantener se cierran"""
+        try:
+            con.rollback()
+        except Exception:
+            self.drop(con)
+            raise
+        with self.cerrojo:
+            if len(self.libres) < self.conexiones:
+                self.libres.append((con, time.monotonic()))
+                self.cerrojo.notify()
+                return
+        self.drop(con)
+
+    def drop(self, con):
+        """Cierra una conexión entregada por el pool"""
+        self.cerrar(con)
+        self.descontar()
+
+    def disconnect(self):
+        """Cierra todas las conexiones libres"""
+        with self.cerrojo:
+            self.comprobar_proceso()
+            libres = list(self.libres)
+            self.libres.clear()
+            self.abiertas -= len(libres)
+            self.cerrojo.notify_all()
+        for con, _ in libres:
+            self.cerrar(con)
+
+
+def parametros_url(url):
+    """Parámetros de db.bind a partir de una URL como la de DATABASE_URL"""
+    data = urlparse(url)
+    provider = data.scheme
+    if provider == "postgresql":
+        provider = "postgres"
+    return {
+        "provider": provider,
+        "user": data.username,
+        "password": data.password,
+        "host": data.hostname,
+        "port": data.port,
+        "database": data.path[1:],
+        "create_db": None
+    }
+
+
+def opciones_conexion(config, solo_lectura=False):
+    """Parámetros adicionales de psycopg2.connect según la configuración. Con
+    solo_lectura, la conexión rechaza cualquier escritura"""
+    opciones = {}
+    ajustes = []
+    timeout = getattr(config, "statement_timeout", None)
+    if timeout:
+        ajustes.append("-c statement_timeout={}".format(int(timeout * 1000)))
+    if solo_lectura:
+        ajustes.append("-c default_transaction_read_only=on")
+    if ajustes:
+        opciones["options"] = " ".join(ajustes)
+    timeout = getattr(config, "timeout_conexion", None)
+    if timeout:
+        opciones["connect_timeout"] = max(1, int(timeout))
+    return opciones
+
+
+def crear_pool(db_params, config, solo_lectura=False):
+    """Retorna un PoolConexiones a la base de datos de db_params (parámetros
+    de db.bind), configurado según config (sección pool_db). Para que pony
+    lo use se le pasa en db.bind como pony_pool_mockup"""
+    parametros = {k: v for k, v in db_params.items()
+                  if k not in ("provider", "create_db") and v is not None}
+    parametros.update(opciones_conexion(config, solo_lectura))
+
+    def conectar():
+        import psycopg2     # pylint: disable=import-outside-toplevel
+        con = psycopg2.connect(**parametros)
+        con.set_client_encoding("UTF8")
+        return con
+
+    pool = PoolConexiones(conectar,
+                          conexiones=getattr(config, "conexiones", 5),
+                          extra=getattr(config, "extra", 5),
+                          espera=getattr(config, "espera", 2),
+                          max_inactividad=getattr(config, "max_inactividad", 300),
+                          comprobar_tras=getattr(config, "comprobar_tras", 30))
+    return pool
+
+
+def pragmas_sqlite(config):
+    """Sentencias PRAGMA que aplican a una conexión con SQLite la
+    configuración dada (sección sqlite)"""
+    pragmas = [
+        "PRAGMA journal_mode={}".format(getattr(config, "journal_mode", "wal")),
+        "PRAGMA synchronous={}".format(getattr(config, "synchronous", "normal")),
+        # Milisegundos que se espera a que otro proceso libere la base de datos
+        "PRAGMA busy_timeout={}".format(int(getattr(config, "busy_timeout", 5) * 1000)),
+        "PRAGMA mmap_size={}".format(int(getattr(config, "mmap_size", 0))),
+    ]
+    cache = getattr(config, "cache_size", None)
+    if cache:
+        # Negativo, para expresarlo en KiB y no en páginas
+        pragmas.append("PRAGMA cache_size=-{}".format(int(cache)))
+    return pragmas
+
+
+def ajustar_sqlite(db, config):
+    """Hace que pony aplique los pragmas de la configuración a cada conexión
+    con SQLite que abra. Debe llamarse antes de db.bind"""
+    pragmas = pragmas_sqlite(config)
+
+    @db.on_connect(provider="sqlite")
+    def aplicar_pragmas(db, conexion):     # pylint: disable=unused-argument,unused-variable
+        cursor = conexion.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
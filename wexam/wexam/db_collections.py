@@ -8,12 +8,12 @@ from datetime import datetime
 from time import mktime, strptime
 from pony.orm.core import ObjectNotFound
 from pony.orm import commit
-from pony.orm import desc
-from passlib.hash import bcrypt
+from pony.orm import desc, select
 
 # from pony.orm import delete
 from . import model
 from . import util
+from . import claves
 
 # Colecciones de items de la base de datos
 class DBCollection(object):
@@ -59,10 +59,13 @@ class DBCollection(object):
         si la clase no tiene campo 'creador'"""
 
         quien = model.Profesor.get(id=id_)
+        # A igual fecha, por orden de creación. Sólo hay que ordenar los empates,
+        # el resto del orden lo da el índice de fecha_modificacion
+        orden = (desc(self.clase.fecha_modificacion), self.clase.id)
         if quien.role == "admin":
-            return self.clase.select().order_by(desc(self.clase.fecha_modificacion))
+            return self.clase.select().order_by(*orden)
         creados = (self.clase.select(lambda p: p.creador == quien)
-                   .order_by(desc(self.clase.fecha_modificacion)))
+                   .order_by(*orden))
         print(creados)
         return creados
 
@@ -92,7 +95,7 @@ class Profesores(DBCollection):
 
     def add(self, data, tipo=None):
         # Forzar a que la clave se guarde cifrada
-        data.update(password=bcrypt.hash(data["password"]))
+        data.update(password=claves.cifrar(data["password"]))
         data.update(email=data["email"].lower())
         return DBCollection.add(self, data, model.Profesor)
 
@@ -193,7 +196,9 @@ class Problemas(DBCollection):
             todos = self.query()
         else:
             creados = model.Problema.select(lambda p: p.creador == quien)
-            compartidos = model.Problema.select(lambda p: quien in p.compartido_con.miembros)
+            # Recorriendo los círculos del profesor, y no todos los problemas
+            compartidos = select(p for p in model.Problema for c in p.compartido_con
+                                 for m in c.miembros if m == quien)
             todos = set.union(set(creados), set(compartidos))
         tags = None
         orden = "id"
@@ -0,0 +1,322 @@
+"""Backends que ejecutan las tareas de compilación.
+
+Las vistas y los modelos no usan rq directamente, sino el backend guardado en
+app.tareas, que ofrece siempre las mismas operaciones:
+
+* lanzar(nombre, *args, clave, sync, usuario, prioridad, admitir, **kwargs):
+  inicia la tarea 'tasks.<nombre>' y retorna el id de su trabajo
+* trabajo(job_id): el trabajo, o None si no existe. Tiene el interfaz de un
+  trabajo rq que usa el resto de la aplicación (get_status, is_finished,
+  is_failed, meta, result, exc_info)
+* trabajos(job_ids): lista con el trabajo (o None) de cada id, obtenidos de
+  una vez
+* promover(job, formato, sync): pasa el trabajo a la cola interactiva si una
+  petición de ese formato y modo debe ir a ella
+* despachar(): da a los trabajos en espera la oportunidad de avanzar
+* esperar(job_id, timeout) y eventos(job_id, timeout): como en el módulo tareas
+
+Hay dos implementaciones:
+
+* BackendRQ, que encola los trabajos en redis para los workers rq del servicio
+  de compilación
+* BackendLocal, para instalaciones de un solo nodo o de desarrollo sin redis,
+  que ejecuta las mismas funciones en un pool de procesos de la propia app y
+  guarda su estado en disco
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timezone
+import functools
+import importlib
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+
+import redis
+
+from . import tareas
+
+
+class BackendRQ(object):
+    """Tareas ejecutadas por los workers rq. Las colas, los planificadores y la
+    conexión se toman de la app en cada operación (app.redis, app.task_queues
+    y app.planificadores)"""
+
+    def __init__(self, app):
+        self.app = app
+
+    def lanzar(self, nombre, *args, clave=None, sync=False, usuario=None,
+               prioridad=None, admitir=True, **kwargs):
+        """Encola el trabajo en la cola de la prioridad dada o, si no se da, en
+        la que corresponda a su formato. Si hay planificador, espera allí su
+        turno, y (salvo que no se pida admitir) eleva planificador.Saturado si
+        el usuario ya tiene demasiados trabajos en curso y el trabajo no
+        comparte otro ya lanzado. Los trabajos que no se admiten tampoco
+        cuentan para ese límite"""
+        if prioridad is None:
+            prioridad = tareas.elegir_cola(kwargs.get("formato"), sync)
+        cola = self.app.task_queues.get(prioridad, self.app.task_queue)
+        planificadores = getattr(self.app, "planificadores", {})
+        planificador = planificadores.get(prioridad)
+        return tareas.encolar(cola, nombre, *args, clave=clave,
+                              promocionar=prioridad == tareas.COLA_INTERACTIVA,
+                              planificadores=planificadores.values(),
+                              planificador=planificador, usuario=usuario,
+                              contar=admitir, **kwargs)
+
+    def trabajo(self, job_id):
+        return tareas.obtener_trabajo(self.app.redis, job_id)
+
+    def trabajos(self, job_ids):
+        return tareas.obtener_trabajos(self.app.redis, job_ids)
+
+    def promover(self, job, formato=None, sync=False):
+        if tareas.elegir_cola(formato, sync) != tareas.COLA_INTERACTIVA:
+            return
+        cola = self.app.task_queues.get(tareas.COLA_INTERACTIVA)
+        if cola is not None:
+            tareas.promover(cola, job, getattr(self.app, "planificadores", {}).values())
+
+    def despachar(self):
+        """Pasa a las colas rq los trabajos que quepan en ellas, según los
+        planificadores. No accede a la base de datos, por lo que puede
+        invocarse fuera de la db_session"""
+        try:
+            for planificador in getattr(self.app, "planificadores", {}).values():
+                planificador.despachar()
+        except redis.exceptions.RedisError:
+            pass
+
+    def esperar(self, job_id, timeout):
+        return tareas.esperar(self.app.redis, job_id, timeout,
+                              al_despertar=self.despachar)
+
+    def eventos(self, job_id, timeout):
+        return tareas.eventos(self.app.redis, job_id, timeout,
+                              al_despertar=self.despachar)
+
+
+class TrabajoLocal(object):
+    """Estado de un trabajo del BackendLocal, leído de su fichero. Imita la
+    parte del interfaz de los trabajos rq que usa la aplicación"""
+
+    def __init__(self, backend, job_id, datos):
+        self.backend = backend
+        self.id = job_id
+        self.origin = "local"
+        self.meta = datos.get("meta", {})
+        self.exc_info = datos.get("exc_info")
+        self.status = datos["status"]
+        self.enqueued_at = datetime.fromtimestamp(datos["enqueued_at"], timezone.utc)
+
+    def get_status(self):
+        return self.status
+
+    @property
+    def is_finished(self):
+        return self.status == "finished"
+
+    @property
+    def is_failed(self):
+        return self.status == "failed"
+
+    @property
+    def result(self):
+        """Valor que retornó la tarea (la ruta en que escribió el resultado, o
+        su contenido), o None si no ha terminado"""
+        if not self.is_finished:
+            return None
+        return self.backend.leer_resultado(self.id)
+
+
+def escribir_json(ruta, datos):
+    """Escribe el fichero de forma atómica, pues lo leen otros procesos"""
+    descriptor, temporal = tempfile.mkstemp(dir=os.path.dirname(ruta), suffix=".tmp")
+    with os.fdopen(descriptor, "w") as fichero:
+        json.dump(datos, fichero)
+    os.replace(temporal, ruta)
+
+
+def ejecutar(carpeta, job_id, modulo, nombre, args, kwargs):
+    """Ejecuta la tarea en un proceso del pool, dejando en la carpeta su estado
+    y su resultado"""
+    ruta = os.path.join(carpeta, job_id + ".json")
+    with open(ruta) as fichero:
+        datos = json.load(fichero)
+    datos.update(status="started", meta={"progreso": "Compilando"})
+    escribir_json(ruta, datos)
+    try:
+        funcion = getattr(importlib.import_module(modulo), nombre)
+        resultado = funcion(*args, **kwargs)
+        if type(resultado) == tuple:
+            resultado = resultado[-1]
+        if isinstance(resultado, bytes):
+            with open(os.path.join(carpeta, job_id + ".resultado"), "wb") as fichero:
+                fichero.write(resultado)
+            datos["resultado"] = None
+        else:
+            datos["resultado"] = resultado
+        datos.update(status="finished", meta={})
+    except Exception:     # pylint: disable=broad-except
+        datos.update(status="failed", exc_info=traceback.format_exc())
+    escribir_json(ruta, datos)
+
+
+class BackendLocal(object):
+    """Tareas ejecutadas en un pool de procesos del propio servidor, sin redis.
+
+    El estado de cada trabajo se guarda en un fichero JSON en la carpeta dada,
+    por lo que lo pueden consultar todos los procesos del nodo (aunque cada
+    uno ejecuta sólo los trabajos que lanzó). Las tareas se buscan en el
+    módulo dado, el mismo que usan los workers rq"""
+
+    def __init__(self, carpeta, max_procesos=2, modulo="tasks", retencion=86400):
+        self.carpeta = carpeta
+        self.max_procesos = max_procesos
+        self.modulo = modulo
+        self.retencion = retencion
+        self.pool = None
+        self.lanzados = {}       # clave -> job_id, para compartir trabajos
+        self.cerrojo = threading.Lock()
+        self.cambios = threading.Condition()
+        os.makedirs(carpeta, exist_ok=True)
+
+    def ruta(self, job_id, extension="json"):
+        return os.path.join(self.carpeta, "{}.{}".format(job_id, extension))
+
+    def obtener_pool(self):
+        """El pool se crea al usarlo por primera vez, y no al arrancar, para
+        que cada proceso del servidor (uwsgi los crea con fork) tenga el suyo.
+        Sus procesos se lanzan con spawn, pues fork no es seguro en un proceso
+        con hilos"""
+        with self.cerrojo:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(
+                    self.max_procesos, mp_context=multiprocessing.get_context("spawn"))
+            return self.pool
+
+    def descartar_pool(self, pool):
+        """Descarta el pool dado si sigue siendo el actual, para que el
+        siguiente trabajo cree otro"""
+        with self.cerrojo:
+            if self.pool is pool:
+                self.pool = None
+        pool.shutdown(wait=False)
+
+    def enviar(self, job_id, nombre, args, kwargs):
+        """Envía el trabajo al pool. Si alguno de sus procesos murió (por
+        ejemplo, por falta de memoria), el pool ya no admite trabajos: se
+        descarta y se crea otro"""
+        pool = self.obtener_pool()
+        try:
+            futuro = pool.submit(ejecutar, self.carpeta, job_id, self.modulo,
+                                 nombre, args, kwargs)
+        except BrokenProcessPool:
+            self.descartar_pool(pool)
+            futuro = self.obtener_pool().submit(ejecutar, self.carpeta, job_id,
+                                                self.modulo, nombre, args, kwargs)
+        futuro.add_done_callback(functools.partial(self.terminado, job_id))
+
+    def lanzar(self, nombre, *args, clave=None, sync=False, usuario=None,
+               prioridad=None, admitir=True, **kwargs):
+        """Inicia el trabajo en el pool, que no distingue prioridades ni aplica
+        límites por usuario. Si este proceso ya lanzó uno con la misma clave
+        que no ha fallado ni se ha purgado, retorna el suyo"""
+        with self.cerrojo:
+            if clave is not None and clave in self.lanzados:
+                job = self.trabajo(self.lanzados[clave])
+                if job is not None and job.get_status() in tareas.ESTADOS_COMPARTIBLES:
+                    return job.id
+            job_id = str(uuid.uuid4())
+            escribir_json(self.ruta(job_id), {"status": "queued", "meta": {},
+                                              "enqueued_at": time.time()})
+            if clave is not None:
+                self.lanzados[clave] = job_id
+        self.enviar(job_id, nombre, args, kwargs)
+        self.purgar()
+        return job_id
+
+    def terminado(self, job_id, futuro):
+        """Despierta a quienes esperan algún trabajo, pues uno ha terminado.
+        Si no llegó a ejecutarse o su proceso murió (el pool eleva entonces la
+        excepción en el futuro), el trabajo no pudo anotar su estado y se
+        marca aquí como fallido"""
+        if futuro.cancelled():
+            self.fallido(job_id, "Cancelado")
+        elif futuro.exception() is not None:
+            excepcion = futuro.exception()
+            self.fallido(job_id, "".join(traceback.format_exception(
+                type(excepcion), excepcion, excepcion.__traceback__)))
+        with self.cambios:
+            self.cambios.notify_all()
+
+    def fallido(self, job_id, exc_info):
+        """Marca el trabajo como fallido, con la traza dada"""
+        try:
+            with open(self.ruta(job_id)) as fichero:
+                datos = json.load(fichero)
+        except FileNotFoundError:
+            return
+        datos.update(status="failed", exc_info=exc_info)
+        escribir_json(self.ruta(job_id), datos)
+
+    def trabajo(self, job_id):
+        try:
+            with open(self.ruta(job_id)) as fichero:
+                return TrabajoLocal(self, job_id, json.load(fichero))
+        except FileNotFoundError:
+            return None
+
+    def trabajos(self, job_ids):
+        return [self.trabajo(job_id) for job_id in job_ids]
+
+    def leer_resultado(self, job_id):
+        with open(self.ruta(job_id)) as fichero:
+            resultado = json.load(fichero).get("resultado")
+        if resultado is not None:
+            return resultado
+        try:
+            with open(self.ruta(job_id, "resultado"), "rb") as fichero:
+                return fichero.read()
+        except FileNotFoundError:
+            return None
+
+    def promover(self, job, formato=None, sync=False):
+        pass
+
+    def despachar(self):
+        pass
+
+    def esperar_cambio(self, timeout):
+        """Bloquea hasta que termine algún trabajo de este proceso, o pasen
+        timeout segundos (los de otros procesos sólo se ven al consultarlos)"""
+        with self.cambios:
+            self.cambios.wait(timeout)
+
+    def esperar(self, job_id, timeout):
+        return tareas.aguardar(lambda: self.trabajo(job_id), self.esperar_cambio, timeout)
+
+    def eventos(self, job_id, timeout):
+        return tareas.seguir(lambda: self.trabajo(job_id), self.esperar_cambio, timeout)
+
+    def purgar(self):
+        """Borra el estado y el resultado de los trabajos lanzados hace más de
+        retencion segundos"""
+        limite = time.time() - self.retencion
+        with os.scandir(self.carpeta) as entradas:
+            for entrada in entradas:
+                try:
+                    if entrada.stat().st_mtime < limite:
+                        os.remove(entrada.path)
+                except FileNotFoundError:
+                    pass
+        with self.cerrojo:
+            for clave, job_id in list(self.lanzados.items()):
+                if not os.path.exists(self.ruta(job_id)):
+                    del self.lanzados[clave]
@@ -1,59 +1,147 @@
 # import logging
 import json
 import os
+import threading
 from urllib.parse import urlparse
 
 import yaml
 import morepath
 import redis
-import rq
 
 from .app import App
 from . import mixins
 from .model import db
+from .cache import CacheCompilacion
+from . import tareas
+from .planificador import crear_planificadores
+from .circuito import crear_conexion
+from .ejecutores import BackendRQ, BackendLocal
+from . import claves
+from . import conexiones
+from .replicas import PoolEnrutado
 
 
 def setup_db(app):
-    """Conecta con la base de datos de la aplicación"""
+    """Conecta con la base de datos de la aplicación. Con postgres, si la
+    configuración tiene sección pool_db, las conexiones se toman de un pool
+    acotado (véase conexiones), y si tiene sección replica con su url (o
+    existe la variable de entorno DATABASE_REPLICA_URL) las lecturas se hacen
+    en la réplica (véase replicas). Con SQLite, las conexiones se ajustan
+    según la sección sqlite"""
     if app.settings.database.provider == "from_database_url":
         url = os.getenv("DATABASE_URL", None)
         assert url is not None, "No existe la variable de entorno DATABASE_URL"
-        data = urlparse(url)
-        db_params = {
-            "provider": data.scheme,
-            "user": data.username,
-            "password": data.password,
-            "host": data.hostname,
-            "port": data.port,
-            "database": data.path[1:],
-            "create_db": None
-        }
+        db_params = conexiones.parametros_url(url)
     else:
         db_params = app.settings.database.__dict__.copy()
     print("Using database {}".format(db_params))
+    config = getattr(app.settings, "pool_db", None)
+    replica = getattr(app.settings, "replica", None)
+    url_replica = getattr(replica, "url", None) or os.getenv("DATABASE_REPLICA_URL", None)
+    app.enrutador = None
+    if db_params["provider"] == "postgres" and (config is not None or url_replica):
+        pool = conexiones.crear_pool(db_params, config)
+        if url_replica:
+            print("Using read replica {}".format(urlparse(url_replica).hostname))
+            app.enrutador = PoolEnrutado(pool, conexiones.crear_pool(
+                conexiones.parametros_url(url_replica), config, solo_lectura=True))
+            pool = app.enrutador
+        db_params = {"provider": db_params["provider"], "pony_pool_mockup": pool}
+    config = getattr(app.settings, "sqlite", None)
+    if config is not None and db_params["provider"] == "sqlite":
+        conexiones.ajustar_sqlite(db, config)
     db.bind(**db_params)
     db.generate_mapping(create_tables=True)
+    # Que los workers de uwsgi, creados tras cargar la aplicación, no hereden
+    # conexiones abiertas
+    db.disconnect()
 
 def setup_redis(app):
     """Intenta conectar con redis, o guarda None en las variables apropiadas para indicar
     que no está disponible"""
     if getattr(app.settings, "redis", None) is None:
         app.redis = None
-        app.task_queue = None
+        app.task_queues = {}
     else:
         try:
-            app.redis = redis.Redis.from_url(app.settings.redis.url, socket_timeout=10)
-            app.task_queue = rq.Queue('json2latex-task', connection=app.redis)
+            # Pool acotado y con timeouts cortos, protegido por un interruptor
+            # que hace fallar de inmediato las operaciones si redis cae
+            app.redis = crear_conexion(app.settings.redis.url, app.settings.redis)
+            # Una cola por prioridad (interactiva, lotes y mantenimiento)
+            app.task_queues = tareas.crear_colas(app.redis,
+                                                 getattr(app.settings, "colas", None))
         except:
             app.redis = None
-            app.task_queue = None
+            app.task_queues = {}
+    # Cola por defecto, la de lotes
+    app.task_queue = app.task_queues.get(tareas.COLA_LOTES)
+    # Reparto equitativo de los trabajos entre profesores, si se configura
+    config = getattr(app.settings, "planificador", None)
+    if config is None:
+        app.planificadores = {}
+    else:
+        app.planificadores = crear_planificadores(app.task_queues, config)
+    if app.redis is not None:
+        try:
+            tareas.activar_notificaciones(app.redis)
+        except redis.exceptions.RedisError as e:
+            print("No se pudieron activar las notificaciones de redis ({}). Las "
+                  "descargas síncronas consultarán el estado periódicamente".format(e))
+    # Número de hilos de este proceso que pueden quedarse bloqueados a la vez
+    # esperando a una compilación, ya sea en una descarga con sync=1 o en un
+    # flujo de eventos (/task/{id}/events). Ambos comparten el límite, que
+    # debe ser menor que el número de hilos de cada proceso, para que siempre
+    # quede alguno libre para las demás peticiones
+    config = getattr(app.settings, "tareas", None)
+    app.bloqueos = threading.BoundedSemaphore(getattr(config, "max_bloqueos", 1))
+
+def setup_cache(app):
+    """Prepara la caché de resultados de compilación, o guarda None si la
+    configuración no especifica una"""
+    if getattr(app.settings, "cache", None) is None:
+        app.cache = None
+    else:
+        app.cache = CacheCompilacion(app.settings.cache.folder,
+                                     app.settings.cache.max_bytes,
+                                     getattr(app.settings.cache, "compartida", False))
+
+def setup_tareas(app):
+    """Elige el backend que ejecuta las tareas de compilación: los workers rq
+    si hay redis, o un pool de procesos local si la configuración lo permite
+    (sección ejecutor_local). Si no hay ninguno guarda None"""
+    config = getattr(app.settings, "ejecutor_local", None)
+    usar_rq = app.redis is not None
+    if usar_rq and config is not None:
+        # crear_conexion no conecta, así que se comprueba aquí si redis
+        # responde. Si no, las tareas se quedan en este nodo
+        try:
+            app.redis.ping()
+        except redis.exceptions.RedisError as e:
+            print("No se pudo conectar con redis ({}). Las tareas de compilación "
+                  "se ejecutarán en este nodo".format(e))
+            usar_rq = False
+    if usar_rq:
+        app.tareas = BackendRQ(app)
+    elif config is not None:
+        app.tareas = BackendLocal(config.carpeta,
+                                  max_procesos=getattr(config, "max_procesos", 2),
+                                  modulo=getattr(config, "modulo", "tasks"),
+                                  retencion=getattr(config, "retencion", 86400))
+    else:
+        app.tareas = None
+
+def setup_claves(app):
+    """Configura el cifrado de las claves y el pool en que se verifican"""
+    claves.configurar(getattr(app.settings, "claves", None))
 
 def instance_app():
     """Crea una instancia de la aplicación"""
 
     morepath.autoscan()
 
-    # Lo siguiente prepara el logger de pony.orm para que emita a un
+    # Para ver cuántas consultas lanza cada petición basta la sección tiempos
+    # de la configuración (véase tiempos). Si hace falta verlas todas, lo
+    # siguiente prepara el logger de pony.orm para que emita a un
     # fichero todas las sentencias SQL que va enviando a la base de datos
     # pony.orm.sql_debug(True)
     # logger = logging.getLogger("pony.orm.sql")
@@ -85,5 +173,8 @@ def instance_app():
     app = App()
 
     setup_redis(app)
+    setup_tareas(app)
+    setup_cache(app)
+    setup_claves(app)
     setup_db(app)
     return app
@@ -0,0 +1,159 @@
+"""Mantenimiento periódico de la base de datos.
+
+Las peticiones sólo borran lo que ellas mismas dejan huérfano (los tags que
+se quitan a un problema, la asignatura que deja de usar un examen). Lo que
+queda huérfano por otras causas lo elimina este módulo:
+
+* Tags que no usa ningún problema
+* Asignaturas sin exámenes (por ejemplo, tras borrar el examen)
+* Tareas fallidas, o cuyo resultado ya no está en el almacén y cuyo trabajo
+  ya no existe en el backend. get_status sólo las borra cuando alguien las
+  consulta, por lo que las que nadie consulta se acumularían
+
+Entre pasada y pasada, el comando reparte además cada pocos segundos los
+trabajos que esperan en el planificador (véase planificador), que de otro
+modo sólo avanzan cuando alguna petición encola, consulta o espera una tarea.
+
+Todo se hace por lotes, cada uno en su propia transacción, para no bloquear
+la base de datos durante mucho tiempo.
+
+Se ejecuta con el comando `wexam-mantenimiento` (véase setup.py), una sola vez
+o cada cierto intervalo (sección mantenimiento de la configuración). Las
+métricas de cada pasada se muestran en la salida estándar y se guardan en
+redis, en la clave CLAVE_METRICAS.
+"""
+
+import argparse
+from datetime import datetime
+import json
+import os
+import time
+
+from pony.orm import db_session
+import redis
+
+# Como en la app, instance_app se importa antes que model, pues importar model
+# el primero cierra un ciclo (model, mixins, permissions, model) en el que
+# permissions aún no encuentra las entidades
+from .instance_app import instance_app
+from . import model
+
+CLAVE_METRICAS = "wexam:mantenimiento:ultima"
+
+
+def purgar_huerfanos(consulta, lote):
+    """Borra, en lotes de como mucho lote objetos, los que retorna consulta()
+    (una consulta pony). Retorna cuántos ha borrado"""
+    borrados = 0
+    while True:
+        with db_session():
+            objetos = consulta()[:lote]
+            for objeto in objetos:
+                objeto.delete()
+        borrados += len(objetos)
+        if len(objetos) < lote:
+            return borrados
+
+
+def purgar_tags(lote=500):
+    """Borra los tags que no usa ningún problema"""
+    return purgar_huerfanos(lambda: model.Tag.select(lambda t: not t.problemas), lote)
+
+
+def purgar_asignaturas(lote=500):
+    """Borra las asignaturas sin exámenes"""
+    return purgar_huerfanos(lambda: model.Asignatura.select(lambda a: not a.examenes), lote)
+
+
+def purgar_tareas(app, lote=500):
+    """Borra las tareas fallidas y las que ya no tienen ni resultado en el
+    almacén ni trabajo en el backend. Los trabajos de cada lote se consultan
+    al backend de una vez. Sin backend de tareas no se borra nada, pues no se
+    puede saber en qué estado están"""
+    if getattr(app, "tareas", None) is None:
+        return 0
+    cache = getattr(app, "cache", None)
+    borradas = 0
+    ultima = ""
+    while True:
+        with db_session():
+            tareas = model.Tarea.select(lambda t: t.id > ultima).order_by(model.Tarea.id)[:lote]
+            if not tareas:
+                return borradas
+            ultima = tareas[-1].id
+            # No se usa cache.get, que contaría aciertos en las métricas
+            pendientes = [t for t in tareas if cache is None or not t.clave
+                          or not os.path.exists(cache.ruta(t.clave, t.tipo))]
+            trabajos = app.tareas.trabajos([t.trabajo or t.id for t in pendientes])
+            for tarea, job in zip(pendientes, trabajos):
+                if job is None or job.is_failed:
+                    tarea.delete()
+                    borradas += 1
+        if len(tareas) < lote:
+            return borradas
+
+
+def guardar_metricas(app, metricas):
+    """Guarda en redis las métricas de la última pasada, si está disponible"""
+    if getattr(app, "redis", None) is None:
+        return
+    try:
+        app.redis.set(CLAVE_METRICAS, json.dumps(metricas))
+    except redis.exceptions.RedisError:
+        pass
+
+
+def mantener(app, lote=500):
+    """Realiza una pasada completa de mantenimiento y retorna sus métricas:
+    número de objetos borrados de cada tipo, y segundos empleados"""
+    inicio = time.monotonic()
+    metricas = {"fecha": datetime.now().isoformat()}
+    for nombre, purgar in (("tags", lambda: purgar_tags(lote)),
+                           ("asignaturas", lambda: purgar_asignaturas(lote)),
+                           ("tareas", lambda: purgar_tareas(app, lote))):
+        parcial = time.monotonic()
+        metricas[nombre] = purgar()
+        metricas["segundos_" + nombre] = round(time.monotonic() - parcial, 3)
+    metricas["segundos"] = round(time.monotonic() - inicio, 3)
+    guardar_metricas(app, metricas)
+    return metricas
+
+
+def despachar_durante(app, segundos, cada):
+    """Durante los segundos dados, pasa a las colas rq cada `cada` segundos
+    los trabajos que quepan en ellas (véase BackendRQ.despachar)"""
+    fin = time.monotonic() + segundos
+    while True:
+        if getattr(app, "tareas", None) is not None:
+            app.tareas.despachar()
+        restante = fin - time.monotonic()
+        if restante <= 0:
+            return
+        time.sleep(min(cada, restante))
+
+
+def main():
+    """Punto de entrada del comando wexam-mantenimiento"""
+    parser = argparse.ArgumentParser(description="Mantenimiento periódico de wexam")
+    parser.add_argument("--una-vez", action="store_true",
+                        help="realizar una sola pasada y terminar")
+    parser.add_argument("--intervalo", type=float,
+                        help="segundos entre pasadas (por defecto, los de la configuración)")
+    parser.add_argument("--lote", type=int,
+                        help="objetos borrados en cada transacción")
+    args = parser.parse_args()
+
+    app = instance_app()
+    config = getattr(app.settings, "mantenimiento", None)
+    intervalo = args.intervalo or getattr(config, "intervalo", 3600)
+    lote = args.lote or getattr(config, "lote", 500)
+    reparto = getattr(config, "intervalo_reparto", 5)
+    while True:
+        print(json.dumps(mantener(app, lote)), flush=True)
+        if args.una_vez:
+            return
+        despachar_durante(app, intervalo, reparto)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+"""Métricas del servidor en el formato de texto de Prometheus (/metrics).
+
+Cada proceso acumula en memoria (en registro) los incrementos de sus
+métricas: el tween medir_vistas cuenta las peticiones, su duración y las
+consultas SQL que lanzan, por modelo y vista, y otros módulos anotan los
+aciertos y fallos de sus cachés y la duración de la verificación de claves.
+Anotar cuesta sólo unas sumas en un diccionario.
+
+Para que /metrics muestre los totales de todos los procesos uwsgi (y no
+sólo los del que atiende la petición), cada proceso vuelca sus incrementos
+cada intervalo segundos (sección metricas de la configuración) a un hash de
+redis, con una única transacción. Sin redis, cada proceso muestra sólo los
+suyos. El estado de las colas de compilación se consulta en el momento.
+"""
+
+from bisect import bisect_left
+from functools import lru_cache
+import hmac
+import threading
+import time
+
+import dectate
+import redis
+
+from .app import App
+from .replicas import enrutar_lecturas
+from .tiempos import medir_peticion
+
+CLAVE_METRICAS = "wexam:metricas"
+# Límites (en segundos) de los intervalos de los histogramas
+INTERVALOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Nombre, tipo y descripción de cada métrica, en el orden en que se muestran
+FAMILIAS = (
+    ("wexam_peticiones_total", "counter",
+     "Peticiones atendidas, por modelo, vista, método y código de estado"),
+    ("wexam_peticion_segundos", "histogram", "Duración de las peticiones, por modelo y vista"),
+    ("wexam_consultas_sql_total", "counter", "Consultas SQL lanzadas, por modelo y vista"),
+    ("wexam_cache_total", "counter", "Consultas a las cachés, por caché y resultado"),
+    ("wexam_verificacion_clave_segundos", "histogram",
+     "Duración de la verificación de claves en el login"),
+    ("wexam_cola_pendientes", "gauge", "Trabajos pendientes en cada cola de compilación"),
+    ("wexam_cola_en_curso", "gauge", "Trabajos en ejecución de cada cola de compilación"),
+    ("wexam_cola_espera_segundos", "gauge",
+     "Segundos que lleva esperando el trabajo más antiguo de cada cola"),
+)
+SUFIJOS_HISTOGRAMA = ("_bucket", "_sum", "_count")
+
+
+def serie(nombre, **etiquetas):
+    """Nombre de una serie con sus etiquetas, como aparece en /metrics"""
+    if not etiquetas:
+        return nombre
+    return "{}{{{}}}".format(nombre, ",".join(
+        '{}="{}"'.format(clave, escapar(valor)) for clave, valor in etiquetas.items()))
+
+
+def escapar(valor):
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# Las series se componen una vez y se reutilizan, pues formatearlas en cada
+# petición costaría más que todo lo demás
+@lru_cache(maxsize=4096)
+def serie_contador(nombre, etiquetas):
+    return serie(nombre, **dict(etiquetas))
+
+
+@lru_cache(maxsize=4096)
+def series_histograma(nombre, etiquetas):
+    """Series de los intervalos (de menor a mayor, y +Inf), del número de
+    valores y de su suma de un histograma"""
+    etiquetas = dict(etiquetas)
+    intervalos = [serie(nombre + "_bucket", **etiquetas, le=limite)
+                  for limite in INTERVALOS + ("+Inf",)]
+    return (intervalos, serie(nombre + "_count", **etiquetas),
+            serie(nombre + "_sum", **etiquetas))
+
+
+class Registro(object):
+    """Incrementos de las métricas de este proceso aún no volcados a redis (y,
+    si no hay redis, los totales del proceso)"""
+
+    def __init__(self):
+        self.cerrojo = threading.Lock()
+        self.pendientes = {}
+        self.acumulado = {}
+        self.volcado = time.monotonic()
+
+    def sumar(self, nombre, valor=1, **etiquetas):
+        clave = serie_contador(nombre, tuple(etiquetas.items()))
+        with self.cerrojo:
+            self.pendientes[clave] = self.pendientes.get(clave, 0) + valor
+
+    def observar(self, nombre, segundos, **etiquetas):
+        """Anota un valor en un histograma. Los intervalos son acumulativos,
+        como los espera Prometheus: se suma 1 en todos aquellos cuyo límite
+        (le) es mayor o igual que el valor"""
+        intervalos, cuenta, suma = series_histograma(nombre, tuple(etiquetas.items()))
+        with self.cerrojo:
+            pendientes = self.pendientes
+            for clave in intervalos[bisect_left(INTERVALOS, segundos):]:
+                pendientes[clave] = pendientes.get(clave, 0) + 1
+            pendientes[cuenta] = pendientes.get(cuenta, 0) + 1
+            pendientes[suma] = pendientes.get(suma, 0) + segundos
+
+    def volcar(self, conexion):
+        """Pasa los incrementos pendientes a redis (o a acumulado si no hay
+        redis). Si redis falla se conservan para el siguiente volcado"""
+        with self.cerrojo:
+            pendientes, self.pendientes = self.pendientes, {}
+            self.volcado = time.monotonic()
+        if conexion is None:
+            destino = self.acumulado
+        else:
+            try:
+                pipe = conexion.pipeline()
+                for clave, valor in pendientes.items():
+                    pipe.hincrbyfloat(CLAVE_METRICAS, clave, valor)
+                pipe.execute()
+                return
+            except redis.exceptions.RedisError:
+                destino = self.pendientes
+        with self.cerrojo:
+            for clave, valor in pendientes.items():
+                destino[clave] = destino.get(clave, 0) + valor
+
+    def leer(self, conexion):
+        """Valores de todas las series, tras volcar los de este proceso"""
+        self.volcar(conexion)
+        if conexion is None:
+            with self.cerrojo:
+                return dict(self.acumulado)
+        return {clave.decode(): float(valor)
+                for clave, valor in conexion.hgetall(CLAVE_METRICAS).items()}
+
+
+registro = Registro()
+
+
+def contar(nombre, valor=1, **etiquetas):
+    """Suma valor a un contador de este proceso"""
+    registro.sumar(nombre, valor, **etiquetas)
+
+
+def observar(nombre, segundos, **etiquetas):
+    """Anota un valor en un histograma de este proceso"""
+    registro.observar(nombre, segundos, **etiquetas)
+
+
+def nombres_vistas(clase_app):
+    """Diccionario que asocia el lugar del código en que se declaró cada vista
+    (que morepath anota en request.view_code_info) con el nombre de su modelo
+    y el de la función que la implementa"""
+    nombres = {}
+    for accion, funcion in dectate.query_app(clase_app, "view"):
+        info = accion.code_info
+        nombres[(info.path, info.lineno)] = (accion.model.__name__, funcion.__name__)
+    return nombres
+
+
+def token_valido(config, autorizacion):
+    """Indica si la cabecera Authorization lleva el token de la sección
+    metricas de la configuración, con el que se identifica el recolector"""
+    token = getattr(config, "token", None)
+    if not token or not autorizacion:
+        return False
+    return hmac.compare_digest(autorizacion.encode(), "Bearer {}".format(token).encode())
+
+
+def formato(valor):
+    if float(valor).is_integer():
+        return str(int(valor))
+    return repr(float(valor))
+
+
+def orden(clave):
+    """Orden de las series de una familia: por etiquetas, y los intervalos de
+    los histogramas (cuyo límite, le, es siempre la última) de menor a mayor"""
+    inicio, _, limite = clave.partition('le="')
+    if not limite:
+        return (clave, 0)
+    limite = limite.split('"')[0]
+    return (inicio, float("inf") if limite == "+Inf" else float(limite))
+
+
+def exposicion(valores):
+    """Texto para Prometheus con las series dadas (diccionario serie -> valor)"""
+    familias = {}
+    for clave, valor in valores.items():
+        nombre = clave.split("{")[0]
+        for sufijo in SUFIJOS_HISTOGRAMA:
+            if nombre.endswith(sufijo):
+                nombre = nombre[:-len(sufijo)]
+                break
+        familias.setdefault(nombre, []).append((clave, valor))
+    lineas = []
+    for nombre, tipo, ayuda in FAMILIAS:
+        if nombre not in familias:
+            continue
+        lineas.append("# HELP {} {}".format(nombre, ayuda))
+        lineas.append("# TYPE {} {}".format(nombre, tipo))
+        for clave, valor in sorted(familias[nombre], key=lambda s: orden(s[0])):
+            lineas.append("{} {}".format(clave, formato(valor)))
+    return "\n".join(lineas) + "\n"
+
+
+@App.tween_factory(over=enrutar_lecturas, under=medir_peticion)
+def medir_vistas(app, handler):
+    """Anota las peticiones en el registro. Sin sección metricas en la
+    configuración no hace nada"""
+    config = getattr(app.settings, "metricas", None)
+    if config is None:
+        return handler
+    # Se importa aquí porque el modelo, a través de claves, importa este módulo
+    from .model import db      # pylint: disable=import-outside-toplevel
+    vistas = nombres_vistas(type(app))
+    intervalo = getattr(config, "intervalo", 10)
+
+    def consultas():
+        total = db.local_stats.get(None)
+        return total.db_count if total is not None else 0
+
+    def medir(request):
+        antes = consultas()
+        inicio = time.perf_counter()
+        estado = 500
+        try:
+            response = handler(request)
+            estado = response.status_code
+            return response
+        finally:
+            info = getattr(request, "view_code_info", None)
+            modelo, vista = vistas.get((info.path, info.lineno) if info else None, ("", ""))
+            registro.sumar("wexam_peticiones_total", modelo=modelo, vista=vista,
+                           metodo=request.method, estado=estado)
+            registro.observar("wexam_peticion_segundos", time.perf_counter() - inicio,
+                              modelo=modelo, vista=vista)
+            registro.sumar("wexam_consultas_sql_total", consultas() - antes,
+                           modelo=modelo, vista=vista)
+            if time.monotonic() - registro.volcado >= intervalo:
+                registro.volcar(getattr(app, "redis", None))
+    return medir
@@ -1,11 +1,14 @@
 """Clases mixin para añadir funcionalidad a los modelos sin tener que tocar los modelos"""
 
 from datetime import datetime, timedelta
-from passlib.hash import bcrypt
+import json
+import math
+import os
+import uuid
 from pony.orm import commit
-from webob.exc import HTTPGatewayTimeout
+from webob.exc import (HTTPException, HTTPGatewayTimeout, HTTPTooManyRequests,
+                       HTTPServiceUnavailable)
 import redis
-import rq
 
 # Se implementan métodos específicos para la "lógica de negocio" de cada modelo.
 # Por ejemplo, un profesor, al actualizar la contraseña, debe ser cifrada. Un problema,
@@ -22,6 +25,13 @@ class UpdatableMixin(object):
         self.set(**data)   #pylint:disable=no-member
 
 
+def borrar_tags_huerfanos(tags):
+    """Borra, de entre los tags dados, los que ya no usa ningún problema"""
+    for tag in tags:
+        if tag.problemas.is_empty():
+            tag.delete()
+
+
 class ProblemaMixin(UpdatableMixin):
     """Métodos adicionales para la clase Problema"""
     def is_deletable(self, request):
@@ -134,6 +144,7 @@ class ProblemaMixin(UpdatableMixin):
         if not "tags" in data:
             return False
         problema = self
+        anteriores = list(problema.tags)
         # Borrar lo que habia y cambiarlo por lo que llega
         problema.tags.clear()
         tags_existentes = model.Tag.select(lambda t: t.name in data["tags"])
@@ -146,8 +157,9 @@ class ProblemaMixin(UpdatableMixin):
         for tag in tags_nuevos:
             problema.tags.add(model.Tag(name=tag))
         commit()
-        # Eliminar de la bbdd los tags que ya no son usados
-        model.Tag.select(lambda t: not t.problemas).delete(bulk=True)
+        # Eliminar de la bbdd los tags que este problema ha dejado sin usar. Los
+        # huérfanos por otras causas los elimina el mantenimiento periódico
+        borrar_tags_huerfanos(anteriores)
         return True
 
     def delete_object(self):
@@ -155,8 +167,9 @@ class ProblemaMixin(UpdatableMixin):
         para eliminar los tags huérfanos"""
         if self.is_closed():
             raise ValueError("El problema no puede borrarse por aparecer en exámenes cerrados")
+        tags = list(self.tags)
         self.delete()
-        model.Tag.select(lambda t: not t.problemas).delete(bulk=True)
+        borrar_tags_huerfanos(tags)
         return True
 
     def clone(self, request):
@@ -199,6 +212,15 @@ class ProblemaMixin(UpdatableMixin):
         return problema
 
 
+# Tarea que compila cada formato de descarga del examen
+TAREAS_COMPILACION = {"zip": "json2latex", "tgz": "json2latex", "pdf": "json2pdf"}
+# Variantes de un examen, en el orden en que se entregan, y tarea que compila
+# varias de ellas en un único trabajo (y archivo)
+VARIANTES = ("noresuelto", "resuelto", "explicado")
+TAREA_VARIANTES = "json2latex_variantes"
+FORMATOS_VARIANTES = ("zip", "tgz")
+
+
 class ExamenMixin(UpdatableMixin):
     """Métodos adicionales para la clase Examen"""
     def clear_all_problemas(self):
@@ -290,8 +312,9 @@ class ExamenMixin(UpdatableMixin):
         self.asignatura = asignatura
         return True
 
-    def update_estado(self, nuevo_estado):
-        """Actualizar "inteligentemente" el estado del examen"""
+    def update_estado(self, nuevo_estado, request=None):
+        """Actualizar "inteligentemente" el estado del examen. Si se recibe la
+        petición, tras cerrarlo o publicarlo se precompilan sus descargas"""
 
         if nuevo_estado not in ["abierto", "cerrado", "publicado"]:
             raise ValueError("El estado '{}' no es válido".format(nuevo_estado))
@@ -320,6 +343,70 @@ class ExamenMixin(UpdatableMixin):
         # El resto de transiciones están permitidas
         data_ok.update(estado = transicion[1])
         super().update(data_ok)
+        if request is not None:
+            self.precompilar(request)
+
+    def json_compilacion(self, request, resuelto=None):
+        """Retorna el JSON (serializado) que se envía a compilar, con la
+        variante dada si se especifica"""
+        examen_json = request.view(self, name="data")
+        if resuelto is not None:
+            examen_json["resuelto"] = resuelto
+        return json.dumps(examen_json)
+
+    def lanzar_compilacion(self, request, formato, resuelto, sync=False, **opciones):
+        """Lanza la compilación del examen en el formato dado (zip, tgz o pdf)
+        y retorna la Tarea, o None si no hay backend de tareas. Peticiones
+        idénticas comparten clave, y con ella el resultado compilado"""
+        examen_json = self.json_compilacion(request, resuelto)
+        clave = CacheCompilacion.calcular_clave(examen_json, formato, resuelto)
+        return self.creador.lanzar_tarea(request, TAREAS_COMPILACION[formato],
+                                         clave=clave, sync=sync, data=examen_json,
+                                         formato=formato, **opciones)
+
+    def lanzar_variantes(self, request, formato, variantes, sync=False, **opciones):
+        """Lanza en un único trabajo la compilación de varias variantes del
+        examen (de entre VARIANTES), que se entregan juntas en un archivo zip
+        o tgz. El servicio de compilación prepara la plantilla y las figuras
+        una sola vez para todas. Retorna la Tarea, o None si no hay backend"""
+        desconocidas = set(variantes) - set(VARIANTES)
+        if desconocidas:
+            raise ValueError("Variantes no válidas: {}".format(", ".join(sorted(desconocidas))))
+        if formato not in FORMATOS_VARIANTES:
+            raise ValueError("Varias variantes sólo pueden descargarse en formato {}"
+                             .format(" o ".join(FORMATOS_VARIANTES)))
+        # En orden canónico, para que la misma selección comparta clave
+        variantes = [v for v in VARIANTES if v in variantes]
+        examen_json = self.json_compilacion(request)
+        clave = CacheCompilacion.calcular_clave(examen_json, formato, ",".join(variantes))
+        return self.creador.lanzar_tarea(request, TAREA_VARIANTES, clave=clave, sync=sync,
+                                         data=examen_json, variantes=variantes,
+                                         formato=formato, **opciones)
+
+    def precompilar(self, request):
+        """Si el estado actual del examen está entre los configurados (sección
+        precompilacion), lanza en segundo plano la compilación de los formatos
+        y variantes configurados, para que su descarga posterior los encuentre
+        en la caché. Van a la cola de menor prioridad y no cuentan para el
+        límite de tareas del profesor. Un fallo no impide el cambio de estado.
+        Retorna la lista de Tareas lanzadas"""
+        config = getattr(request.app.settings, "precompilacion", None)
+        if config is None or getattr(request.app, "tareas", None) is None:
+            return []
+        if self.estado not in getattr(config, "estados", ["cerrado", "publicado"]):
+            return []
+        lanzadas = []
+        try:
+            for formato in getattr(config, "formatos", ["pdf"]):
+                for resuelto in getattr(config, "resuelto", ["noresuelto"]):
+                    tarea = self.lanzar_compilacion(request, formato, resuelto,
+                                                    prioridad=tareas.COLA_MANTENIMIENTO,
+                                                    admitir=False)
+                    if tarea is not None:
+                        lanzadas.append(tarea)
+        except (HTTPException, redis.exceptions.RedisError) as e:
+            print("No se pudo precompilar el examen {} ({})".format(self.id, e))
+        return lanzadas
 
     def verificar_y_separar_problemas(self, request):
         """Esta función recibe una petición que tendrá un campo "problemas" con una serie
@@ -371,14 +458,14 @@ class ExamenMixin(UpdatableMixin):
             # no se hará nada con ellos de todas formas
         return a_añadir, no_se_puede, ya_estaban
 
-    def update(self,data):
+    def update(self, data, request=None):
         """Actualiza datos de un examen (no sus problemas o círculos)"""
 
         examen = self
 
         if "estado" in data:
             # Actualizar primero el estado
-            self.update_estado(data["estado"])
+            self.update_estado(data["estado"], request)
 
         if examen.estado != "abierto":
             if examen.estado != data["estado"]:
@@ -398,10 +485,11 @@ class ExamenMixin(UpdatableMixin):
                 else:
                     data_ok[k] = data[k]
         # Actualizar asignatura (creando una si es necesario)
-        if self.update_asignatura(data):
-            # Purgar tabla de asignaturas no usadas
-            asig_huerfanas = model.Asignatura.select(lambda a: not a.examenes)
-            asig_huerfanas.delete()
+        anterior = self.asignatura
+        if self.update_asignatura(data) and anterior.examenes.is_empty():
+            # Borrar la asignatura anterior si ya no se usa. Las que quedan
+            # huérfanas por otras causas las elimina el mantenimiento periódico
+            anterior.delete()
 
         # Actualizar resto de campos del examen
         super().update(data_ok)
@@ -416,28 +504,119 @@ class ExamenMixin(UpdatableMixin):
 
 class ProfesorMixin(UpdatableMixin):
     """Funciones adicionales para el modelo Profesor"""
-    def update(self, data):
+    def update(self, data, request=None):
         """Actualiza los datos del profesor, asegurándose de que la clave va cifrada
-        a la base de datos"""
+        a la base de datos. Si se recibe la petición y cambia la clave o el rol,
+        se revocan todos los token del profesor. Retorna si se revocaron"""
+        revocar = "password" in data or data.get("role", self.role) != self.role
         if "password" in data:
-            data.update(password=bcrypt.hash(data["password"]))
+            data.update(password=claves.cifrar(data["password"]))
         super().update(data)
+        if revocar and request is not None:
+            revocar_tokens(request.app, self.id)
+            return True
+        return False
 
-    def lanzar_tarea(self, request, nombre, *args, **kwargs):
-        if request.app.redis is None:
-            return None
-        try:
-            rq_job = request.app.task_queue.enqueue('tasks.{}'.format(nombre), *args, **kwargs)
-            #print(kwargs)
-        except redis.exceptions.TimeoutError:
-            raise HTTPGatewayTimeout("El backend redis no responde")
+    def lanzar_tarea(self, request, nombre, *args, clave=None, sync=False,
+                     prioridad=None, admitir=True, **kwargs):
+        """Lanza la tarea de compilación dada en el backend de tareas (app.tareas)
+        y crea la Tarea que permite consultar su estado. Si se suministra la clave (hash) del contenido
+        a compilar, se evita lanzar trabajos repetidos: si este profesor ya tenía
+        una tarea pendiente con esa clave se retorna ésta, si el resultado ya
+        está en la caché se retorna una Tarea completada sin lanzar nada, y si
+        otro profesor está compilando lo mismo la Tarea comparte su trabajo.
+
+        Con el backend rq, la cola se elige según el formato y si el cliente espera el resultado
+        (sync), de modo que las descargas interactivas no esperan detrás de las
+        exportaciones en lote, salvo que se especifique la prioridad. El límite
+        de tareas en curso es el de quien hace la petición (el profesor
+        identificado, o la dirección del cliente si es anónima), y no se
+        comprueba si no se pide admitir"""
         if "formato" in kwargs:
             tipo = kwargs["formato"]
         else:
             tipo = "bytes"
-        task = model.Tarea(id=rq_job.get_id(), nombre=nombre, creador=self, tipo=tipo)
+        cache = getattr(request.app, "cache", None)
+        if clave is not None:
+            tarea = model.Tarea.select(lambda t: t.creador == self and t.clave == clave).first()
+            if tarea is not None and tarea.get_fichero(request, buscar_trabajo=False) is None:
+                job = tarea.get_trabajo(request)
+                if not tarea.disponible(job):
+                    # La caché purgó el resultado y el backend ya no tiene el
+                    # trabajo (o falló): se compila de nuevo
+                    tarea.delete()
+                    tarea = None
+                elif job.is_finished:
+                    # El resultado sigue en el backend: se pasa al almacén
+                    tarea.get_fichero(request, job=job)
+                elif prioridad is None:
+                    # Ahora alguien pide el resultado (quizás de una tarea que
+                    # se lanzó en segundo plano): si aún no ha empezado y la
+                    # petición es interactiva, pasa a la cola interactiva
+                    request.app.tareas.promover(job, tipo, sync)
+            if tarea is not None:
+                return tarea
+            if cache is not None:
+                if cache.get(clave, tipo) is not None:
+                    tarea = model.Tarea(id=uuid.uuid4().hex, nombre=nombre, creador=self,
+                                        tipo=tipo, clave=clave)
+                    if tarea.get_fichero(request, buscar_trabajo=False) is not None:
+                        return tarea
+                    tarea.delete()
+                if cache.compartida:
+                    # El worker escribe el resultado directamente en el almacén
+                    # (de forma atómica), en lugar de retornarlo a través del
+                    # backend. Sólo si la configuración indica que puede
+                    # hacerlo, pues requiere que sus tareas acepten el destino
+                    kwargs["destino"] = cache.ruta(clave, tipo)
+        if request.app.tareas is None:
+            return None
+        try:
+            # Si otra petición idéntica ya está compilándose, se comparte su trabajo
+            job_id = request.app.tareas.lanzar(nombre, *args, clave=clave, sync=sync,
+                                               usuario=solicitante(request),
+                                               prioridad=prioridad,
+                                               admitir=admitir, **kwargs)
+        except redis.exceptions.TimeoutError:
+            raise HTTPGatewayTimeout("El backend redis no responde")
+        except redis.exceptions.ConnectionError as e:
+            raise redis_no_disponible(e)
+        except Saturado as e:
+            raise HTTPTooManyRequests(str(e), headers={"Retry-After": str(e.reintentar)})
+        task = model.Tarea(id=uuid.uuid4().hex, nombre=nombre, creador=self, tipo=tipo,
+                           clave=clave, trabajo=job_id)
+        if clave is not None and cache is not None and not cache.compartida:
+            # Si se comparte un trabajo que ya terminó (por ejemplo, una
+            # precompilación), su resultado pasa ya al almacén
+            task.get_fichero(request)
         return task
 
+    def estado_tareas(self, request):
+        """Retorna una lista con las tareas del profesor y el estado de cada
+        una (como TareaMixin.get_status). Los trabajos de las que no tienen
+        aún el resultado en el almacén se leen del backend de una sola vez, y
+        las tareas fallidas o cuyo trabajo ya no existe se borran"""
+        tareas = list(self.tareas)
+        pendientes = [t.trabajo or t.id for t in tareas
+                      if t.get_fichero(request, buscar_trabajo=False) is None]
+        trabajos = {}
+        if pendientes and request.app.tareas is not None:
+            # Quien consulta el estado está esperando a que avance la cola
+            request.app.tareas.despachar()
+            try:
+                trabajos = dict(zip(pendientes, request.app.tareas.trabajos(pendientes)))
+            except redis.exceptions.TimeoutError:
+                raise HTTPGatewayTimeout("El backend redis no responde")
+            except redis.exceptions.ConnectionError as e:
+                raise redis_no_disponible(e)
+        estados = []
+        for tarea in tareas:
+            # Se leen antes de obtener el estado, que puede borrar la tarea
+            datos = {"id": tarea.id, "nombre": tarea.nombre, "tipo": tarea.tipo}
+            datos.update(tarea.get_status(request, trabajos))
+            estados.append((tarea, datos))
+        return estados
+
 
 class CirculoMixin(UpdatableMixin):
     """Funciones adicionales para el manejo de circulos"""
@@ -557,33 +736,135 @@ class AsignaturaMixin(UpdatableMixin):
         return a
 
 
+def redis_no_disponible(excepcion):
+    """Excepción HTTP (503) con la que responder si no se puede conectar con
+    redis. Si es porque el interruptor está abierto, Retry-After indica
+    cuándo volverá a intentarse"""
+    reintentar = math.ceil(getattr(excepcion, "reintentar", 5))
+    return HTTPServiceUnavailable("El backend redis no está disponible",
+                                  headers={"Retry-After": str(reintentar)})
+
+
+def solicitante(request):
+    """Quién hace la petición, a efectos del límite de tareas en curso: el id
+    del profesor identificado o, si es anónima, la dirección del cliente"""
+    return getattr(request.identity, "id", None) or request.client_addr
+
+
 class TareaMixin(object):
-    def get_rq_job(self, request):
-        if request.app.redis is None:
+    def get_trabajo(self, request):
+        """Retorna el trabajo de la tarea en el backend de tareas, o None si no
+        existe (o no hay backend)"""
+        if request.app.tareas is None:
             return None
         try:
-            rq_job = rq.job.Job.fetch(self.id, connection=request.app.redis)
+            # Las tareas antiguas no tienen trabajo, pues su id era el del trabajo rq
+            return request.app.tareas.trabajo(self.trabajo or self.id)
         except redis.exceptions.TimeoutError:
             raise HTTPGatewayTimeout("El backend redis no responde")
-        except (redis.exceptions.RedisError, rq.exceptions.NoSuchJobError):
+        except redis.exceptions.ConnectionError as e:
+            # No se puede saber si el trabajo existe, así que no debe darse por borrado
+            raise redis_no_disponible(e)
+        except redis.exceptions.RedisError:
             return None
-        return rq_job
+
+    def esperar(self, request):
+        """Bloquea hasta que la tarea se complete o falle, o hasta que pasen
+        settings.tareas.espera_maxima segundos. La espera se despierta con las
+        notificaciones del backend sobre el trabajo, sin consultar su estado en bucle"""
+        if self.completada or request.app.tareas is None:
+            return
+        config = getattr(request.app.settings, "tareas", None)
+        timeout = getattr(config, "espera_maxima", 30)
+        try:
+            request.app.tareas.esperar(self.trabajo or self.id, timeout)
+        except redis.exceptions.TimeoutError:
+            raise HTTPGatewayTimeout("El backend redis no responde")
+        except redis.exceptions.ConnectionError as e:
+            raise redis_no_disponible(e)
+
+    def eventos(self, request):
+        """Generador de los cambios de estado de la tarea (véase tareas.seguir),
+        que dura como mucho settings.tareas.duracion_eventos segundos"""
+        config = getattr(request.app.settings, "tareas", None)
+        duracion = getattr(config, "duracion_eventos", 300)
+        return request.app.tareas.eventos(self.trabajo or self.id, duracion)
 
     def get_progress(self, request):
-        if request.app.redis is None:
+        if request.app.tareas is None:
             return "No disponible"
-        job = self.get_rq_job(request)
+        job = self.get_trabajo(request)
         return job.meta.get('progreso', "Esperando") if job is not None else "Completada"
 
-    def get_status(self, request):
-        if request.app.redis is None:
+    def get_fichero(self, request, buscar_trabajo=True, job=None):
+        """Retorna la ruta del fichero con el resultado de la tarea en el almacén
+        de artefactos (la caché de compilaciones), o None si no está disponible.
+
+        Si no está en el almacén pero el trabajo terminó retornando el contenido
+        (servicios de compilación que no escriben en el destino), se guarda allí.
+        El trabajo se consulta al backend, salvo que se suministre.
+        Actualiza los campos fichero, tamaño y completada de la tarea"""
+        cache = getattr(request.app, "cache", None)
+        if cache is None or not self.clave:
+            return None
+        ruta = cache.get(self.clave, self.tipo)
+        if ruta is None and buscar_trabajo and request.app.tareas is not None:
+            if job is None:
+                job = self.get_trabajo(request)
+            if job is not None and job.is_finished:
+                content = job.result
+                if type(content) == tuple:
+                    content = content[-1]
+                if isinstance(content, bytes):
+                    ruta = cache.put(self.clave, self.tipo, content)
+        if ruta is None:
+            return None
+        try:
+            tamaño = os.path.getsize(ruta)
+        except FileNotFoundError:
+            # Purgado entretanto por otro proceso
+            return None
+        if self.fichero != ruta or self.tamaño != tamaño or not self.completada:
+            self.set(fichero=ruta, tamaño=tamaño, completada=True)
+        return ruta
+
+    def disponible(self, job):
+        """Indica si la tarea, cuyo resultado no está en el almacén, aún puede
+        entregarlo a través de su trabajo job (o None si ya no existe): si no
+        ha fallado y, si ya terminó, conserva el contenido"""
+        if job is None or job.is_failed:
+            return False
+        if not job.is_finished:
+            return True
+        content = job.result
+        if type(content) == tuple:
+            content = content[-1]
+        return isinstance(content, bytes)
+
+    def get_status(self, request, trabajos=None):
+        """Retorna el estado de la tarea. Si se suministra, el trabajo se toma
+        del diccionario trabajos (id del trabajo -> trabajo) en lugar de
+        consultarlo al backend. Las tareas fallidas o cuyo trabajo ya no existe
+        se borran"""
+        if self.get_fichero(request, buscar_trabajo=False) is not None:
+            return {
+                "status": "Completada",
+                "bytes": self.tamaño,
+            }
+        if request.app.tareas is None:
             return {
                 "status": "No disponible",
                 "msg": "El servidor no implementa esta funcionalidad"
             }
-        job = self.get_rq_job(request)
+        job_id = self.trabajo or self.id
+        if trabajos is not None and job_id in trabajos:
+            job = trabajos[job_id]
+        else:
+            # Quien consulta el estado está esperando a que avance la cola
+            request.app.tareas.despachar()
+            job = self.get_trabajo(request)
         if job is None:
-            self.creador.tareas.remove(self)
+            self.delete()
             return {
                 "status": "Borrada",
                 "msg": "Debes lanzar de nuevo la conversión"
@@ -595,21 +876,30 @@ class TareaMixin(object):
                 "msg": str(job.exc_info)
             }
         if job.is_finished:
+            if self.get_fichero(request, job=job) is not None:
+                return {
+                    "status": "Completada",
+                    "bytes": self.tamaño,
+                }
             return {
                 "status": "Completada",
             }
         return {
-            "status": self.get_progress(request),
+            "status": job.meta.get('progreso', "Esperando"),
         }
 
     def get_result(self, request):
-        if request.app.redis is None:
-            return None
-        job = self.get_rq_job(request)
+        """Retorna el contenido del resultado tal como lo dejó el trabajo en el
+        backend y borra la tarea. Sólo se usa cuando el resultado no está en el
+        almacén de artefactos (véase get_fichero). Si el trabajo ya no existe
+        retorna None y también borra la tarea"""
+        job = self.get_trabajo(request)
         if job is None:
+            self.delete()
             return None
+        content = job.result
         self.delete()
-        return job.result
+        return content
 
 
 
@@ -618,4 +908,9 @@ from . import permissions
 from . import model
 from . import db_collections as coll
 from . import util
+from .planificador import Saturado
+from .cache import CacheCompilacion
+from . import tareas
+from . import claves
+from .sesiones import revocar_tokens
 from pony.orm.core import ObjectNotFound
@@ -28,7 +28,9 @@ class Examen(db.Entity, mixins.ExamenMixin):
     creador = Required('Profesor')
     publicado = Optional(datetime)
     fecha_creacion = Required(datetime)
-    fecha_modificacion = Required(datetime)
+    fecha_modificacion = Required(datetime, index=True)
+    # Listado de los exámenes de un profesor, del más reciente al más antiguo
+    composite_index(creador, fecha_modificacion)
 
 
 class Asignatura(db.Entity, mixins.AsignaturaMixin):
@@ -53,8 +55,9 @@ class Problema(db.Entity, mixins.ProblemaMixin):
     compartido_con = Set('Circulo')
     examenes = Set('Problema_examen')
     fecha_creacion = Required(datetime)
-    fecha_modificacion = Required(datetime)
+    fecha_modificacion = Required(datetime, index=True)
     simhash = Required(str, default="simhash")
+    composite_index(creador, fecha_modificacion)
 
 
     def compute_simhash(self):
@@ -79,6 +82,8 @@ class Problema_examen(db.Entity):
     problema_id = Required(Problema)
     examen_id = Required(Examen)
     PrimaryKey(problema_id, examen_id)
+    # Problemas de un examen, en orden
+    composite_index(examen_id, posicion)
 
 
 class Cuestion(db.Entity, mixins.UpdatableMixin):
@@ -89,6 +94,7 @@ class Cuestion(db.Entity, mixins.UpdatableMixin):
     puntos = Required(float, default=1)
     problema = Required(Problema)
     posicion = Required(int)
+    composite_index(problema, posicion)
 
 
 class Figura(db.Entity):
@@ -99,7 +105,7 @@ class Figura(db.Entity):
 
 class Tag(db.Entity):
     id = PrimaryKey(int, auto=True)
-    name = Required(str)
+    name = Required(str, index=True)
     problemas = Set(Problema)
 
 
@@ -117,6 +123,9 @@ class Profesor(db.Entity, mixins.ProfesorMixin):
     fecha_creacion = Required(datetime)
     fecha_modificacion = Required(datetime)
     tareas = Set('Tarea')
+    # Versiones de sus token y de sus círculos (véase sesiones)
+    version_token = Required(int, default=0)
+    version_circulos = Required(int, default=0)
 
 
 class Circulo(db.Entity, mixins.CirculoMixin):
@@ -127,6 +136,7 @@ class Circulo(db.Entity, mixins.CirculoMixin):
     problemas_visibles = Set(Problema)
     fecha_creacion = Required(datetime)
     fecha_modificacion = Required(datetime)
+    composite_index(creador, fecha_modificacion)
 
 
 class Metainfo(db.Entity):
@@ -140,4 +150,10 @@ class Tarea(db.Entity, mixins.TareaMixin):
     nombre = Required(str)
     tipo = Required(str)
     creador = Required(Profesor, reverse='tareas')
-    completada = Required(bool, default=False)
\ No newline at end of file
+    completada = Required(bool, default=False)
+    clave = Optional(str)   # Hash del contenido a compilar, para la caché
+    trabajo = Optional(str) # Id del trabajo rq, que varias tareas pueden compartir
+    fichero = Optional(str) # Ruta del resultado en el almacén de artefactos (la caché)
+    tamaño = Optional(int)  # Y su tamaño en bytes
+    # Tarea del profesor que ya compiló (o está compilando) un contenido
+    composite_index(creador, clave)
\ No newline at end of file
@@ -0,0 +1,211 @@
+"""Perfil por muestreo, siempre activo, agregado por vista.
+
+Si la configuración tiene sección muestreo, cada proceso mantiene un hilo
+que cada intervalo segundos mira qué están ejecutando los hilos que atienden
+peticiones (sys._current_frames) y anota la pila de cada uno, desde el tween
+muestrear_peticiones hasta la función en curso, encabezada por el modelo y
+la vista de la petición. Lo que se mide es el tiempo de reloj de las
+peticiones: una que espera a que se verifique una clave en el pool de
+claves aparece esperando en claves.verificar.
+
+Las pilas se cuentan por ventanas de tiempo (de una hora por defecto) y se
+conservan las últimas (una semana). Cada proceso vuelca sus cuentas a redis
+cada volcado segundos, para que /muestras (sólo admins) muestre las de
+todos; sin redis, cada proceso muestra las suyas. El formato es el de "pilas
+colapsadas": una línea por pila, con sus funciones separadas por ";" y el
+número de muestras, que admiten flamegraph.pl, speedscope, etc.
+
+El hilo se arranca con la primera petición que atiende cada proceso, pues
+los hilos no sobreviven al fork con que uwsgi crea los workers.
+"""
+
+from collections import Counter
+import math
+import os
+import sys
+import threading
+import time
+
+import redis
+
+from .app import App
+from .metricas import nombres_vistas
+from .perfiles import perfilar_peticion
+
+PREFIJO_MUESTRAS = "wexam:muestras:"
+# Pila de las muestras que no caben en una ventana que ya tiene max_pilas
+OTRAS = "(otras)"
+
+
+class Muestreador(object):
+    """Hilo de muestreo de un proceso, y las cuentas de sus pilas"""
+
+    def __init__(self, intervalo=0.02, ventana=3600, ventanas=168, volcado=30,
+                 max_pilas=5000, profundidad=100):
+        self.intervalo = intervalo
+        self.ventana = ventana
+        self.ventanas = ventanas
+        self.volcado = volcado
+        self.max_pilas = max_pilas
+        self.profundidad = profundidad
+        self.activas = {}       # id del hilo -> petición que atiende
+        self.vistas = {}        # véase metricas.nombres_vistas
+        self.tope = None        # código del tween, donde terminan las pilas
+        self.conexion = None
+        self.pendientes = {}    # número de ventana -> Counter de pilas no volcadas
+        self.locales = {}       # lo mismo, ya volcadas, si no hay redis
+        self.nombres = {}       # código -> nombre de la función en las pilas
+        self.cerrojo = threading.Lock()
+        self.pid = None
+
+    def configurar(self, config):
+        for clave in ("intervalo", "ventana", "ventanas", "volcado", "max_pilas",
+                      "profundidad"):
+            setattr(self, clave, getattr(config, clave, getattr(self, clave)))
+
+    def arrancar(self):
+        """Arranca el hilo de muestreo en este proceso, si no lo estaba ya"""
+        with self.cerrojo:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            # Las cuentas heredadas del proceso padre ya las vuelca él
+            self.pendientes = {}
+        threading.Thread(target=self.ejecutar, name="muestreador", daemon=True).start()
+
+    def ejecutar(self):
+        pid = os.getpid()
+        siguiente_volcado = time.monotonic() + self.volcado
+        while self.pid == pid:
+            time.sleep(self.intervalo)
+            self.muestrear()
+            if time.monotonic() >= siguiente_volcado:
+                self.volcar()
+                siguiente_volcado = time.monotonic() + self.volcado
+
+    def nombre(self, codigo):
+        nombre = self.nombres.get(codigo)
+        if nombre is None:
+            modulo = os.path.splitext(os.path.basename(codigo.co_filename))[0]
+            if modulo.startswith("<"):
+                # Código generado (como el de los dispatch de morepath), cuyo
+                # "fichero" es su propio texto
+                modulo = modulo.split(":")[0].split("\n")[0].rstrip(">") + ">"
+            nombre = "{}:{}".format(modulo, getattr(codigo, "co_qualname", codigo.co_name))
+            self.nombres[codigo] = nombre
+        return nombre
+
+    def pila(self, marco, request):
+        """Pila colapsada del marco dado, desde el tween hasta él"""
+        funciones = []
+        while marco is not None and marco.f_code is not self.tope:
+            funciones.append(self.nombre(marco.f_code))
+            marco = marco.f_back
+        funciones.reverse()
+        info = getattr(request, "view_code_info", None)
+        modelo, vista = self.vistas.get((info.path, info.lineno) if info else None,
+                                        ("", "(sin vista)"))
+        return ";".join(["{}.{}".format(modelo, vista) if modelo else vista] +
+                        funciones[:self.profundidad])
+
+    def muestrear(self):
+        """Anota la pila de cada hilo que está atendiendo una petición"""
+        if not self.activas:
+            return
+        marcos = sys._current_frames()     # pylint: disable=protected-access
+        pilas = [self.pila(marcos[hilo], request)
+                 for hilo, request in list(self.activas.items()) if hilo in marcos]
+        numero = int(time.time() // self.ventana)
+        with self.cerrojo:
+            cuentas = self.pendientes.setdefault(numero, Counter())
+            for pila in pilas:
+                if pila not in cuentas and len(cuentas) >= self.max_pilas:
+                    pila = OTRAS
+                cuentas[pila] += 1
+
+    def retener(self, ventanas):
+        """Descarta las ventanas que ya no se conservan"""
+        primera = int(time.time() // self.ventana) - self.ventanas + 1
+        for numero in [n for n in ventanas if n < primera]:
+            del ventanas[numero]
+
+    def volcar(self):
+        """Pasa las cuentas pendientes a redis (o a locales si no hay redis).
+        Si redis falla se conservan para el siguiente volcado"""
+        with self.cerrojo:
+            pendientes, self.pendientes = self.pendientes, {}
+        if not pendientes:
+            return
+        destino = self.locales
+        if self.conexion is not None:
+            try:
+                pipe = self.conexion.pipeline()
+                for numero, cuentas in pendientes.items():
+                    clave = PREFIJO_MUESTRAS + str(numero)
+                    for pila, veces in cuentas.items():
+                        pipe.hincrby(clave, pila, veces)
+                    pipe.expire(clave, self.ventana * self.ventanas)
+                pipe.execute()
+                return
+            except redis.exceptions.RedisError:
+                destino = self.pendientes
+        with self.cerrojo:
+            for numero, cuentas in pendientes.items():
+                destino.setdefault(numero, Counter()).update(cuentas)
+            self.retener(destino)
+
+    def leer(self, horas=None):
+        """Cuentas de las pilas de las últimas horas (o de todas las ventanas
+        que se conservan), tras volcar las de este proceso"""
+        self.volcar()
+        actual = int(time.time() // self.ventana)
+        numero = self.ventanas
+        if horas:
+            numero = min(numero, math.ceil(horas * 3600 / self.ventana))
+        ventanas = range(actual - numero + 1, actual + 1)
+        total = Counter()
+        if self.conexion is None:
+            with self.cerrojo:
+                for ventana in ventanas:
+                    total.update(self.locales.get(ventana, {}))
+            return total
+        pipe = self.conexion.pipeline()
+        for ventana in ventanas:
+            pipe.hgetall(PREFIJO_MUESTRAS + str(ventana))
+        for cuentas in pipe.execute():
+            for pila, veces in cuentas.items():
+                total[pila.decode()] += int(veces)
+        return total
+
+
+def colapsadas(cuentas):
+    """Texto con las pilas colapsadas, de más a menos muestras"""
+    return "".join("{} {}\n".format(pila, veces) for pila, veces in cuentas.most_common())
+
+
+muestreador = Muestreador()
+
+
+@App.tween_factory(over=perfilar_peticion)
+def muestrear_peticiones(app, handler):
+    """Anota qué petición atiende cada hilo, para el hilo de muestreo. Sin
+    sección muestreo en la configuración no hace nada"""
+    config = getattr(app.settings, "muestreo", None)
+    if config is None:
+        return handler
+    muestreador.configurar(config)
+    muestreador.vistas = nombres_vistas(type(app))
+    muestreador.conexion = getattr(app, "redis", None)
+    activas = muestreador.activas
+
+    def muestrear(request):
+        if muestreador.pid != os.getpid():
+            muestreador.arrancar()
+        hilo = threading.get_ident()
+        activas[hilo] = request
+        try:
+            return handler(request)
+        finally:
+            del activas[hilo]
+    muestreador.tope = muestrear.__code__
+    return muestrear
@@ -25,6 +25,24 @@ def reset_database():
     genera pseudo-aleatoriamente para testing"""
     return appmodel.ResetDB()
 
+# Ruta para consultar el estado de las colas de compilación
+@App.path(model=appmodel.Colas, path="/colas")
+def get_colas():
+    """/colas: Ruta para consultar la ocupación de las colas de compilación"""
+    return appmodel.Colas()
+
+# Ruta para las métricas del servidor
+@App.path(model=appmodel.Metricas, path="/metrics")
+def get_metricas(request):
+    """/metrics: Ruta con las métricas del servidor, en el formato de Prometheus"""
+    return appmodel.Metricas(request.headers.get("Authorization"))
+
+# Ruta para el perfil por muestreo
+@App.path(model=appmodel.Muestras, path="/muestras")
+def get_muestras(horas=0):
+    """/muestras: Ruta con las pilas muestreadas en las últimas horas"""
+    return appmodel.Muestras(horas)
+
 # Ruta para reiniciar contraseña
 @App.path(model=appmodel.ResetPassword, path='/reset_password/{email}')
 def get_reset_password(email):
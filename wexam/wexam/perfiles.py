@@ -0,0 +1,93 @@
+"""Perfil (cProfile) de una petición concreta, a petición de un admin.
+
+Si la configuración tiene sección perfiles, un admin puede añadir a
+cualquier petición el parámetro perfil (?perfil=pstats) o la cabecera
+X-Perfil. La petición se atiende normalmente, pero bajo cProfile, y en
+lugar de su respuesta se retorna el perfil, para descargarlo:
+
+- pstats (o cualquier otro valor): el fichero binario de pstats, que puede
+  examinarse con python -m pstats, snakeviz, etc.
+- texto: el resumen de pstats, ordenado por tiempo acumulado.
+
+El código de estado de la respuesta original va en la cabecera
+X-Estado-Original. Si quien lo pide no es admin, el parámetro se ignora.
+Sin él, el tween sólo mira si está presente.
+"""
+
+import cProfile
+import io
+import marshal
+import pstats
+import threading
+
+from morepath import Response
+
+from .app import App
+from .permissions import es_admin
+from .tiempos import medir_peticion
+
+PARAMETRO = "perfil"
+CABECERA = "X-Perfil"
+TEXTO = "texto"
+
+# Sólo se perfila una petición a la vez en cada proceso (desde Python 3.12
+# no puede haber dos cProfile activos a la vez)
+perfilando = threading.Lock()
+
+
+def formato_pedido(request):
+    """Formato del perfil que pide la petición, o None si no lo pide"""
+    formato = request.headers.get(CABECERA)
+    if formato is None:
+        formato = request.GET.get(PARAMETRO)
+    return formato
+
+
+def respuesta_perfil(perfil, formato, lineas):
+    """Respuesta con el perfil en el formato pedido"""
+    if formato == TEXTO:
+        salida = io.StringIO()
+        pstats.Stats(perfil, stream=salida).sort_stats("cumulative").print_stats(lineas)
+        return Response(salida.getvalue(), content_type="text/plain", charset="utf-8")
+    perfil.create_stats()
+    response = Response(marshal.dumps(perfil.stats), content_type="application/octet-stream")
+    response.headers["Content-Disposition"] = 'attachment; filename="perfil.pstats"'
+    return response
+
+
+@App.tween_factory(over=medir_peticion)
+def perfilar_peticion(app, handler):
+    """Perfila las peticiones de los admin que lo piden. Sin sección perfiles
+    en la configuración no hace nada"""
+    config = getattr(app.settings, "perfiles", None)
+    if config is None:
+        return handler
+    lineas = getattr(config, "lineas", 60)
+
+    def perfilar(request):
+        formato = formato_pedido(request)
+        if formato is None or not es_admin(request.identity):
+            return handler(request)
+        if not perfilando.acquire(blocking=False):
+            response = Response(json_body={"debug": "Ya se está perfilando otra petición"},
+                                status=429)
+            response.headers["Retry-After"] = "1"
+            return response
+        try:
+            perfil = cProfile.Profile()
+            perfil.enable()
+            try:
+                original = handler(request)
+            finally:
+                perfil.disable()
+            response = respuesta_perfil(perfil, formato, lineas)
+        finally:
+            perfilando.release()
+        # Las respuestas que se envían en streaming (descargas) tienen un
+        # fichero abierto, que no se va a leer
+        cerrar = getattr(original.app_iter, "close", None)
+        if cerrar is not None:
+            cerrar()
+        response.headers["X-Estado-Original"] = str(original.status_code)
+        return response
+    return perfilar
@@ -1,8 +1,9 @@
-from more.jwtauth import JWTIdentityPolicy
-
 from .app import App
 from . import model
 from . import db_collections as coll
+from . import appmodel
+from .metricas import token_valido
+from .sesiones import PoliticaJWT, CLAIM_CIRCULOS
 
 # pylint: disable=too-few-public-methods
 
@@ -24,6 +25,11 @@ class PoderVer:
 class SerAdmin:
     """Esta condición sólo la cumplen los usuarios admin"""
     pass
+
+class LeerMetricas:
+    """Esta condición la cumplen los admin y el recolector de métricas, que
+    se identifica con el token de la configuración en lugar de con un JWT"""
+    pass
 # pylint: enable=too-few-public-methods
 
 
@@ -32,63 +38,97 @@ class SerAdmin:
 # pylint: disable=unused-argument
 @App.identity_policy()
 def get_identity_policy(settings):
-    """Crea la política de identidad (usando jwt)"""
+    """Crea la política de identidad (usando jwt, con una caché de los token
+    ya verificados). Queda también en App.politica_identidad, pues la vista
+    /login/refresh la usa directamente"""
     jwtauth_settings = settings.jwtauth.__dict__.copy()
-    return JWTIdentityPolicy(**jwtauth_settings)
+    config = getattr(settings, "sesiones", None)
+    App.politica_identidad = PoliticaJWT(
+        max_tokens=getattr(config, "max_tokens", 1024),
+        ventana_renovacion=getattr(config, "ventana_renovacion", 86400),
+        **jwtauth_settings)
+    return App.politica_identidad
+
+# El id y el rol del usuario se toman del token, sin consultar la base de
+# datos. Son fiables porque el token está firmado por nosotros y se revoca al
+# cambiar el rol o borrar al profesor: cada petición compara su versión con
+# la actual, que se lee de redis sin consultar la base de datos (véase
+# sesiones), así que un admin al que se le quita el rol deja de serlo en su
+# siguiente petición, en cualquier proceso. Si redis falla, la versión se lee
+# de la base de datos. Los círculos del token se descartan del mismo modo
+
+def es_admin(identity):
+    """Indica si el rol que consta en el token es admin"""
+    return getattr(identity, "role", None) == "admin"
+
+def circulos_de(identity):
+    """Ids de los círculos a que pertenece el usuario. Se toman del token,
+    salvo si no constan en él o han cambiado desde que se emitió, en cuyo
+    caso se consultan a la base de datos"""
+    circulos = getattr(identity, CLAIM_CIRCULOS, None)
+    if circulos is not None:
+        return set(circulos)
+    quien = model.Profesor.get(id=identity.id)
+    if quien is None:
+        return set()
+    return {c.id for c in quien.circulos_en_que_esta}
 
 @App.permission_rule(model=object, permission=EstarRegistrado)
 def verificar_registrado(identity, que, permission):
     """Comprueba si el usuario puede ver el recurso, generico"""
-    quien = model.Profesor.get(id=identity.id)
-    # Si está en la base de datos, le permitimos ver el recurso
-    if quien is not None:
-        return True
+    # Si el profesor se borró su token ya no es válido
+    return getattr(identity, "id", None) is not None
 
 @App.permission_rule(model=object, permission=SerAdmin)
 def verificar_admin(identity, que, permission):
     """Comprueba si el usuario es admin"""
-    quien = model.Profesor.get(id=identity.id)
-    # Si está en la base de datos, comprobamos su rol
-    return quien and quien.role == "admin"
+    return es_admin(identity)
+
+@App.permission_rule(model=appmodel.Metricas, permission=LeerMetricas)
+def verificar_metricas(app, identity, que, permission):
+    """Comprueba si el usuario es admin o trae el token del recolector"""
+    return es_admin(identity) or verificar_recolector(app, None, que, permission)
+
+@App.permission_rule(model=appmodel.Metricas, permission=LeerMetricas, identity=None)
+def verificar_recolector(app, identity, que, permission):
+    """Sin JWT, comprueba si la petición trae el token del recolector"""
+    return token_valido(getattr(app.settings, "metricas", None), que.autorizacion)
 
 @App.permission_rule(model=model.Profesor, permission=SerPropietario)
 def verificar_propietario_usuario(identity, que, permission):
     """Comprueba si el usuario a que quiere acceder es él mismo."""
 
-    quien = model.Profesor.get(id=identity.id)
-    if quien and quien.role == "admin":
+    if es_admin(identity):
         return True
-    return quien == que
+    return que.id == identity.id
 
 @App.permission_rule(model=object, permission=SerPropietario)
 def verificar_propietario(identity, que, permission):
     """Comprueba si el usuario es propietario del objeto"""
 
-    quien = model.Profesor.get(id=identity.id)
-    if quien and quien.role == "admin":
+    if es_admin(identity):
         return True
     if not hasattr(que, "creador"):
         return False
-    return que.creador == quien
+    # que.creador.id no necesita cargar el profesor, pony ya conoce su id
+    return que.creador.id == identity.id
 
 @App.permission_rule(model=coll.SubCollection, permission=SerPropietario)
 def verificar_propietario_circulo(identity, que, permission):
     """Comprueba si el contenedor fue creada por el usuario."""
 
-    quien = model.Profesor.get(id=identity.id)
-    if quien and quien.role == "admin":
+    if es_admin(identity):
         return True
-    return quien == que.contenedor.creador
+    return que.contenedor.creador.id == identity.id
 
 
 @App.permission_rule(model=model.Cuestion, permission=SerPropietario)
 def verificar_propietario_cuestion(identity, que, permission):
     """Comprueba si la cuestión fue creada por el usuario."""
 
-    quien = model.Profesor.get(id=identity.id)
-    if quien and quien.role == "admin":
+    if es_admin(identity):
         return True
-    return quien == que.problema.creador
+    return que.problema.creador.id == identity.id
 
 @App.permission_rule(model=model.Problema, permission=PoderVer)
 def verificar_compartido_problema(identity, que, permission):
@@ -97,8 +137,8 @@ def verificar_compartido_problema(identity, que, permission):
         return True
     if not hasattr(que, "compartido_con"):
         return False
-    quien = model.Profesor.get(id=identity.id)
-    return quien in que.compartido_con.miembros
+    circulos = circulos_de(identity)
+    return any(c.id in circulos for c in que.compartido_con)
 
 @App.permission_rule(model=model.Cuestion, permission=PoderVer)
 def verificar_compartido_cuestion(identity, que, permission):
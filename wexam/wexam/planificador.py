@@ -0,0 +1,191 @@
+"""Control de admisión y reparto equitativo de los trabajos de compilación.
+
+Sin él, un único profesor (o un script) puede llenar la cola rq con cientos
+de trabajos, y las descargas de los demás esperarían detrás de todos ellos.
+Para evitarlo:
+
+* Cada profesor puede tener como mucho un número de trabajos en curso
+  (pendientes o ejecutándose). Las peticiones que lo superan se rechazan
+  (véase Saturado), indicando cuándo reintentar. Cuentan para quien pide la
+  compilación, no para el autor del examen, y sólo los trabajos nuevos: la
+  petición que comparte un trabajo ya lanzado no se rechaza.
+* Los trabajos no van directamente a la cola rq, sino a una lista por
+  profesor. Cuando la cola rq tiene hueco, se pasa a ella el siguiente
+  trabajo de cada profesor por turnos (round-robin), de modo que quien lanza
+  un único trabajo espera como mucho a que se atienda uno de cada uno de los
+  demás, y no a todos los que tengan encolados.
+
+Todo el estado está en redis, por lo que es compartido por todos los procesos.
+Mientras espera su turno, el trabajo rq existe con estado "deferred", y se
+puede consultar, esperar o compartir como cualquier otro. También puede
+retirarse del planificador para encolarlo directamente en otra cola (véase
+tareas.promover).
+
+El reparto (despachar) se realiza al admitir un trabajo y cada vez que alguien
+consulta o espera el estado de una tarea, que es justo cuando alguien está
+interesado en que avancen. Los trabajos que nadie consulta (como las
+precompilaciones) avanzarían sólo con los de otros, así que el comando
+wexam-mantenimiento lo invoca además periódicamente (véase mantenimiento), y
+debe estar en marcha si se usa el planificador.
+"""
+
+import redis
+import rq
+from rq.job import Job, JobStatus
+
+PREFIJO = "wexam:planificador:"
+# Estados en los que un trabajo ya no cuenta como "en curso"
+ESTADOS_TERMINADOS = ("finished", "failed", "stopped", "canceled")
+
+
+class Saturado(Exception):
+    """El profesor ya tiene en curso tantos trabajos como se le permiten.
+    reintentar es el número de segundos tras los que se sugiere reintentarlo"""
+    def __init__(self, en_curso, reintentar):
+        super().__init__("Ya tienes {} tareas en curso. Espera a que terminen"
+                         .format(en_curso))
+        self.en_curso = en_curso
+        self.reintentar = reintentar
+
+
+class Planificador(object):
+    """Reparto por turnos de los trabajos de una cola rq entre los profesores.
+
+    max_en_curso es el número de trabajos que cada profesor puede tener en
+    curso, y capacidad el número de trabajos pendientes que se dejan en la
+    cola rq (el resto esperan su turno en el planificador). Conviene que sea
+    similar al número de workers que la atienden"""
+
+    def __init__(self, cola, max_en_curso=4, capacidad=2, reintentar=10):
+        self.cola = cola
+        self.conexion = cola.connection
+        self.max_en_curso = max_en_curso
+        self.capacidad = capacidad
+        self.reintentar = reintentar
+        self.prefijo = PREFIJO + cola.name + ":"
+        self.turno = self.prefijo + "turno"
+
+    def clave_pendientes(self, usuario):
+        """Lista de trabajos de ese usuario que esperan su turno"""
+        return "{}pendientes:{}".format(self.prefijo, usuario)
+
+    def clave_en_curso(self, usuario):
+        """Conjunto de trabajos de ese usuario aún no terminados"""
+        return "{}encurso:{}".format(PREFIJO, usuario)
+
+    def en_curso(self, usuario):
+        """Retorna cuántos trabajos tiene el usuario sin terminar, olvidando
+        los que ya terminaron o expiraron"""
+        clave = self.clave_en_curso(usuario)
+        ids = [i.decode("ascii") for i in self.conexion.smembers(clave)]
+        if not ids:
+            return 0
+        with self.conexion.pipeline(transaction=False) as pipe:
+            for job_id in ids:
+                pipe.hget(Job.redis_job_namespace_prefix + job_id, "status")
+            estados = pipe.execute()
+        terminados = [job_id for job_id, estado in zip(ids, estados)
+                      if estado is None or estado.decode("ascii") in ESTADOS_TERMINADOS]
+        if terminados:
+            self.conexion.srem(clave, *terminados)
+        return len(ids) - len(terminados)
+
+    def admitir(self, usuario):
+        """Comprueba que el usuario puede lanzar otro trabajo, o eleva Saturado.
+        Es aproximado: peticiones simultáneas del mismo usuario podrían
+        superar el límite en alguna unidad"""
+        en_curso = self.en_curso(usuario)
+        if en_curso >= self.max_en_curso:
+            raise Saturado(en_curso, self.reintentar)
+
+    def encolar(self, usuario, funcion, *args, job_id=None, contar=True, **kwargs):
+        """Crea el trabajo rq en espera (deferred), lo pone en la lista del
+        usuario y despacha los que quepan en la cola rq. Retorna el id del
+        trabajo. No comprueba el límite del usuario (véase admitir). Si no se
+        pide contar, el trabajo espera su turno como los demás del usuario pero
+        no cuenta entre los que tiene en curso (como las precompilaciones, que
+        el usuario no ha pedido)"""
+        job = Job.create(funcion, args=args, kwargs=kwargs, connection=self.conexion,
+                         id=job_id, origin=self.cola.name, status=JobStatus.DEFERRED,
+                         meta={"usuario": usuario})
+        job.save()
+        if contar:
+            self.conexion.sadd(self.clave_en_curso(usuario), job.id)
+        pendientes = self.clave_pendientes(usuario)
+
+        def apuntar(pipe):
+            vacia = pipe.llen(pendientes) == 0
+            pipe.multi()
+            pipe.rpush(pendientes, job.id)
+            if vacia:
+                # El usuario no tenía turno, pues sólo lo tienen los que esperan
+                pipe.rpush(self.turno, usuario)
+        self.conexion.transaction(apuntar, pendientes)
+        self.despachar()
+        return job.id
+
+    def retirar(self, job):
+        """Saca del planificador un trabajo que espera su turno, para pasarlo
+        a otra cola. Retorna si lo ha sacado (si no, ya se había despachado).
+        Si la lista del usuario queda vacía, su turno se descarta al llegar
+        (véase siguiente)"""
+        usuario = job.meta.get("usuario")
+        if usuario is None:
+            return False
+        return self.conexion.lrem(self.clave_pendientes(usuario), 1, job.id) > 0
+
+    def siguiente(self):
+        """Saca del planificador el siguiente trabajo por turnos, y retorna
+        su id o None si no hay ninguno esperando"""
+        while True:
+            with self.conexion.pipeline() as pipe:
+                try:
+                    pipe.watch(self.turno)
+                    usuario = pipe.lindex(self.turno, 0)
+                    if usuario is None:
+                        return None
+                    pendientes = self.clave_pendientes(usuario.decode("utf-8"))
+                    pipe.watch(pendientes)
+                    job_id = pipe.lindex(pendientes, 0)
+                    quedan = pipe.llen(pendientes)
+                    pipe.multi()
+                    pipe.lpop(self.turno)
+                    pipe.lpop(pendientes)
+                    if quedan > 1:
+                        # Si le quedan más trabajos, vuelve al final de la fila
+                        pipe.rpush(self.turno, usuario)
+                    pipe.execute()
+                except redis.exceptions.WatchError:
+                    # Otro proceso despachó a la vez. Se reintenta
+                    continue
+            if job_id is not None:
+                return job_id.decode("ascii")
+
+    def despachar(self):
+        """Pasa a la cola rq los trabajos que quepan en ella, por turnos.
+        Retorna cuántos ha pasado"""
+        despachados = 0
+        while len(self.cola) < self.capacidad:
+            job_id = self.siguiente()
+            if job_id is None:
+                break
+            try:
+                job = Job.fetch(job_id, connection=self.conexion)
+            except rq.exceptions.NoSuchJobError:
+                continue
+            job.set_status(JobStatus.QUEUED)
+            self.cola.enqueue_job(job)
+            despachados += 1
+        return despachados
+
+
+def crear_planificadores(colas, config):
+    """Retorna un Planificador para cada cola del diccionario dado, con los
+    parámetros de la configuración (sección planificador)"""
+    return {
+        prioridad: Planificador(cola,
+                                max_en_curso=getattr(config, "max_en_curso", 4),
+                                capacidad=getattr(config, "capacidad", 2),
+                                reintentar=getattr(config, "reintentar", 10))
+        for prioridad, cola in colas.items()
+    }
@@ -0,0 +1,178 @@
+"""Lecturas desde una réplica de la base de datos.
+
+Casi todas las peticiones son GET, que sólo leen. Si la configuración tiene
+sección replica (con postgres), las peticiones GET y HEAD se atienden con
+conexiones a la réplica, y las demás con la base de datos primaria.
+
+Todas las entidades de pony están ligadas a una única base de datos, así que
+el reparto se hace en el pool de conexiones: PoolEnrutado (que se le pasa a
+pony en lugar del suyo) toma las conexiones del pool de la réplica en los
+hilos que están dentro de leyendo_de_replica(), y del de la primaria en los
+demás. El tween enrutar_lecturas, que envuelve la db_session que more.pony
+abre en cada petición, es el que decide cuáles van a la réplica.
+
+Algunas peticiones GET escriben casi siempre: la descarga de un examen crea
+su Tarea, y la consulta de una tarea la marca como completada o la borra.
+Éstas (ESCRITURAS_GET) van directamente a la primaria, pues en la réplica
+fallarían y se ejecutarían dos veces, la primera quizás ocupando durante
+segundos un hilo a la espera de la compilación. Para las demás, las
+conexiones a la réplica se abren en modo sólo lectura, de modo que si una
+petición GET intenta escribir la base de datos la rechaza, y la petición se
+repite entera en la primaria.
+
+Como la réplica va algo retrasada, tras escribir un usuario sus peticiones
+se atienden en la primaria durante ventana_escritura segundos, para que vea
+lo que acaba de escribir. Esas marcas se guardan en redis, para que las
+respeten todos los procesos, o en el propio proceso si no hay redis.
+"""
+
+from contextlib import contextmanager
+import re
+import threading
+import time
+
+from more.pony.app import pony_tween_factory
+import redis
+
+from .app import App
+
+PREFIJO_ESCRITURA = "wexam:escritura:"
+# Código de error de postgres al escribir en una transacción de sólo lectura
+SOLO_LECTURA = "25006"
+METODOS_LECTURA = ("GET", "HEAD")
+# Rutas de peticiones GET que escriben en la base de datos
+ESCRITURAS_GET = re.compile(r"^/(examen/[^/]+/download|task/[^/]+(/download|/events)?)/?$")
+
+# Instante hasta el que cada profesor lee de la primaria (si no hay redis)
+escrituras_locales = {}
+
+
+class PoolEnrutado(object):
+    """Pool para pony que reparte las conexiones entre el de la primaria y
+    el de la réplica, según el hilo esté o no leyendo de la réplica"""
+
+    def __init__(self, primaria, replica):
+        self.primaria = primaria
+        self.replica = replica
+        self.local = threading.local()
+        self.origen = {}    # id de la conexión -> pool del que salió
+        self.cerrojo = threading.Lock()
+
+    @contextmanager
+    def leyendo_de_replica(self):
+        """Las sesiones que se abran dentro usarán la réplica"""
+        anterior = getattr(self.local, "replica", False)
+        self.local.replica = True
+        try:
+            yield
+        finally:
+            self.local.replica = anterior
+
+    def connect(self):
+        pool = self.replica if getattr(self.local, "replica", False) else self.primaria
+        con, nueva = pool.connect()
+        with self.cerrojo:
+            self.origen[id(con)] = pool
+        return con, nueva
+
+    def pool_de(self, con):
+        with self.cerrojo:
+            return self.origen.pop(id(con), self.primaria)
+
+    def release(self, con):
+        self.pool_de(con).release(con)
+
+    def drop(self, con):
+        self.pool_de(con).drop(con)
+
+    def disconnect(self):
+        self.primaria.disconnect()
+        self.replica.disconnect()
+
+
+def es_escritura_rechazada(exc):
+    """Indica si la excepción (o alguna de las que envuelve, como hace pony)
+    se debe a haber intentado escribir en la réplica"""
+    pendientes = [exc]
+    vistas = set()
+    while pendientes:
+        e = pendientes.pop()
+        if e is None or id(e) in vistas:
+            continue
+        vistas.add(id(e))
+        if getattr(e, "pgcode", None) == SOLO_LECTURA:
+            return True
+        pendientes.extend([getattr(e, "original_exc", None), e.__cause__, e.__context__])
+        # CommitException y similares guardan los exc_info de las originales
+        pendientes.extend(info[1] for info in getattr(e, "exceptions", None) or [])
+    return False
+
+
+def es_lectura(request):
+    """Indica si la petición puede atenderse en la réplica"""
+    return (request.method in METODOS_LECTURA
+            and not ESCRITURAS_GET.match(request.path_info))
+
+
+def id_usuario(request):
+    """Id del profesor que hace la petición, o None si no se ha identificado"""
+    return getattr(request.identity, "id", None)
+
+
+def marcar_escritura(app, id_profesor, ventana):
+    """Anota que el profesor acaba de escribir, para que durante ventana
+    segundos lea de la primaria"""
+    escrituras_locales[id_profesor] = time.monotonic() + ventana
+    conexion = getattr(app, "redis", None)
+    if conexion is None:
+        return
+    try:
+        conexion.set(PREFIJO_ESCRITURA + str(id_profesor), 1, ex=max(1, int(ventana)))
+    except redis.exceptions.RedisError:
+        pass
+
+
+def escritura_reciente(app, id_profesor):
+    """Indica si el profesor escribió hace menos de la ventana. Si redis no
+    responde se usa lo que sabe este proceso"""
+    conexion = getattr(app, "redis", None)
+    if conexion is not None:
+        try:
+            return bool(conexion.exists(PREFIJO_ESCRITURA + str(id_profesor)))
+        except redis.exceptions.RedisError:
+            pass
+    return escrituras_locales.get(id_profesor, 0) > time.monotonic()
+
+
+@App.tween_factory(over=pony_tween_factory)
+def enrutar_lecturas(app, handler):
+    """Atiende en la réplica las peticiones de lectura, salvo las de quien
+    acaba de escribir. Sin réplica no hace nada"""
+    enrutador = getattr(app, "enrutador", None)
+    if enrutador is None:
+        return handler
+    config = getattr(app.settings, "replica", None)
+    ventana = getattr(config, "ventana_escritura", 5)
+
+    def enrutar(request):
+        id_profesor = id_usuario(request)
+        if not es_lectura(request):
+            try:
+                return handler(request)
+            finally:
+                if id_profesor is not None:
+                    marcar_escritura(app, id_profesor, ventana)
+        if id_profesor is None or not escritura_reciente(app, id_profesor):
+            try:
+                with enrutador.leyendo_de_replica():
+                    return handler(request)
+            except Exception as e:      # pylint: disable=broad-except
+                if not es_escritura_rechazada(e):
+                    raise
+            # La petición necesita escribir (sin figurar en ESCRITURAS_GET).
+            # Se repite en la primaria
+            request.reset()
+            if id_profesor is not None:
+                marcar_escritura(app, id_profesor, ventana)
+        return handler(request)
+    return enrutar
@@ -0,0 +1,283 @@
+"""Identificación de los usuarios a partir de su token JWT.
+
+Verificar la firma de un token y decodificar su JSON en cada petición tiene
+un coste apreciable, y un cliente envía el mismo token en todas las suyas.
+Por ello PoliticaJWT guarda las identidades ya verificadas en una caché LRU
+(CacheIdentidades) indexada por el token, en la que cada entrada caduca
+cuando lo hace el token.
+
+Para que un token pueda revocarse al instante pese a la caché, cada profesor
+tiene una versión de token, que se incluye en los token al emitirlos (claim
+"ver") y se compara con la actual en cada petición. Al incrementarla (al
+cambiar la clave o el rol, o al borrar al profesor) todos sus tokens dejan de
+ser válidos.
+
+Las versiones son columnas del profesor en la base de datos, que se
+incrementan en la misma transacción que el cambio que las motiva, y redis
+guarda una copia para que cada petición no tenga que consultarlas:
+
+* Al incrementarlas se suben también en redis, antes de confirmar la
+  transacción. Si redis falla, la transacción se deshace y se responde 503:
+  el cambio no se hace si no puede revocar los token.
+* En redis sólo pueden subir (véase subir_versiones), de modo que una copia
+  leída de la base de datos antes de un incremento no lo deshace. Si la
+  transacción se deshace tras subirlas, redis queda por delante de la base de
+  datos, lo que a lo sumo invalida algún token nuevo: falla cerrado.
+* Al identificar una petición se leen de redis. Si no están (o caducaron),
+  se leen de la base de datos y se copian. Si redis falla, o no hay redis, se
+  leen de la base de datos, que cuesta una consulta por clave primaria.
+
+Un token aún válido, o caducado hace menos de ventana_renovacion segundos,
+puede cambiarse por otro nuevo (POST /login/refresh) sin volver a enviar la
+clave, lo que evita verificarla con bcrypt. Sólo se comprueba su firma y su
+versión, así que un cambio de clave o de rol también impide renovarlo.
+
+El token lleva también el rol del profesor y los ids de los círculos a que
+pertenece (claim "circulos"), para que las reglas de permisos no tengan que
+consultarlos en la base de datos. El rol está protegido por la versión de
+token. La pertenencia a círculos cambia más a menudo y sin culpa del
+profesor, por lo que no revoca el token, sino que incrementa otra versión, la
+de círculos (claim "ver_circulos"). Si no coincide con la actual, la
+identidad se entrega sin círculos y los permisos los consultan a la base de
+datos, hasta que el token se renueva. Ambas versiones se leen juntas.
+"""
+
+from collections import OrderedDict
+import threading
+import time
+
+from jwt import DecodeError, ExpiredSignatureError
+from morepath import Identity, NO_IDENTITY
+from more.jwtauth import JWTIdentityPolicy
+from pony.orm import db_session, rollback
+import redis
+from webob.exc import HTTPServiceUnavailable
+
+from .metricas import contar
+
+PREFIJO_VERSIONES = "wexam:versiones:"
+# Las copias en redis caducan, para que no se acumulen las de profesores que
+# ya no usan la aplicación (o borrados). Después se leen de nuevo de la base
+# de datos
+DURACION_VERSIONES = 86400
+CLAIM_VERSION = "ver"
+CLAIM_CIRCULOS = "circulos"
+CLAIM_VERSION_CIRCULOS = "ver_circulos"
+
+
+def versiones_bd(id_profesor):
+    """Tupla (versión de token, versión de círculos) del profesor según la
+    base de datos, o None si no existe (ya se borró)"""
+    from .model import Profesor    # pylint: disable=import-outside-toplevel
+    with db_session:
+        profesor = Profesor.get(id=id_profesor)
+        if profesor is None:
+            return None
+        return profesor.version_token, profesor.version_circulos
+
+
+def subir_versiones(conexion, id_profesor, token=None, circulos=None):
+    """Copia en redis las versiones dadas del profesor, salvo las que allí ya
+    sean mayores"""
+    clave = PREFIJO_VERSIONES + str(id_profesor)
+    nuevas = {"token": token, "circulos": circulos}
+
+    def subir(pipe):
+        actuales = dict(zip(nuevas, pipe.hmget(clave, *nuevas)))
+        cambios = {campo: version for campo, version in nuevas.items()
+                   if version is not None and (actuales[campo] is None or
+                                               int(actuales[campo]) < version)}
+        pipe.multi()
+        if cambios:
+            pipe.hset(clave, mapping=cambios)
+        pipe.expire(clave, DURACION_VERSIONES)
+    conexion.transaction(subir, clave)
+
+
+def versiones(app, id_profesor):
+    """Tupla (versión de token, versión de círculos) actual del profesor, o
+    None si no existe (ya se borró). Se leen de redis si están allí"""
+    if id_profesor is None:
+        return None
+    conexion = getattr(app, "redis", None)
+    if conexion is not None:
+        try:
+            token, circulos = conexion.hmget(PREFIJO_VERSIONES + str(id_profesor),
+                                             "token", "circulos")
+            if token is not None and circulos is not None:
+                return int(token), int(circulos)
+        except redis.exceptions.RedisError:
+            conexion = None
+    actuales = versiones_bd(id_profesor)
+    if actuales is not None and conexion is not None:
+        try:
+            subir_versiones(conexion, id_profesor, *actuales)
+        except redis.exceptions.RedisError:
+            pass
+    return actuales
+
+
+def publicar(app, cambios):
+    """Sube en redis las versiones ya incrementadas en la base de datos
+    (diccionario id del profesor -> argumentos de subir_versiones). Si redis
+    falla, deshace la transacción en curso y eleva 503"""
+    conexion = getattr(app, "redis", None)
+    if conexion is None:
+        return
+    try:
+        for id_profesor, nuevas in cambios.items():
+            subir_versiones(conexion, id_profesor, **nuevas)
+    except redis.exceptions.RedisError:
+        rollback()
+        raise HTTPServiceUnavailable("No se pueden revocar las sesiones, pues el "
+                                     "backend redis no está disponible",
+                                     headers={"Retry-After": "5"})
+
+
+def revocar_tokens(app, id_profesor):
+    """Incrementa la versión de token del profesor, invalidando todos los que
+    tenía. Retorna la nueva versión, o None si el profesor no existe"""
+    from .model import Profesor    # pylint: disable=import-outside-toplevel
+    with db_session:
+        profesor = Profesor.get(id=id_profesor)
+        if profesor is None:
+            return None
+        profesor.version_token += 1
+        publicar(app, {id_profesor: {"token": profesor.version_token}})
+        return profesor.version_token
+
+
+def invalidar_circulos(app, ids_profesores):
+    """Incrementa la versión de círculos de los profesores dados, tras cambiar
+    su pertenencia a algún círculo. Sus token siguen siendo válidos, pero ya
+    no se confía en los círculos que indican"""
+    ids_profesores = list(set(ids_profesores))
+    if not ids_profesores:
+        return
+    from .model import Profesor    # pylint: disable=import-outside-toplevel
+    with db_session:
+        cambios = {}
+        for profesor in Profesor.select(lambda p: p.id in ids_profesores):
+            profesor.version_circulos += 1
+            cambios[profesor.id] = {"circulos": profesor.version_circulos}
+        publicar(app, cambios)
+
+
+def sin_circulos(identidad):
+    """Copia de la identidad en la que no constan los círculos del profesor,
+    para que los permisos los consulten a la base de datos"""
+    datos = identidad.as_dict()
+    datos[CLAIM_CIRCULOS] = None
+    return Identity(**datos)
+
+
+class CacheIdentidades(object):
+    """Caché LRU de identidades verificadas, indexada por el token. Guarda
+    como mucho max_entradas, y cada una sólo hasta la caducidad del token"""
+
+    def __init__(self, max_entradas=1024):
+        self.max_entradas = max_entradas
+        self.entradas = OrderedDict()
+        self.cerrojo = threading.Lock()
+
+    def get(self, token):
+        """Retorna la tupla (identidad, id del profesor, versión) guardada para
+        el token, o None si no está o ha caducado"""
+        with self.cerrojo:
+            entrada = self.entradas.get(token)
+            if entrada is None:
+                return None
+            caducidad, datos = entrada
+            if caducidad is not None and caducidad <= time.time():
+                del self.entradas[token]
+                return None
+            self.entradas.move_to_end(token)
+            return datos
+
+    def put(self, token, caducidad, datos):
+        with self.cerrojo:
+            self.entradas[token] = (caducidad, datos)
+            self.entradas.move_to_end(token)
+            while len(self.entradas) > self.max_entradas:
+                self.entradas.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entradas)
+
+
+class PoliticaJWT(JWTIdentityPolicy):
+    """JWTIdentityPolicy que no vuelve a verificar los token que ya verificó,
+    y que rechaza los emitidos con una versión distinta de la actual"""
+
+    def __init__(self, max_tokens=1024, ventana_renovacion=86400, **kwargs):
+        super().__init__(**kwargs)
+        self.cache = CacheIdentidades(max_tokens)
+        self.ventana_renovacion = ventana_renovacion
+
+    def verificar_token(self, token):
+        """Retorna la tupla (identidad, id del profesor, versión, versión de
+        círculos) del token,
+        tomándola de la caché o verificándolo. None si no es válido"""
+        datos = self.cache.get(token)
+        contar("wexam_cache_total", cache="tokens",
+               resultado="fallo" if datos is None else "acierto")
+        if datos is not None:
+            return datos
+        try:
+            claims_set = self.decode_jwt(token)
+        except (DecodeError, ExpiredSignatureError):
+            return None
+        userid = self.get_userid(claims_set)
+        if userid is None:
+            return None
+        extra_claims = self.get_extra_claims(claims_set) or {}
+        datos = (Identity(userid=userid, **extra_claims), extra_claims.get("id"),
+                 extra_claims.get(CLAIM_VERSION, 0),
+                 extra_claims.get(CLAIM_VERSION_CIRCULOS, 0))
+        self.cache.put(token, claims_set.get("exp"), datos)
+        return datos
+
+    def identify(self, request):
+        token = self.get_jwt(request)
+        if token is None:
+            return NO_IDENTITY
+        datos = self.verificar_token(token)
+        if datos is None:
+            return NO_IDENTITY
+        identidad, id_profesor, version, version_circulos = datos
+        actuales = versiones(request.app, id_profesor)
+        if actuales is None or version != actuales[0]:
+            return NO_IDENTITY
+        actual_circulos = actuales[1]
+        if version_circulos != actual_circulos:
+            return sin_circulos(identidad)
+        return identidad
+
+    def renovable(self, request):
+        """Retorna la identidad del token de la petición si puede renovarse
+        (está firmado por nosotros, caducó hace menos de ventana_renovacion
+        segundos o aún no lo ha hecho, y su versión es la actual), o None.
+        Como en identify, si sus círculos han cambiado se retorna sin ellos"""
+        token = self.get_jwt(request)
+        if token is None:
+            return None
+        try:
+            claims_set = self.decode_jwt(token, verify_expiration=False)
+        except DecodeError:
+            return None
+        caducidad = claims_set.get("exp")
+        if caducidad is not None and caducidad + self.ventana_renovacion < time.time():
+            return None
+        userid = self.get_userid(claims_set)
+        if userid is None:
+            return None
+        extra_claims = self.get_extra_claims(claims_set) or {}
+        actuales = versiones(request.app, extra_claims.get("id"))
+        if actuales is None or extra_claims.get(CLAIM_VERSION, 0) != actuales[0]:
+            return None
+        actual_circulos = actuales[1]
+        identidad = Identity(userid=userid, **extra_claims)
+        if extra_claims.get(CLAIM_VERSION_CIRCULOS, 0) != actual_circulos:
+            return sin_circulos(identidad)
+        return identidad
+
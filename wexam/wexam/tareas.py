@@ -0,0 +1,322 @@
+"""Funciones para encolar trabajos de compilación en redis (rq) y esperar
+a que terminen.
+
+Los trabajos con una misma clave (hash del contenido a compilar) se
+comparten: mientras uno está pendiente o en ejecución, las peticiones
+idénticas se asocian a él en lugar de encolar otro. Para ello se guarda en
+redis una marca por clave con el id del trabajo que la está compilando.
+
+Para esperar a un trabajo no se consulta su estado periódicamente, sino
+que se escuchan las notificaciones de redis sobre él. Hay dos fuentes:
+
+* Las notificaciones "keyspace" de redis sobre la clave del trabajo rq, que
+  se producen cada vez que el worker cambia su estado o su meta (progreso).
+  Requieren que el servidor redis las tenga activadas (véase
+  activar_notificaciones)
+* El canal propio de cada trabajo, en el que el servicio de compilación
+  puede publicar mediante notificar()
+
+Si no llega ninguna notificación, se consulta igualmente el estado cada
+cierto intervalo, por lo que la espera funciona (más lentamente) aunque
+ninguna de las dos fuentes esté disponible.
+
+Los trabajos se reparten en varias colas según su prioridad: la interactiva
+(alguien espera el resultado, como los PDF o las descargas síncronas), la de
+lotes (exportaciones zip/tgz) y la de mantenimiento. Los workers que escuchan
+varias colas las atienden en el orden en que se les pasan, por lo que basta
+arrancarlos con `rq worker <interactiva> <lotes> <mantenimiento>` para que
+las descargas interactivas nunca esperen detrás de las de lotes.
+"""
+
+from datetime import datetime, timezone
+import json
+import time
+import uuid
+
+import redis
+import rq
+import rq.registry
+from rq.job import JobStatus
+
+PREFIJO_MARCA = "wexam:compilando:"
+DURACION_MARCA = 3600    # segundos
+
+CANAL_TAREA = "wexam:tarea:{}"
+INTERVALO_CONSULTA = 1.0    # segundos
+
+COLA_INTERACTIVA = "interactiva"
+COLA_LOTES = "lotes"
+COLA_MANTENIMIENTO = "mantenimiento"
+# Nombre en redis de cada cola, si la configuración no especifica otro. La de
+# lotes conserva el nombre de la única cola que había antes
+NOMBRES_COLAS = {
+    COLA_INTERACTIVA: "json2latex-interactive",
+    COLA_LOTES: "json2latex-task",
+    COLA_MANTENIMIENTO: "wexam-maintenance",
+}
+# Formatos que se compilan siempre en la cola interactiva, pues se usan para
+# previsualizar el examen
+FORMATOS_INTERACTIVOS = ("pdf",)
+
+# Estados en que un trabajo aún sirve para asociarle nuevas peticiones
+# (terminado también, pues su resultado sigue en redis un tiempo)
+ESTADOS_COMPARTIBLES = ("queued", "deferred", "scheduled", "started", "finished")
+
+
+def liberar_marca(conexion, clave, job_id):
+    """Borra la marca de la clave, pero sólo si sigue apuntando al trabajo dado
+    (otra petición podría haberla renovado entretanto)"""
+    marca = PREFIJO_MARCA + clave
+    with conexion.pipeline() as pipe:
+        try:
+            pipe.watch(marca)
+            actual = pipe.get(marca)
+            if actual is not None and actual.decode("ascii") == job_id:
+                pipe.multi()
+                pipe.delete(marca)
+                pipe.execute()
+        except redis.exceptions.WatchError:
+            pass
+
+
+def crear_colas(conexion, config):
+    """Retorna un diccionario con la cola rq de cada prioridad. Sus nombres se
+    toman de la configuración (sección colas) o de NOMBRES_COLAS"""
+    return {prioridad: rq.Queue(getattr(config, prioridad, nombre), connection=conexion)
+            for prioridad, nombre in NOMBRES_COLAS.items()}
+
+
+def elegir_cola(formato, sync=False):
+    """Prioridad de la cola a la que debe ir una compilación"""
+    if sync or formato in FORMATOS_INTERACTIVOS:
+        return COLA_INTERACTIVA
+    return COLA_LOTES
+
+
+def promover(cola, job, planificadores=()):
+    """Si el trabajo sigue pendiente en otra cola, o esperando su turno en el
+    planificador de otra (de los dados), lo pasa a la dada. Se usa cuando
+    alguien espera de forma interactiva un trabajo encolado en lotes"""
+    if job.origin == cola.name:
+        return
+    estado = job.get_status()
+    if estado == JobStatus.DEFERRED:
+        for planificador in planificadores:
+            if planificador.cola.name == job.origin and planificador.retirar(job):
+                job.set_status(JobStatus.QUEUED)
+                cola.enqueue_job(job)
+                return
+        return
+    if estado != JobStatus.QUEUED:
+        return
+    # Si remove no lo encuentra es que un worker ya lo ha tomado
+    if rq.Queue(job.origin, connection=cola.connection).remove(job.id):
+        cola.enqueue_job(job)
+
+
+def estadisticas(cola):
+    """Estado de una cola: trabajos pendientes, en ejecución, y segundos que lleva esperando el más antiguo de los pendientes"""
+    espera = 0
+    primero = cola.get_job_ids(0, 1)
+    if primero:
+        job = obtener_trabajo(cola.connection, primero[0])
+        if job is not None and job.enqueued_at is not None:
+            encolado = job.enqueued_at
+            if encolado.tzinfo is None:
+                encolado = encolado.replace(tzinfo=timezone.utc)
+            espera = max(0, (datetime.now(timezone.utc) - encolado).total_seconds())
+    return {
+        "nombre": cola.name,
+        "pendientes": len(cola),
+        "en_curso": rq.registry.StartedJobRegistry(cola.name, connection=cola.connection).count,
+        "espera": round(espera, 1),
+    }
+
+
+def encolar(cola, nombre, *args, clave=None, promocionar=False, planificadores=(),
+            planificador=None, usuario=None, contar=True, **kwargs):
+    """Encola la tarea 'tasks.<nombre>' y retorna el id del trabajo rq.
+
+    Si se suministra la clave y ya hay un trabajo compartible con ella, no se
+    encola nada y se retorna el id de ese trabajo. Si además se pide
+    promocionar y ese trabajo aún está pendiente en otra cola (o en el
+    planificador de otra, de los dados), se pasa a ésta.
+
+    Si se suministra un planificador, el trabajo espera en él su turno
+    (entre los del usuario dado) antes de pasar a la cola. Salvo que no se
+    pida contar, antes se comprueba que el usuario puede lanzar otro trabajo
+    (o se eleva planificador.Saturado) y éste cuenta entre los que tiene en
+    curso. Compartir un trabajo existente no requiere esa comprobación"""
+    funcion = 'tasks.{}'.format(nombre)
+
+    def poner(job_id):
+        if planificador is not None:
+            if contar:
+                planificador.admitir(usuario)
+            return planificador.encolar(usuario, funcion, *args, job_id=job_id,
+                                        contar=contar, **kwargs)
+        return cola.enqueue(funcion, *args, job_id=job_id, **kwargs).id
+
+    if clave is None:
+        return poner(str(uuid.uuid4()))
+    conexion = cola.connection
+    marca = PREFIJO_MARCA + clave
+    job_id = str(uuid.uuid4())
+    # Dos intentos: si la marca existente apunta a un trabajo fallido o expirado
+    # se libera y se vuelve a intentar reservarla
+    for _ in range(2):
+        if conexion.set(marca, job_id, nx=True, ex=DURACION_MARCA):
+            try:
+                return poner(job_id)
+            except Exception:
+                # No se ha encolado (por ejemplo, el usuario está saturado)
+                liberar_marca(conexion, clave, job_id)
+                raise
+        existente = conexion.get(marca)
+        if existente is None:
+            continue
+        existente = existente.decode("ascii")
+        job = obtener_trabajo(conexion, existente)
+        if job is not None and job.get_status() in ESTADOS_COMPARTIBLES:
+            if promocionar:
+                promover(cola, job, planificadores)
+            return existente
+        liberar_marca(conexion, clave, existente)
+    # Si otra petición nos ganó la marca las dos veces, encolamos sin compartir
+    return poner(job_id)
+
+
+def activar_notificaciones(conexion):
+    """Pide al servidor redis que emita notificaciones keyspace para los
+    cambios en hashes (que es como rq guarda cada trabajo), respetando las
+    que ya tuviera activadas. Puede fallar si el servidor no admite CONFIG"""
+    actual = conexion.config_get("notify-keyspace-events").get(
+        "notify-keyspace-events", "")
+    if "K" in actual and ("h" in actual or "A" in actual):
+        return
+    nuevo = "".join(sorted(set(actual) | set("Kh")))
+    conexion.config_set("notify-keyspace-events", nuevo)
+
+
+def canales(conexion, job_id):
+    """Canales pub/sub por los que llegan las notificaciones de un trabajo"""
+    db = conexion.connection_pool.connection_kwargs.get("db", 0)
+    return [CANAL_TAREA.format(job_id),
+            "__keyspace@{}__:rq:job:{}".format(db, job_id)]
+
+
+def notificar(conexion, job_id, **datos):
+    """Publica un cambio en el trabajo dado (por ejemplo su progreso o que ha
+    terminado). Pensada para ser llamada desde el servicio de compilación"""
+    conexion.publish(CANAL_TAREA.format(job_id), json.dumps(datos))
+
+
+def obtener_trabajo(conexion, job_id):
+    """Retorna el trabajo rq, o None si no existe"""
+    try:
+        return rq.job.Job.fetch(job_id, connection=conexion)
+    except rq.exceptions.NoSuchJobError:
+        return None
+
+
+def obtener_trabajos(conexion, job_ids):
+    """Retorna la lista de los trabajos rq con esos ids (None los que no
+    existen), leídos en un solo viaje a redis"""
+    if not job_ids:
+        return []
+    return rq.job.Job.fetch_many(job_ids, connection=conexion)
+
+
+def aguardar(obtener, esperar_cambio, timeout):
+    """Bloquea hasta que el trabajo que retorna obtener() termine (con éxito o
+    fallo) o pasen timeout segundos. Entre consultas se llama a
+    esperar_cambio(segundos), que debe retornar antes si hay novedades.
+    Retorna el trabajo, o None si no existe"""
+    limite = time.monotonic() + timeout
+    while True:
+        job = obtener()
+        if job is None or job.is_finished or job.is_failed:
+            return job
+        restante = limite - time.monotonic()
+        if restante <= 0:
+            return job
+        esperar_cambio(min(INTERVALO_CONSULTA, restante))
+
+
+def seguir(obtener, esperar_cambio, timeout, latido=15):
+    """Generador de los cambios de estado del trabajo que retorna obtener(),
+    para enviarlos al cliente según se producen (Server-Sent Events).
+
+    Produce el estado actual (véase describir) y después uno nuevo cada vez
+    que cambia, consultándolo tras cada llamada a esperar_cambio (como en
+    aguardar). Termina tras producir el estado final (completado, fallido o
+    borrado) o pasados timeout segundos. Si en latido segundos no ha habido
+    cambios produce None, para que quien lo use pueda mantener viva la conexión"""
+    limite = time.monotonic() + timeout
+    anterior = None
+    ultimo_envio = time.monotonic()
+    while True:
+        estado = describir(obtener())
+        if estado != anterior:
+            yield estado
+            anterior = estado
+            ultimo_envio = time.monotonic()
+            if estado["status"] in ("Borrada", "Fallida", "Completada"):
+                return
+        elif time.monotonic() - ultimo_envio >= latido:
+            yield None
+            ultimo_envio = time.monotonic()
+        restante = limite - time.monotonic()
+        if restante <= 0:
+            return
+        esperar_cambio(min(INTERVALO_CONSULTA, restante))
+
+
+def consultor(conexion, job_id, al_despertar=None):
+    """Función que obtiene el trabajo de redis, llamando antes a al_despertar"""
+    def obtener():
+        if al_despertar is not None:
+            al_despertar()
+        return obtener_trabajo(conexion, job_id)
+    return obtener
+
+
+def esperar(conexion, job_id, timeout, al_despertar=None):
+    """Bloquea hasta que el trabajo dado termine (con éxito o fallo) o pasen
+    timeout segundos, despertando con las notificaciones de redis. Retorna
+    el trabajo, o None si no existe. Si se da la función al_despertar, se
+    invoca antes de cada consulta del estado"""
+    pubsub = conexion.pubsub(ignore_subscribe_messages=True)
+    # Suscribirse antes de consultar el estado, para no perder la notificación
+    # si el trabajo termina entre ambas operaciones
+    pubsub.subscribe(*canales(conexion, job_id))
+    try:
+        return aguardar(consultor(conexion, job_id, al_despertar),
+                        lambda segundos: pubsub.get_message(timeout=segundos), timeout)
+    finally:
+        pubsub.close()
+
+
+def describir(job):
+    """Estado de un trabajo con el mismo formato que la vista de la Tarea"""
+    if job is None:
+        return {"status": "Borrada", "msg": "Debes lanzar de nuevo la conversión"}
+    if job.is_failed:
+        return {"status": "Fallida", "msg": str(job.exc_info)}
+    if job.is_finished:
+        return {"status": "Completada"}
+    return {"status": job.meta.get("progreso", "Esperando")}
+
+
+def eventos(conexion, job_id, timeout, latido=15, al_despertar=None):
+    """Generador de los cambios de estado de un trabajo (véase seguir), que
+    despierta con las notificaciones de redis. Como en esperar, al_despertar
+    se invoca antes de cada consulta del estado"""
+    pubsub = conexion.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(*canales(conexion, job_id))
+    try:
+        yield from seguir(consultor(conexion, job_id, al_despertar),
+                          lambda segundos: pubsub.get_message(timeout=segundos),
+                          timeout, latido)
+    finally:
+        pubsub.close()
@@ -4,7 +4,7 @@ from wexam.model import *
 import os.path
 import os
 from datetime import datetime
-from passlib.hash import bcrypt
+from wexam.claves import cifrar
 import random
 
 
@@ -17,27 +17,27 @@ def crear_db_ejemplo(db):
         jose = Profesor(nombre="Jose Luis Díaz", email="jldiaz@uniovi.es",
                     username="jldiaz", role="profesor",
                     fecha_creacion=now, fecha_modificacion=now,
-                    password=bcrypt.hash("0000"))
+                    password=cifrar("0000"))
         marco = Profesor(nombre="Marco Antonio García", email="marco@uniovi.es",
                     username="marco", role="profesor",
                     fecha_creacion=now, fecha_modificacion=now,
-                    password=bcrypt.hash("0000"))
+                    password=cifrar("0000"))
         joaquin = Profesor(nombre="Joaquín Entrialgo", email="joaquin@uniovi.es",
                     username="joaquin", role="profesor",
                     fecha_creacion=now, fecha_modificacion=now,
-                    password=bcrypt.hash("0000"))
+                    password=cifrar("0000"))
         arias = Profesor(nombre="José Ramón Arias", email="arias@uniovi.es",
                     username="arias", role="profesor",
                     fecha_creacion=now, fecha_modificacion=now,
-                    password=bcrypt.hash("0000"))
+                    password=cifrar("0000"))
         javier = Profesor(nombre="Javier García", email="javier@uniovi.es",
                     username="javier", role="profesor",
                     fecha_creacion=now, fecha_modificacion=now,
-                    password=bcrypt.hash("0000"))
+                    password=cifrar("0000"))
         admin = Profesor(nombre="Administrador", email="admin@example.com",
                     username="admin", role="admin",
                     fecha_creacion=now, fecha_modificacion=now,
-                    password=bcrypt.hash("0000"))
+                    password=cifrar("0000"))
         # jldiaz crea un par de círculos y mete en ellos a otros profesores
         now = datetime.now()
         c_sd = Circulo(nombre="Sist. Dist.", creador=jose,
@@ -0,0 +1,69 @@
+"""Sustituto del módulo `tasks` del servicio de compilación, para poder
+ejecutar en los test un worker rq que no necesite LaTeX. Cada función
+genera un contenido que identifica al examen y la variante compilada"""
+import io
+import json
+import os
+import tarfile
+import time
+import zipfile
+
+import rq
+
+from wexam import tareas
+
+
+def informar(progreso):
+    """Actualiza el progreso del trabajo en curso, como hace el servicio de
+    compilación, y lo notifica. La pausa da tiempo a que los test lo observen"""
+    job = rq.get_current_job()
+    if job is None:
+        return
+    job.meta['progreso'] = progreso
+    job.save_meta()
+    tareas.notificar(job.connection, job.id, progreso=progreso)
+    time.sleep(0.2)
+
+
+def entregar(contenido, destino):
+    """Si se especifica destino, escribe en él el resultado (de forma atómica)
+    y retorna su ruta. Si no, retorna el contenido, que rq guarda en redis"""
+    if destino is None:
+        return contenido
+    temporal = destino + ".tmp"
+    with open(temporal, "wb") as fichero:
+        fichero.write(contenido)
+    os.replace(temporal, destino)
+    return destino
+
+
+def json2pdf(data, formato, destino=None):
+    examen = json.loads(data)
+    informar("Compilando")
+    contenido = "%PDF examen {} {}".format(examen["id"], examen["resuelto"])
+    return entregar(contenido.encode("utf-8"), destino)
+
+
+def json2latex(data, formato, destino=None):
+    examen = json.loads(data)
+    contenido = "{} examen {} {}".format(formato, examen["id"], examen["resuelto"])
+    return entregar(contenido.encode("utf-8"), destino)
+
+
+def json2latex_variantes(data, variantes, formato, destino=None):
+    """Un único archivo con una carpeta por variante"""
+    examen = json.loads(data)
+    buffer = io.BytesIO()
+    if formato == "zip":
+        with zipfile.ZipFile(buffer, "w") as archivo:
+            for variante in variantes:
+                archivo.writestr("{}/examen.tex".format(variante),
+                                 "examen {} {}".format(examen["id"], variante))
+    else:
+        with tarfile.open(fileobj=buffer, mode="w:gz") as archivo:
+            for variante in variantes:
+                contenido = "examen {} {}".format(examen["id"], variante).encode("utf-8")
+                info = tarfile.TarInfo("{}/examen.tex".format(variante))
+                info.size = len(contenido)
+                archivo.addfile(info, io.BytesIO(contenido))
+    return entregar(buffer.getvalue(), destino)
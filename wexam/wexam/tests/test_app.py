@@ -9,6 +9,7 @@ import pytest
 from webtest import TestApp as Client
 import wexam.mixins
 import wexam.model
+from wexam import claves
 from wexam.model import (db, Profesor, Cuestion, Examen, Problema, Problema_examen,
                          Asignatura, Tag, Circulo)
 from crear_db_ejemplo import crear_db_ejemplo
@@ -37,9 +38,12 @@ class TestWithMockDatabaseUnlogged:
             # La carga de la App también se hace una sola vez
             with open('settings/default.yaml') as config:
                 settings_dict = yaml.load(config)
+            # En los test basta el coste mínimo de bcrypt
+            settings_dict["claves"]["coste"] = 4
             wexam.App.init_settings(settings_dict)
             morepath.scan(wexam)
             morepath.commit(wexam.App)
+            claves.configurar(wexam.App().settings.claves)
         else:
             # Aún si la bd ya existía hay que volver a crear las tablas
             # porque el teardown las elimina
@@ -229,6 +233,8 @@ class TestProfesorDesdeAdmin(TestWithMockDatabaseLoggedAsAdmin):
         assert p1.json["email"] == 'jldiaz@uniovi.es'
         creado = p1.json["fecha_creacion"]
         modificado = p1.json["fecha_modificacion"]
+        # Las fechas tienen resolución de segundos
+        time.sleep(1)
         p1 = self.c.put_json('/profesor/1', {'email': 'jldiaz@gmail.com'})
         assert p1.json["email"] == 'jldiaz@gmail.com'
         # Volver a dejarlo como estaba
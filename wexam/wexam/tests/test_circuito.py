@@ -0,0 +1,95 @@
+"""Test del interruptor (circuit breaker) que protege las conexiones a redis"""
+import time
+
+import pytest
+import redis
+from pony.orm import db_session
+
+from test_tareas import TestWithRedisLoggedAsAdmin
+from wexam.circuito import Interruptor, CircuitoAbierto, crear_conexion
+from wexam.model import Tarea
+
+# Puerto en el que no escucha nadie, para simular un redis caído
+REDIS_CAIDO = "redis://127.0.0.1:1/0"
+
+
+class TestInterruptor:
+    """Transiciones del interruptor entre cerrado, abierto y semiabierto"""
+    def test_se_abre_tras_fallos_seguidos(self):
+        "Tras umbral fallos seguidos las operaciones se rechazan"
+        interruptor = Interruptor(umbral=2, espera=60)
+        interruptor.fallo()
+        interruptor.comprobar()
+        interruptor.fallo()
+        with pytest.raises(CircuitoAbierto) as excepcion:
+            interruptor.comprobar()
+        assert 0 < excepcion.value.reintentar <= 60
+
+    def test_exito_reinicia_la_cuenta(self):
+        "Los fallos sólo cuentan si son consecutivos"
+        interruptor = Interruptor(umbral=2, espera=60)
+        interruptor.fallo()
+        interruptor.exito()
+        interruptor.fallo()
+        interruptor.comprobar()
+
+    def test_una_sola_prueba_al_reintentar(self):
+        "Pasada la espera se deja pasar una operación, y según su resultado se cierra"
+        interruptor = Interruptor(umbral=1, espera=0.05)
+        interruptor.fallo()
+        time.sleep(0.06)
+        interruptor.comprobar()
+        with pytest.raises(CircuitoAbierto):
+            interruptor.comprobar()
+        interruptor.exito()
+        interruptor.comprobar()
+
+    def test_prueba_fallida_vuelve_a_abrir(self):
+        "Si la operación de prueba falla, se espera de nuevo"
+        interruptor = Interruptor(umbral=3, espera=0.05)
+        for _ in range(3):
+            interruptor.fallo()
+        time.sleep(0.06)
+        interruptor.comprobar()
+        interruptor.fallo()
+        with pytest.raises(CircuitoAbierto):
+            interruptor.comprobar()
+
+
+class TestConexionProtegida:
+    """El cliente redis creado con crear_conexion deja de conectar si redis cae"""
+    def test_falla_sin_conectar(self):
+        "Una vez abierto el interruptor no se intenta conectar"
+        cliente = crear_conexion(REDIS_CAIDO)
+        for _ in range(3):
+            with pytest.raises(redis.exceptions.ConnectionError):
+                cliente.get("x")
+        assert cliente.interruptor.estado == "abierto"
+        inicio = time.monotonic()
+        for _ in range(100):
+            with pytest.raises(CircuitoAbierto):
+                cliente.get("x")
+        with pytest.raises(CircuitoAbierto):
+            cliente.pipeline().get("x").execute()
+        assert time.monotonic() - inicio < 0.5
+
+
+class TestRedisCaido(TestWithRedisLoggedAsAdmin):
+    """Con redis caído, las vistas de tareas responden 503 de inmediato"""
+    def test_tarea_responde_503(self):
+        "La tarea no se da por borrada, y se indica cuándo reintentar"
+        respuesta = self.c.get('/examen/1/download?formato=zip')
+        redis_bueno = self.app.redis
+        self.app.redis = crear_conexion(REDIS_CAIDO)
+        try:
+            for _ in range(3):
+                self.c.get(respuesta.json["link"], status=503)
+            inicio = time.monotonic()
+            estado = self.c.get(respuesta.json["link"], status=503)
+            assert time.monotonic() - inicio < 0.5
+            assert int(estado.headers["Retry-After"]) > 0
+        finally:
+            self.app.redis = redis_bueno
+        with db_session():
+            assert Tarea.get(id=respuesta.json["link"].split("/")[-1]) is not None
+        self.ejecutar_worker()
@@ -0,0 +1,94 @@
+"""Test del cifrado y la verificación de claves"""
+import re
+import threading
+
+from passlib.context import CryptContext
+from pony.orm import db_session
+import yaml
+
+from test_app import TestWithMockDatabaseUnlogged
+from wexam import claves
+from wexam.model import Profesor
+
+
+class ContextoBloqueado:
+    """Contexto cuya verificación no termina hasta que se libera"""
+    def __init__(self):
+        self.empezada = threading.Event()
+        self.liberar = threading.Event()
+
+    def verify_and_update(self, clave, hash_):
+        self.empezada.set()
+        self.liberar.wait(5)
+        return True, None
+
+
+def test_pendientes_dejan_hilos_libres():
+    "Con la configuración por defecto, los login pendientes no ocupan todos los hilos de uwsgi"
+    with open("lanzar-uwsgi.sh") as script:
+        hilos = int(re.search(r"--threads (\d+)", script.read()).group(1))
+    for nombre in ("default", "amazon-ec2"):
+        with open("settings/{}.yaml".format(nombre)) as config:
+            assert yaml.safe_load(config)["claves"]["max_pendientes"] < hilos
+
+
+class TestVerificador:
+    def test_rechaza_si_hay_demasiadas_pendientes(self):
+        "Por encima de max_pendientes se eleva Saturado sin esperar"
+        contexto = ContextoBloqueado()
+        verificador = claves.Verificador(contexto, max_hilos=1, max_pendientes=1,
+                                         reintentar=3)
+        hilo = threading.Thread(target=verificador.verificar, args=("x", "y"))
+        hilo.start()
+        assert contexto.empezada.wait(5)
+        try:
+            verificador.verificar("x", "y")
+            assert False, "Debería haber elevado Saturado"
+        except claves.Saturado as e:
+            assert e.reintentar == 3
+        contexto.liberar.set()
+        hilo.join()
+        assert verificador.verificar("x", "y") == (True, None)
+
+    def test_coste_distinto_se_recalcula(self):
+        "Una clave cifrada con otro coste es válida, y se retorna el nuevo hash"
+        antiguo = CryptContext(schemes=["bcrypt"], bcrypt__rounds=5).hash("0000")
+        valida, nuevo = claves.verificar("0000", antiguo)
+        assert valida
+        assert claves.contexto.identify(nuevo) == "bcrypt"
+        assert not claves.contexto.needs_update(nuevo)
+        assert claves.verificar("0000", nuevo) == (True, None)
+        assert claves.verificar("1111", antiguo) == (False, None)
+
+
+class TestLogin(TestWithMockDatabaseUnlogged):
+    def login(self, **kwargs):
+        return self.c.post_json('/login', {'email': 'admin@example.com',
+                                           'password': '0000'}, **kwargs)
+
+    def test_login_recalcula_hash(self):
+        "Tras el login, la clave queda cifrada con el coste configurado"
+        with db_session():
+            admin = Profesor.get(email='admin@example.com')
+            admin.password = CryptContext(schemes=["bcrypt"], bcrypt__rounds=5).hash("0000")
+        assert self.login().status_code == 200
+        with db_session():
+            guardado = Profesor.get(email='admin@example.com').password
+        assert not claves.contexto.needs_update(guardado)
+        assert self.login().status_code == 200
+
+    def test_login_saturado(self):
+        "Si hay demasiados logins pendientes se responde 503 con Retry-After"
+        contexto = ContextoBloqueado()
+        original = claves.verificador
+        claves.verificador = claves.Verificador(contexto, max_hilos=1, max_pendientes=1)
+        hilo = threading.Thread(target=claves.verificador.verificar, args=("x", "y"))
+        hilo.start()
+        try:
+            assert contexto.empezada.wait(5)
+            respuesta = self.login(status=503)
+            assert respuesta.headers["Retry-After"] == "2"
+        finally:
+            contexto.liberar.set()
+            hilo.join()
+            claves.verificador = original
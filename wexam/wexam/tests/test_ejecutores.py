@@ -0,0 +1,151 @@
+"""Test del backend local de tareas, que las ejecuta sin redis en un pool
+de procesos (con las funciones del módulo tasks de los test)"""
+import shutil
+import tempfile
+import types
+
+import pytest
+
+from test_app import TestWithMockDatabaseLoggedAsAdmin
+from wexam.cache import CacheCompilacion
+from wexam.circuito import crear_conexion
+from wexam.ejecutores import BackendLocal, BackendRQ
+from wexam.instance_app import setup_tareas
+
+EXAMEN = '{"id": 3, "resuelto": "resuelto"}'
+# Puerto en el que no escucha nadie, para simular un redis caído
+REDIS_CAIDO = "redis://127.0.0.1:1/0"
+
+
+class TestBackendLocal:
+    """Operaciones del backend local, con la misma semántica que las de rq"""
+    def setup_class(self):
+        self.carpeta = tempfile.mkdtemp()
+        self.backend = BackendLocal(self.carpeta, max_procesos=1)
+
+    def teardown_class(self):
+        self.backend.pool.shutdown()
+        shutil.rmtree(self.carpeta)
+
+    def test_trabajo_completado(self):
+        "El resultado de la tarea queda disponible al terminar"
+        job_id = self.backend.lanzar("json2pdf", data=EXAMEN, formato="pdf")
+        job = self.backend.esperar(job_id, 30)
+        assert job.get_status() == "finished"
+        assert job.result == b"%PDF examen 3 resuelto"
+
+    def test_trabajo_fallido(self):
+        "Si la tarea eleva una excepción, el trabajo falla con su traza"
+        job = self.backend.esperar(self.backend.lanzar("json2pdf", data="no es json",
+                                                       formato="pdf"), 30)
+        assert job.is_failed
+        assert "JSONDecodeError" in job.exc_info
+
+    def test_misma_clave_comparte_trabajo(self):
+        "Mientras está en curso, la misma clave retorna el mismo trabajo"
+        primero = self.backend.lanzar("json2latex", clave="abc", data=EXAMEN, formato="zip")
+        segundo = self.backend.lanzar("json2latex", clave="abc", data=EXAMEN, formato="zip")
+        assert primero == segundo
+        self.backend.esperar(primero, 30)
+
+    def test_eventos_hasta_completar(self):
+        "Los eventos terminan con el estado final"
+        job_id = self.backend.lanzar("json2pdf", data=EXAMEN, formato="pdf")
+        estados = [e["status"] for e in self.backend.eventos(job_id, 30) if e]
+        assert estados[-1] == "Completada"
+
+    def test_trabajo_inexistente(self):
+        "Un trabajo desconocido (o purgado) no existe"
+        assert self.backend.trabajo("no-existe") is None
+
+
+class TestPoolRoto:
+    """Si un proceso del pool muere, sus trabajos fallan y el pool se rehace"""
+    def setup_method(self):
+        self.carpeta = tempfile.mkdtemp()
+
+    def teardown_method(self):
+        shutil.rmtree(self.carpeta)
+
+    def test_proceso_muerto(self):
+        "El trabajo cuyo proceso murió falla, y los siguientes se ejecutan"
+        # os._exit termina el proceso del pool sin que ejecutar anote nada
+        backend = BackendLocal(self.carpeta, max_procesos=1, modulo="os")
+        job = backend.esperar(backend.lanzar("_exit", 1), 30)
+        assert job.is_failed
+        assert "BrokenProcessPool" in job.exc_info
+        roto = backend.pool
+        job = backend.esperar(backend.lanzar("getcwd"), 30)
+        assert job.get_status() == "finished"
+        assert backend.pool is not roto
+        backend.pool.shutdown()
+
+
+class TestDescargaSinRedis(TestWithMockDatabaseLoggedAsAdmin):
+    """Sin redis, las descargas funcionan igual con el backend local"""
+    def setup_class(self):
+        TestWithMockDatabaseLoggedAsAdmin.setup_class(self)
+        self.app = self.c.app
+        self.carpeta = tempfile.mkdtemp()
+        self.app.redis = None
+        self.app.tareas = BackendLocal(self.carpeta + "/tareas", max_procesos=1)
+        self.app.cache = CacheCompilacion(self.carpeta + "/cache", 10**6)
+
+    def teardown_class(self):
+        TestWithMockDatabaseLoggedAsAdmin.teardown_class(self)
+        self.app.tareas.pool.shutdown()
+        shutil.rmtree(self.carpeta)
+
+    def test_descarga_sincrona(self):
+        "Con sync=1 se responde con el resultado"
+        respuesta = self.c.get('/examen/1/download?formato=pdf&sync=1')
+        assert respuesta.body == b"%PDF examen 1 noresuelto"
+
+    def test_descarga_asincrona(self):
+        "La tarea se consulta y se descarga como con rq"
+        respuesta = self.c.get('/examen/2/download?formato=zip')
+        # El pool local puede haberla terminado ya
+        assert respuesta.json["status"] in ("Procesando", "Completada")
+        job_id = None
+        for _ in range(300):
+            estado = self.c.get(respuesta.json["link"]).json
+            if estado["status"] == "Completada":
+                break
+            self.app.tareas.esperar_cambio(0.1)
+        assert estado["status"] == "Completada"
+        assert self.c.get(estado["link"]).body == b"zip examen 2 noresuelto"
+
+    def test_sin_almacen_de_artefactos(self):
+        "Sin caché, el resultado se toma del almacén del backend"
+        cache, self.app.cache = self.app.cache, None
+        try:
+            respuesta = self.c.get('/examen/1/download?formato=tgz&sync=1')
+        finally:
+            self.app.cache = cache
+        assert respuesta.body == b"tgz examen 1 noresuelto"
+
+
+class TestEleccionDelBackend:
+    """Con sección ejecutor_local, se usa el backend local si redis no
+    responde al arrancar"""
+    def setup_method(self):
+        self.carpeta = tempfile.mkdtemp()
+        config = types.SimpleNamespace(carpeta=self.carpeta)
+        self.app = types.SimpleNamespace(
+            settings=types.SimpleNamespace(ejecutor_local=config))
+
+    def teardown_method(self):
+        shutil.rmtree(self.carpeta)
+
+    def test_redis_caido_al_arrancar(self):
+        "Si redis no responde, las tareas se ejecutan en el nodo"
+        self.app.redis = crear_conexion(REDIS_CAIDO)
+        setup_tareas(self.app)
+        assert isinstance(self.app.tareas, BackendLocal)
+
+    def test_redis_disponible(self):
+        "Si redis responde, las tareas van a los workers rq"
+        fakeredis = pytest.importorskip("fakeredis")
+        self.app.redis = fakeredis.FakeStrictRedis()
+        setup_tareas(self.app)
+        assert isinstance(self.app.tareas, BackendRQ)
@@ -0,0 +1,91 @@
+"""Test de los planes de ejecución de las consultas más frecuentes.
+
+Cada test ejecuta una consulta, captura las sentencias SQL que lanza pony y
+pide a SQLite su plan (EXPLAIN QUERY PLAN). Fallan si alguna recorre una
+tabla entera sin índice, y en los listados también si hay que ordenar los
+resultados en una tabla temporal. Así se detecta si un cambio en las
+consultas o en el modelo deja de aprovechar los índices.
+"""
+import re
+
+from pony.orm import db_session
+
+from test_app import TestWithMockDatabaseUnlogged
+from wexam import db_collections as coll
+from wexam import model
+
+# "SCAN p" recorre la tabla entera. "SCAN p USING INDEX ..." la recorre en el
+# orden de un índice, lo que sólo ocurre en los listados completos del admin
+RECORRIDO_COMPLETO = re.compile(r"^SCAN \S+$")
+# Ordenar todos los resultados. Sí se admite ordenar sólo los empates del
+# índice ("USE TEMP B-TREE FOR RIGHT PART OF ORDER BY")
+ORDENACION = "USE TEMP B-TREE FOR ORDER BY"
+
+
+def planes(consulta):
+    """Ejecuta consulta() dentro de una db_session y retorna el plan (lista de
+    pasos) de cada SELECT que lanza"""
+    with db_session:
+        conexion = model.db.get_connection()
+        sentencias = []
+        conexion.set_trace_callback(sentencias.append)
+        try:
+            consulta()
+        finally:
+            conexion.set_trace_callback(None)
+        return {sql: [fila[3] for fila in conexion.execute("EXPLAIN QUERY PLAN " + sql)]
+                for sql in sentencias if sql.lstrip().upper().startswith("SELECT")}
+
+
+def verificar(consulta, ordenada=False):
+    """Comprueba que ninguna de las sentencias de la consulta recorre una
+    tabla entera y, si es ordenada, que el orden lo da un índice"""
+    resultado = planes(consulta)
+    assert resultado
+    for sql, pasos in resultado.items():
+        completos = [p for p in pasos if RECORRIDO_COMPLETO.match(p)]
+        assert not completos, "{}\n{}".format(sql, pasos)
+        if ordenada:
+            assert ORDENACION not in pasos, "{}\n{}".format(sql, pasos)
+
+
+class TestIndices(TestWithMockDatabaseUnlogged):
+    def test_problemas_creados(self):
+        verificar(lambda: list(coll.Problemas().get_created_by_user(1)), ordenada=True)
+
+    def test_problemas_de_admin(self):
+        "El admin ve todos, pero ordenados por un índice"
+        verificar(lambda: list(coll.Problemas().get_created_by_user(6)), ordenada=True)
+
+    def test_problemas_visibles(self):
+        "Los compartidos se buscan a partir de los círculos del profesor"
+        verificar(lambda: list(coll.Problemas().get_visible_by_user(2)))
+
+    def test_examenes_creados(self):
+        verificar(lambda: list(coll.Examenes().get_created_by_user(1)), ordenada=True)
+
+    def test_circulos_creados(self):
+        verificar(lambda: list(coll.Circulos().get_created_by_user(1)), ordenada=True)
+
+    def test_problemas_de_un_examen(self):
+        verificar(lambda: list(model.Examen[1].problemas.order_by(model.Problema_examen.posicion)),
+                  ordenada=True)
+
+    def test_cuestiones_de_un_problema(self):
+        verificar(lambda: list(model.Problema[1].cuestiones.order_by(model.Cuestion.posicion)),
+                  ordenada=True)
+
+    def test_tags_por_nombre(self):
+        verificar(lambda: list(model.Tag.select(lambda t: t.name in ["foo", "bar"])))
+
+    def test_circulos_de_un_profesor(self):
+        verificar(lambda: list(model.Profesor[2].circulos_en_que_esta))
+
+    def test_circulos_de_un_problema(self):
+        verificar(lambda: list(model.Problema[1].compartido_con))
+
+    def test_tarea_por_clave(self):
+        def consulta():
+            profesor = model.Profesor[1]
+            model.Tarea.select(lambda t: t.creador == profesor and t.clave == "x").first()
+        verificar(consulta)
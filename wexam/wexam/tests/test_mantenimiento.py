@@ -0,0 +1,83 @@
+"""Test del mantenimiento periódico de la base de datos"""
+import json
+import subprocess
+import sys
+
+import pytest
+fakeredis = pytest.importorskip("fakeredis")
+from pony.orm import db_session
+
+from test_tareas import TestWithRedisLoggedAsAdmin
+from wexam import mantenimiento, tareas
+from wexam.model import Asignatura, Profesor, Tag, Tarea
+
+
+class TestMantenimiento(TestWithRedisLoggedAsAdmin):
+    """Se borran por lotes los objetos huérfanos y las tareas caducadas"""
+    def test_purga_huerfanos_y_tareas(self):
+        "Una pasada borra lo que ninguna petición ha limpiado"
+        self.c.get('/examen/1/download?formato=zip')
+        with db_session():
+            pendiente = Tarea.select().first().id
+            profesor = Profesor.select().first()
+            for n in range(3):
+                Tag(name="huerfano{}".format(n))
+            Asignatura(nombre="Sin exámenes", titulacion="Informática")
+            Tarea(id="caducada", nombre="json2pdf", tipo="pdf", creador=profesor,
+                  trabajo="no-existe")
+            fallido = tareas.encolar(self.app.task_queue, "json2pdf", data="no es json",
+                                     formato="pdf")
+            Tarea(id="fallida", nombre="json2pdf", tipo="pdf", creador=profesor,
+                  trabajo=fallido)
+        self.ejecutar_worker()
+        with db_session():
+            tags_antes = Tag.select().count()
+        metricas = mantenimiento.mantener(self.app, lote=2)
+        assert metricas["tags"] == 3
+        assert metricas["asignaturas"] == 1
+        assert metricas["tareas"] == 2
+        with db_session():
+            assert Tag.select().count() == tags_antes - 3
+            assert not Asignatura.select(lambda a: not a.examenes).exists()
+            assert Tarea.get(id="caducada") is None
+            assert Tarea.get(id="fallida") is None
+            assert Tarea.get(id=pendiente) is not None
+        guardadas = json.loads(self.app.redis.get(mantenimiento.CLAVE_METRICAS))
+        assert guardadas["tareas"] == 2
+
+    def test_sin_backend_no_borra_tareas(self):
+        "Sin backend no se sabe el estado de los trabajos, y no se borra nada"
+        with db_session():
+            profesor = Profesor.select().first()
+            Tarea(id="sin-backend", nombre="json2pdf", tipo="pdf", creador=profesor,
+                  trabajo="no-existe")
+        backend, self.app.tareas = self.app.tareas, None
+        try:
+            assert mantenimiento.purgar_tareas(self.app) == 0
+        finally:
+            self.app.tareas = backend
+        with db_session():
+            assert Tarea.get(id="sin-backend") is not None
+
+
+class TestReparto(TestWithRedisLoggedAsAdmin):
+    """Entre pasadas, el comando pasa a la cola rq los trabajos del planificador"""
+    def test_despacha_sin_peticiones(self):
+        "Un trabajo diferido llega a la cola rq aunque nadie lo consulte"
+        planificador = self.app.planificadores[tareas.COLA_LOTES]
+        capacidad, planificador.capacidad = planificador.capacidad, 0
+        try:
+            job_id = self.app.tareas.lanzar("json2pdf", data="{}", formato="zip",
+                                            usuario=1)
+        finally:
+            planificador.capacidad = capacidad
+        assert job_id not in self.app.task_queue.job_ids
+        mantenimiento.despachar_durante(self.app, 0, 1)
+        assert job_id in self.app.task_queue.job_ids
+
+
+def test_comando_se_importa_solo():
+    "El módulo del comando wexam-mantenimiento se importa sin que la app lo esté ya"
+    resultado = subprocess.run([sys.executable, "-c", "from wexam.mantenimiento import main"],
+                               capture_output=True, text=True)
+    assert resultado.returncode == 0, resultado.stderr
@@ -0,0 +1,107 @@
+"""Test de las métricas para Prometheus (/metrics)"""
+import pytest
+fakeredis = pytest.importorskip("fakeredis")
+
+from test_tareas import TestWithRedisLoggedAsAdmin
+from test_app import TestWithMockDatabaseUnlogged
+from wexam import metricas
+
+
+class TestRegistro:
+    def test_sin_redis(self):
+        "Sin redis, cada proceso muestra sus propios totales"
+        registro = metricas.Registro()
+        registro.sumar("wexam_cache_total", cache="tokens", resultado="acierto")
+        registro.sumar("wexam_cache_total", 2, cache="tokens", resultado="acierto")
+        assert registro.leer(None) == {'wexam_cache_total{cache="tokens",resultado="acierto"}': 3}
+        registro.sumar("wexam_cache_total", cache="tokens", resultado="acierto")
+        assert registro.leer(None) == {'wexam_cache_total{cache="tokens",resultado="acierto"}': 4}
+
+    def test_suma_los_procesos(self):
+        "Con redis, se muestran los totales de todos los procesos"
+        conexion = fakeredis.FakeStrictRedis()
+        uno, otro = metricas.Registro(), metricas.Registro()
+        uno.sumar("wexam_consultas_sql_total", 3, modelo="Problema", vista="view_problema")
+        otro.sumar("wexam_consultas_sql_total", 4, modelo="Problema", vista="view_problema")
+        otro.volcar(conexion)
+        serie = 'wexam_consultas_sql_total{modelo="Problema",vista="view_problema"}'
+        assert uno.leer(conexion) == {serie: 7}
+        assert otro.pendientes == uno.pendientes == {}
+
+    def test_conserva_si_redis_falla(self):
+        "Si redis no responde, los incrementos se vuelcan en la siguiente ocasión"
+        servidor = fakeredis.FakeServer()
+        conexion = fakeredis.FakeStrictRedis(server=servidor)
+        registro = metricas.Registro()
+        registro.sumar("wexam_peticiones_total")
+        servidor.connected = False
+        registro.volcar(conexion)
+        assert registro.pendientes == {"wexam_peticiones_total": 1}
+        servidor.connected = True
+        assert registro.leer(conexion) == {"wexam_peticiones_total": 1}
+
+    def test_histograma(self):
+        "Los intervalos son acumulativos"
+        registro = metricas.Registro()
+        registro.observar("wexam_verificacion_clave_segundos", 0.3)
+        registro.observar("wexam_verificacion_clave_segundos", 3)
+        valores = registro.leer(None)
+        def intervalo(limite):
+            return valores.get('wexam_verificacion_clave_segundos_bucket{{le="{}"}}'.format(limite))
+        assert intervalo(0.25) is None
+        assert (intervalo(0.5), intervalo(2.5), intervalo(5), intervalo("+Inf")) == (1, 1, 2, 2)
+        assert valores["wexam_verificacion_clave_segundos_count"] == 2
+        assert valores["wexam_verificacion_clave_segundos_sum"] == pytest.approx(3.3)
+
+
+class TestExposicion:
+    def test_formato(self):
+        registro = metricas.Registro()
+        registro.observar("wexam_peticion_segundos", 0.02, modelo="Examen", vista="v")
+        registro.sumar("wexam_peticiones_total", modelo="Examen", vista="v", metodo="GET",
+                       estado=200)
+        lineas = metricas.exposicion(registro.leer(None)).splitlines()
+        assert lineas[:3] == [
+            "# HELP wexam_peticiones_total Peticiones atendidas, por modelo, vista, "
+            "método y código de estado",
+            "# TYPE wexam_peticiones_total counter",
+            'wexam_peticiones_total{modelo="Examen",vista="v",metodo="GET",estado="200"} 1']
+        assert lineas[4] == "# TYPE wexam_peticion_segundos histogram"
+        limites = [l.split('le="')[1].split('"')[0] for l in lineas if "_bucket" in l]
+        assert limites == ["0.025", "0.05", "0.1", "0.25", "0.5", "1", "2.5", "5", "10", "+Inf"]
+        assert 'wexam_peticion_segundos_sum{modelo="Examen",vista="v"} 0.02' in lineas
+
+    def test_escapa_las_etiquetas(self):
+        assert metricas.serie("x", vista='a"b\\c') == 'x{vista="a\\"b\\\\c"}'
+
+
+class TestMetricas(TestWithRedisLoggedAsAdmin):
+    def test_vistas(self):
+        "Las peticiones se anotan con el modelo y la función de la vista"
+        assert self.c.get("/problema/1").status_code == 200
+        respuesta = self.c.get("/metrics")
+        assert respuesta.content_type == "text/plain"
+        texto = respuesta.text
+        assert ('wexam_peticiones_total{modelo="Problema",vista="view_problema",'
+                'metodo="GET",estado="200"}') in texto
+        assert 'wexam_peticion_segundos_count{modelo="Problema",vista="view_problema"}' in texto
+        assert 'wexam_consultas_sql_total{modelo="Problema",vista="view_problema"}' in texto
+        assert 'wexam_cache_total{cache="tokens",resultado="acierto"}' in texto
+        assert 'wexam_cola_pendientes{cola="json2latex-task",prioridad=' in texto
+
+
+class TestMetricasSinLogin(TestWithMockDatabaseUnlogged):
+    def test_token(self):
+        "Sin JWT, sólo se accede con el token del recolector"
+        config = self.c.app.settings.metricas
+        anterior = config.token
+        config.token = "secreto"
+        try:
+            assert self.c.get("/metrics", expect_errors=True).status_code == 403
+            self.c.authorization = ("Bearer", "otro")
+            assert self.c.get("/metrics", expect_errors=True).status_code == 403
+            self.c.authorization = ("Bearer", "secreto")
+            assert self.c.get("/metrics").status_code == 200
+        finally:
+            config.token = anterior
+            self.c.authorization = None
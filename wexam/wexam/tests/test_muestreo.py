@@ -0,0 +1,88 @@
+"""Test del perfil por muestreo"""
+import threading
+from types import SimpleNamespace
+
+import pytest
+fakeredis = pytest.importorskip("fakeredis")
+
+from test_app import TestWithMockDatabaseLoggedAsProfesor
+from wexam import muestreo
+
+
+def ocupado(parar):
+    "Función que atiende la petición simulada"
+    while not parar.is_set():
+        sum(range(100))
+
+
+def muestrear_hilo(muestreador, veces=3):
+    """Muestrea varias veces un hilo que atiende una petición sin vista"""
+    parar = threading.Event()
+    hilo = threading.Thread(target=ocupado, args=(parar,))
+    hilo.start()
+    muestreador.activas[hilo.ident] = SimpleNamespace()
+    try:
+        for _ in range(veces):
+            muestreador.muestrear()
+    finally:
+        parar.set()
+        hilo.join()
+        del muestreador.activas[hilo.ident]
+
+
+class TestMuestreador:
+    def test_pilas(self):
+        "Las pilas empiezan por la vista y acaban en la función en curso"
+        muestreador = muestreo.Muestreador()
+        muestrear_hilo(muestreador)
+        cuentas = muestreador.leer()
+        assert sum(cuentas.values()) == 3
+        for pila in cuentas:
+            funciones = pila.split(";")
+            assert funciones[0] == "(sin vista)"
+            assert "test_muestreo:ocupado" in funciones
+        assert muestreo.colapsadas(cuentas).endswith(" 3\n")
+
+    def test_max_pilas(self):
+        "Las pilas que no caben se cuentan juntas"
+        muestreador = muestreo.Muestreador(max_pilas=1)
+        muestreador.pendientes = {int(muestreo.time.time() // 3600): muestreo.Counter({"a": 1})}
+        muestrear_hilo(muestreador, veces=2)
+        assert muestreador.leer() == {"a": 1, muestreo.OTRAS: 2}
+
+    def test_ventanas(self):
+        "Sólo se muestran las ventanas pedidas, y las viejas se descartan"
+        muestreador = muestreo.Muestreador(ventana=60, ventanas=3)
+        actual = int(muestreo.time.time() // 60)
+        muestreador.pendientes = {actual - 5: muestreo.Counter({"vieja": 1}),
+                                  actual - 1: muestreo.Counter({"anterior": 1}),
+                                  actual: muestreo.Counter({"actual": 1})}
+        assert muestreador.leer() == {"anterior": 1, "actual": 1}
+        assert muestreador.leer(horas=1 / 60) == {"actual": 1}
+        assert actual - 5 not in muestreador.locales
+
+    def test_suma_los_procesos(self):
+        "Con redis, se muestran las cuentas de todos los procesos"
+        conexion = fakeredis.FakeStrictRedis()
+        uno, otro = muestreo.Muestreador(), muestreo.Muestreador()
+        uno.conexion = otro.conexion = conexion
+        actual = int(muestreo.time.time() // 3600)
+        uno.pendientes = {actual: muestreo.Counter({"a;b": 2})}
+        otro.pendientes = {actual: muestreo.Counter({"a;b": 1, "a;c": 1})}
+        otro.volcar()
+        assert uno.leer() == {"a;b": 3, "a;c": 1}
+        assert 0 < conexion.ttl(muestreo.PREFIJO_MUESTRAS + str(actual)) <= 3600 * 168
+
+
+class TestMuestras(TestWithMockDatabaseLoggedAsProfesor):
+    def test_solo_admin(self):
+        assert self.get_as("/muestras", user="jldiaz", expect_errors=True).status_code == 403
+        respuesta = self.get_as("/muestras?horas=24", user="admin")
+        assert respuesta.content_type == "text/plain"
+
+    def test_hilo_por_proceso(self):
+        "El hilo de muestreo se arranca con la primera petición"
+        self.get_as("/profesores", user="admin")
+        assert muestreo.muestreador.pid == muestreo.os.getpid()
+        assert muestreo.muestreador.tope is not None
+        assert any(hilo.name == "muestreador" for hilo in threading.enumerate())
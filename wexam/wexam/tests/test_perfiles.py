@@ -0,0 +1,39 @@
+"""Test de los perfiles de peticiones bajo demanda"""
+import pstats
+
+from test_app import TestWithMockDatabaseLoggedAsProfesor
+from wexam import perfiles
+
+
+class TestPerfiles(TestWithMockDatabaseLoggedAsProfesor):
+    def test_pstats(self, tmp_path):
+        "Un admin recibe el fichero de pstats en lugar de la respuesta"
+        respuesta = self.get_as("/examen/1/full?perfil=pstats", user="admin")
+        assert respuesta.status_code == 200
+        assert respuesta.headers["X-Estado-Original"] == "200"
+        assert "attachment" in respuesta.headers["Content-Disposition"]
+        fichero = tmp_path / "perfil.pstats"
+        fichero.write_bytes(respuesta.body)
+        funciones = {funcion for _, _, funcion in pstats.Stats(str(fichero)).stats}
+        assert "view_examen_full" in funciones
+
+    def test_texto(self):
+        "También con la cabecera, y como resumen de texto"
+        self.update_jwt_token("admin")
+        respuesta = self.c.get("/examen/1/full", headers={"X-Perfil": "texto"})
+        assert respuesta.content_type == "text/plain"
+        assert "function calls" in respuesta.text
+
+    def test_no_admin(self):
+        "A los demás se les responde normalmente"
+        respuesta = self.get_as("/profesores?perfil=pstats", user="jldiaz")
+        assert respuesta.content_type == "application/json"
+        assert "X-Estado-Original" not in respuesta.headers
+
+    def test_uno_a_la_vez(self):
+        "Mientras se perfila una petición, las demás se rechazan"
+        with perfiles.perfilando:
+            respuesta = self.get_as("/examen/1/full?perfil=pstats", user="admin",
+                                    expect_errors=True)
+        assert respuesta.status_code == 429
+        assert respuesta.headers["Retry-After"] == "1"
@@ -0,0 +1,142 @@
+"""Test del control de admisión y del reparto por turnos de los trabajos"""
+import pytest
+fakeredis = pytest.importorskip("fakeredis")
+import rq
+from rq.job import Job, JobStatus
+
+from pony.orm import db_session
+
+from test_tareas import TestWithRedisLoggedAsAdmin
+from wexam import tareas
+from wexam.model import Examen, Profesor
+from wexam.planificador import Planificador, Saturado
+
+
+def sacar(cola):
+    "Saca de la cola el siguiente trabajo, como haría el worker, o None si está vacía"
+    job_id = cola.connection.lpop(cola.key)
+    return job_id.decode("ascii") if job_id is not None else None
+
+
+def terminar(conexion, job_id):
+    "Marca el trabajo como terminado, como haría el worker"
+    Job.fetch(job_id, connection=conexion).set_status(JobStatus.FINISHED)
+
+
+class TestPlanificador:
+    """Funcionamiento del planificador sobre un redis simulado"""
+    def setup_method(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        self.cola = rq.Queue("pruebas", connection=self.redis)
+
+    def test_reparto_por_turnos(self):
+        "Los trabajos pasan a la cola alternando entre usuarios"
+        planificador = Planificador(self.cola, max_en_curso=10, capacidad=1)
+        propietario = {}
+        for i in range(3):
+            propietario[planificador.encolar(1, "tasks.json2pdf", i)] = 1
+        for i in range(2):
+            propietario[planificador.encolar(2, "tasks.json2pdf", i)] = 2
+        orden = []
+        while True:
+            job_id = sacar(self.cola)
+            if job_id is None:
+                break
+            orden.append(propietario[job_id])
+            terminar(self.redis, job_id)
+            planificador.despachar()
+        # El primero pasa a la cola nada más encolarse; después se alternan
+        assert orden == [1, 1, 2, 1, 2]
+
+    def test_trabajo_en_espera_es_consultable(self):
+        "Mientras espera turno, el trabajo rq existe en estado deferred"
+        planificador = Planificador(self.cola, capacidad=0)
+        job_id = planificador.encolar(1, "tasks.json2pdf", "{}")
+        assert Job.fetch(job_id, connection=self.redis).get_status() == "deferred"
+        assert len(self.cola) == 0
+
+    def test_limite_por_usuario(self):
+        "Al superar el límite se eleva Saturado, hasta que termine algún trabajo"
+        planificador = Planificador(self.cola, max_en_curso=2, capacidad=1, reintentar=7)
+        primero = planificador.encolar(1, "tasks.json2pdf", "a")
+        planificador.encolar(1, "tasks.json2pdf", "b")
+        with pytest.raises(Saturado) as excepcion:
+            planificador.admitir(1)
+        assert excepcion.value.reintentar == 7
+        planificador.admitir(2)
+        terminar(self.redis, primero)
+        planificador.admitir(1)
+
+    def simular(self, planificador):
+        """Un usuario lanza 40 trabajos de golpe y otros cinco lanzan uno cada
+        uno mientras tanto. Un único worker atiende un trabajo por tick. Retorna
+        los ticks que esperó cada trabajo de los usuarios ligeros"""
+        lanzado = {}
+        esperas = []
+        for i in range(40):
+            lanzado[planificador.encolar("pesado", "tasks.json2latex", i)] = None
+        for tick in range(60):
+            if tick % 5 == 0 and tick // 5 < 5:
+                lanzado[planificador.encolar("ligero%d" % tick, "tasks.json2pdf", tick)] = tick
+            planificador.despachar()
+            job_id = sacar(self.cola)
+            if job_id is None:
+                continue
+            if lanzado[job_id] is not None:
+                esperas.append(tick - lanzado[job_id])
+            terminar(self.redis, job_id)
+        assert len(esperas) == 5
+        return esperas
+
+    def test_simulacion_latencia_acotada(self):
+        "Con el reparto por turnos, los usuarios ligeros no esperan al pesado"
+        sin_reparto = self.simular(Planificador(self.cola, max_en_curso=100, capacidad=100))
+        self.redis.flushall()
+        con_reparto = self.simular(Planificador(self.cola, max_en_curso=100, capacidad=1))
+        # Sin reparto, cada ligero espera a todos los trabajos del pesado
+        assert min(sin_reparto) > 20
+        # Con él, sólo al que ya estaba en la cola y al siguiente del pesado
+        assert max(con_reparto) <= 2
+
+
+class TestAdmision(TestWithRedisLoggedAsAdmin):
+    """Las descargas que superan el límite del profesor responden 429"""
+    def test_demasiadas_tareas(self):
+        "Se responde 429 con Retry-After, y se admite de nuevo al terminar"
+        for planificador in self.app.planificadores.values():
+            planificador.max_en_curso = 2
+        self.c.get('/examen/1/download?formato=zip')
+        self.c.get('/examen/1/download?formato=tgz')
+        # El límite es de quien pide la descarga, no del autor del examen
+        planificador = self.app.planificadores[tareas.COLA_LOTES]
+        with db_session:
+            admin = Profesor.get(username="admin").id
+            autor = Examen[1].creador.id
+        assert autor != admin
+        assert planificador.en_curso(admin) == 2
+        assert planificador.en_curso(autor) == 0
+        respuesta = self.c.get('/examen/1/download?formato=pdf', status=429)
+        assert respuesta.headers["Retry-After"] == "10"
+        self.ejecutar_worker()
+        self.c.get('/examen/1/download?formato=pdf')
+        self.ejecutar_worker()
+
+    def test_compartir_trabajo_no_requiere_admision(self):
+        "Quien ya está en el límite puede unirse a un trabajo lanzado por otro"
+        cola = self.app.task_queues[tareas.COLA_LOTES]
+        planificador = self.app.planificadores[tareas.COLA_LOTES]
+        planificador.max_en_curso = 1
+        tareas.encolar(cola, "json2latex", "b", clave="de b", planificador=planificador,
+                       usuario="b")
+        job_id = tareas.encolar(cola, "json2latex", "a", clave="comun",
+                                planificador=planificador, usuario="a")
+        with pytest.raises(Saturado):
+            tareas.encolar(cola, "json2latex", "b", clave="otra", planificador=planificador,
+                           usuario="b")
+        # La marca de la que no se pudo encolar no queda reservada
+        assert self.app.redis.get(tareas.PREFIJO_MARCA + "otra") is None
+        mismo = tareas.encolar(cola, "json2latex", "a", clave="comun",
+                               planificador=planificador, usuario="b")
+        assert mismo == job_id
+        assert planificador.en_curso("b") == 1
+        self.app.redis.flushall()
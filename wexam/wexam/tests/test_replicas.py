@@ -0,0 +1,149 @@
+"""Test del reparto de las peticiones entre la base de datos primaria y la réplica"""
+import sqlite3
+from types import SimpleNamespace
+
+from morepath import Identity, NO_IDENTITY
+import pytest
+
+from wexam import conexiones, replicas
+
+
+class ErrorSoloLectura(Exception):
+    """Como el que eleva psycopg2 al escribir en una transacción de sólo lectura"""
+    pgcode = replicas.SOLO_LECTURA
+
+
+class ErrorPony(Exception):
+    """Como los de pony, que envuelven la excepción original"""
+    def __init__(self, original):
+        super().__init__(str(original))
+        self.original_exc = original
+
+
+def crear_pool():
+    return conexiones.PoolConexiones(
+        lambda: sqlite3.connect(":memory:", check_same_thread=False))
+
+
+@pytest.fixture
+def enrutador():
+    return replicas.PoolEnrutado(crear_pool(), crear_pool())
+
+
+@pytest.fixture(autouse=True)
+def sin_escrituras():
+    replicas.escrituras_locales.clear()
+    yield
+    replicas.escrituras_locales.clear()
+
+
+class TestPoolEnrutado:
+    def test_reparte_las_conexiones(self, enrutador):
+        "Dentro de leyendo_de_replica las conexiones salen del pool de la réplica"
+        primaria, _ = enrutador.connect()
+        with enrutador.leyendo_de_replica():
+            replica, _ = enrutador.connect()
+        enrutador.release(primaria)
+        enrutador.release(replica)
+        assert [c for c, _ in enrutador.primaria.libres] == [primaria]
+        assert [c for c, _ in enrutador.replica.libres] == [replica]
+        with enrutador.leyendo_de_replica():
+            assert enrutador.connect() == (replica, False)
+
+
+class TestEscrituraRechazada:
+    def test_detecta_la_causa(self):
+        "Se reconoce el error de sólo lectura aunque venga envuelto"
+        assert replicas.es_escritura_rechazada(ErrorSoloLectura())
+        assert replicas.es_escritura_rechazada(ErrorPony(ErrorSoloLectura()))
+        commit = Exception("commit")
+        commit.exceptions = [(ErrorPony, ErrorPony(ErrorSoloLectura()), None)]
+        assert replicas.es_escritura_rechazada(commit)
+        try:
+            try:
+                raise ErrorSoloLectura()
+            except ErrorSoloLectura as e:
+                raise RuntimeError("otra") from e
+        except RuntimeError as e:
+            assert replicas.es_escritura_rechazada(e)
+
+    def test_otros_errores(self):
+        assert not replicas.es_escritura_rechazada(ErrorPony(ValueError()))
+
+
+class TestEnrutarLecturas:
+    def preparar(self, enrutador, escribe=False):
+        app = SimpleNamespace(enrutador=enrutador, redis=None,
+                              settings=SimpleNamespace(replica=SimpleNamespace(
+                                  ventana_escritura=60)))
+        destinos = []
+
+        def handler(request):
+            en_replica = getattr(enrutador.local, "replica", False)
+            destinos.append("replica" if en_replica else "primaria")
+            if en_replica and escribe:
+                raise ErrorPony(ErrorSoloLectura())
+            return "ok"
+        return replicas.enrutar_lecturas(app, handler), destinos
+
+    def peticion(self, metodo="GET", identidad=None, ruta="/examen/1"):
+        request = SimpleNamespace(method=metodo, identity=identidad or NO_IDENTITY,
+                                  path_info=ruta, reiniciada=False)
+        request.reset = lambda: setattr(request, "reiniciada", True)
+        return request
+
+    def test_sin_replica(self):
+        "Sin réplica no hay tween"
+        def handler(request):
+            return "ok"
+        app = SimpleNamespace(settings=SimpleNamespace())
+        assert replicas.enrutar_lecturas(app, handler) is handler
+
+    def test_lecturas_a_la_replica(self, enrutador):
+        enrutar, destinos = self.preparar(enrutador)
+        assert enrutar(self.peticion()) == "ok"
+        assert enrutar(self.peticion("POST")) == "ok"
+        assert destinos == ["replica", "primaria"]
+
+    def test_repite_en_la_primaria_si_escribe(self, enrutador):
+        "Un GET que escribe se repite en la primaria, desde el principio"
+        enrutar, destinos = self.preparar(enrutador, escribe=True)
+        request = self.peticion(identidad=Identity("javier@uniovi.es", id=5))
+        assert enrutar(request) == "ok"
+        assert destinos == ["replica", "primaria"]
+        assert request.reiniciada
+
+    def test_get_que_escriben_van_a_la_primaria(self, enrutador):
+        "Las descargas y consultas de tareas no pasan antes por la réplica"
+        enrutar, destinos = self.preparar(enrutador, escribe=True)
+        for ruta in ("/examen/1/download", "/task/abc", "/task/abc/download",
+                     "/task/abc/events"):
+            request = self.peticion(ruta=ruta)
+            assert enrutar(request) == "ok"
+            assert not request.reiniciada
+        assert destinos == ["primaria"] * 4
+        # Los demás GET que escriben se siguen repitiendo en la primaria
+        enrutar(self.peticion(ruta="/examen/1/problemas"))
+        assert destinos[4:] == ["replica", "primaria"]
+
+    def test_lee_lo_que_escribe(self, enrutador):
+        "Tras escribir, las lecturas de ese usuario van a la primaria durante la ventana"
+        enrutar, destinos = self.preparar(enrutador)
+        javier = Identity("javier@uniovi.es", id=5)
+        marco = Identity("marco@uniovi.es", id=2)
+        enrutar(self.peticion("PUT", javier))
+        enrutar(self.peticion("GET", javier))
+        enrutar(self.peticion("GET", marco))
+        assert destinos == ["primaria", "primaria", "replica"]
+        replicas.escrituras_locales[5] = 0      # Ventana vencida
+        enrutar(self.peticion("GET", javier))
+        assert destinos[-1] == "replica"
+
+    def test_marcas_en_redis(self):
+        "Las marcas de escritura se comparten entre procesos a través de redis"
+        fakeredis = pytest.importorskip("fakeredis")
+        app = SimpleNamespace(redis=fakeredis.FakeStrictRedis())
+        replicas.marcar_escritura(app, 5, 60)
+        replicas.escrituras_locales.clear()
+        assert replicas.escritura_reciente(app, 5)
+        assert not replicas.escritura_reciente(app, 2)
@@ -0,0 +1,262 @@
+"""Test de la caché de identidades y la revocación de token"""
+import time
+from types import SimpleNamespace
+
+from morepath import Identity
+from more.jwtauth import JWTIdentityPolicy
+from pony.orm import db_session
+import pytest
+from webtest import TestApp as Client
+
+from test_app import TestWithMockDatabaseUnlogged
+import wexam
+from wexam import claves, model, permissions, sesiones
+
+
+class TestCacheIdentidades:
+    def test_lru_acotada(self):
+        "Al superar el máximo se descarta la entrada usada hace más tiempo"
+        cache = sesiones.CacheIdentidades(max_entradas=2)
+        cache.put("a", None, 1)
+        cache.put("b", None, 2)
+        assert cache.get("a") == 1
+        cache.put("c", None, 3)
+        assert cache.get("b") is None
+        assert cache.get("a") == 1
+        assert cache.get("c") == 3
+        assert len(cache) == 2
+
+    def test_entrada_caduca_con_el_token(self):
+        "Una entrada no sobrevive a la caducidad de su token"
+        cache = sesiones.CacheIdentidades()
+        cache.put("a", time.time() - 1, 1)
+        assert cache.get("a") is None
+        assert len(cache) == 0
+
+
+class TestRevocacion(TestWithMockDatabaseUnlogged):
+    def login(self, email, password="0000"):
+        respuesta = self.c.post_json('/login', {'email': email, 'password': password})
+        return tuple(respuesta.headers['Authorization'].split())
+
+    def cliente(self, autorizacion):
+        cliente = Client(self.c.app)
+        cliente.authorization = autorizacion
+        return cliente
+
+    def test_token_verificado_una_vez(self, monkeypatch):
+        "Las peticiones con un token ya verificado no vuelven a decodificarlo"
+        decodificados = []
+
+        def decode_jwt(politica, token, **kwargs):
+            decodificados.append(token)
+            return JWTIdentityPolicy.decode_jwt(politica, token, **kwargs)
+        monkeypatch.setattr(sesiones.PoliticaJWT, "decode_jwt", decode_jwt)
+        jose = self.cliente(self.login("jldiaz@uniovi.es"))
+        for _ in range(3):
+            assert jose.get('/profesor/1').status_code == 200
+        assert len(decodificados) == 1
+
+    def test_cambio_de_clave_revoca_token(self):
+        "Tras cambiar la clave de un profesor, sus token anteriores no valen"
+        marco = self.cliente(self.login("marco@uniovi.es"))
+        assert marco.get('/profesor/2').status_code == 200
+        admin = self.cliente(self.login("admin@example.com"))
+        admin.put_json('/profesor/2', {"password": "1111"})
+        respuesta = marco.get('/profesor/2', expect_errors=True)
+        assert respuesta.status_code in (401, 403)
+        marco = self.cliente(self.login("marco@uniovi.es", "1111"))
+        assert marco.get('/profesor/2').status_code == 200
+
+    def test_revocacion_comun_a_todos_los_procesos(self):
+        "La versión está en la base de datos, así que vale la que cambió otro proceso"
+        assert getattr(self.c.app, "redis", None) is None
+        arias = self.cliente(self.login("arias@uniovi.es"))
+        assert arias.get('/profesor/4').status_code == 200
+        with db_session:
+            # Como lo haría revocar_tokens en otro proceso
+            model.Profesor[4].version_token += 1
+        assert arias.get('/profesor/4', expect_errors=True).status_code in (401, 403)
+
+    def test_perder_el_rol_de_admin(self):
+        "Un admin al que se le quita el rol pierde sus permisos en la siguiente petición"
+        admin = self.cliente(self.login("admin@example.com"))
+        admin.put_json('/profesor/5', {"role": "admin"})
+        javier = self.cliente(self.login("javier@uniovi.es"))
+        javier.put_json('/profesor/1', {"nombre": "Jose Luis Díaz"})
+        admin.put_json('/profesor/5', {"role": "profesor"})
+        respuesta = javier.put_json('/profesor/1', {"nombre": "Otro"}, expect_errors=True)
+        assert respuesta.status_code in (401, 403)
+        with db_session:
+            assert model.Profesor[1].nombre == "Jose Luis Díaz"
+
+    def test_cambio_de_la_propia_clave_renueva_token(self):
+        "Quien cambia su propia clave recibe un token nuevo que sí es válido"
+        anterior = self.login("joaquin@uniovi.es")
+        joaquin = self.cliente(anterior)
+        respuesta = joaquin.put_json('/profesor/3', {"password": "2222"})
+        nuevo = tuple(respuesta.headers['Authorization'].split())
+        assert nuevo != anterior
+        assert joaquin.get('/profesor/3', expect_errors=True).status_code in (401, 403)
+        assert self.cliente(nuevo).get('/profesor/3').status_code == 200
+
+
+class TestVersionesEnRedis(TestWithMockDatabaseUnlogged):
+    """Con redis, las versiones se leen de él, y si falla no se acepta un
+    token revocado"""
+    def setup_class(self):
+        fakeredis = pytest.importorskip("fakeredis")
+        TestWithMockDatabaseUnlogged.setup_class(self)
+        self.servidor = fakeredis.FakeServer()
+        self.c.app.redis = fakeredis.FakeStrictRedis(server=self.servidor)
+
+    login = TestRevocacion.login
+    cliente = TestRevocacion.cliente
+
+    def test_sin_consultar_la_base_de_datos(self, monkeypatch):
+        "Una vez copiadas en redis, identificar la petición no consulta las versiones"
+        jose = self.cliente(self.login("jldiaz@uniovi.es"))
+        monkeypatch.setattr(sesiones, "versiones_bd", None)
+        assert jose.get('/profesor/1').status_code == 200
+
+    def test_redis_caido_al_leer(self):
+        "Si redis no responde, las versiones se leen de la base de datos"
+        arias = self.cliente(self.login("arias@uniovi.es"))
+        self.servidor.connected = False
+        try:
+            assert arias.get('/profesor/4').status_code == 200
+            # Sólo en la base de datos, que es la referencia
+            sesiones.revocar_tokens(None, 4)
+            assert arias.get('/profesor/4', expect_errors=True).status_code in (401, 403)
+        finally:
+            self.servidor.connected = True
+
+    def test_redis_caido_al_revocar(self):
+        "Si no puede revocar los token, el cambio de clave no se hace"
+        joaquin = self.cliente(self.login("joaquin@uniovi.es"))
+        admin = self.cliente(self.login("admin@example.com"))
+        self.servidor.connected = False
+        try:
+            admin.put_json('/profesor/3', {"password": "3333"}, status=503)
+        finally:
+            self.servidor.connected = True
+        assert joaquin.get('/profesor/3').status_code == 200
+        self.login("joaquin@uniovi.es")
+
+
+class TestRenovacion(TestWithMockDatabaseUnlogged):
+    def login(self, email="javier@uniovi.es"):
+        respuesta = self.c.post_json('/login', {'email': email, 'password': '0000'})
+        return tuple(respuesta.headers['Authorization'].split())
+
+    def token(self, caducado_hace, version=0):
+        "Token de javier firmado por la app, que caducó hace esos segundos"
+        politica = self.c.app.politica_identidad
+        claims = {"sub": "javier@uniovi.es", "nombre": "Javier García", "id": 5,
+                  "role": "profesor", "ver": version,
+                  "exp": int(time.time()) - caducado_hace}
+        return ("JWT", politica.encode_jwt(claims))
+
+    def renovar(self, autorizacion, **kwargs):
+        self.c.authorization = autorizacion
+        try:
+            return self.c.post('/login/refresh', **kwargs)
+        finally:
+            self.c.authorization = None
+
+    def test_renueva_token_valido(self, monkeypatch):
+        "Un token válido se cambia por otro sin verificar la clave"
+        anterior = self.login()
+        monkeypatch.setattr(claves, "verificar", None)
+        respuesta = self.renovar(anterior)
+        nuevo = tuple(respuesta.headers['Authorization'].split())
+        assert respuesta.json == " ".join(nuevo)
+        self.c.authorization = nuevo
+        try:
+            assert self.c.get('/profesor/5').status_code == 200
+        finally:
+            self.c.authorization = None
+
+    def test_renueva_token_caducado_hace_poco(self):
+        "Dentro de la ventana de renovación, un token caducado aún se renueva"
+        autorizacion = self.token(caducado_hace=3600)
+        self.c.authorization = autorizacion
+        try:
+            assert self.c.get('/profesor/5', expect_errors=True).status_code in (401, 403)
+        finally:
+            self.c.authorization = None
+        assert self.renovar(autorizacion).status_code == 200
+
+    def test_no_renueva_fuera_de_la_ventana(self):
+        "Un token caducado hace más de la ventana requiere identificarse de nuevo"
+        ventana = self.c.app.politica_identidad.ventana_renovacion
+        self.renovar(self.token(caducado_hace=ventana + 60), status=401)
+
+    def test_no_renueva_token_revocado(self):
+        "Tras revocar los token del profesor no pueden renovarse"
+        autorizacion = self.login()
+        sesiones.revocar_tokens(self.c.app, 5)
+        self.renovar(autorizacion, status=401)
+
+    def test_no_renueva_token_ajeno(self):
+        "Un token no firmado por la app no se renueva"
+        self.renovar(("JWT", "no.es.un.token"), status=401)
+
+
+class TestClaims(TestWithMockDatabaseUnlogged):
+    def login(self, email):
+        respuesta = self.c.post_json('/login', {'email': email, 'password': '0000'})
+        cliente = Client(self.c.app)
+        cliente.authorization = tuple(respuesta.headers['Authorization'].split())
+        return cliente
+
+    def identidad(self, cliente):
+        token = cliente.authorization[1]
+        return self.c.app.politica_identidad.verificar_token(token)[0]
+
+    def test_permisos_sin_base_de_datos(self):
+        "Rol y propiedad se deciden con el token, fuera de cualquier db_session"
+        admin = Identity("admin@example.com", id=6, role="admin")
+        arias = Identity("arias@uniovi.es", id=4, role="profesor", circulos=[])
+        objeto = SimpleNamespace(creador=SimpleNamespace(id=4))
+        assert permissions.verificar_admin(admin, None, None)
+        assert not permissions.verificar_admin(arias, None, None)
+        assert permissions.verificar_registrado(arias, None, None)
+        assert permissions.verificar_propietario(arias, objeto, None)
+        assert permissions.verificar_propietario(admin, objeto, None)
+        objeto.creador.id = 1
+        assert not permissions.verificar_propietario(arias, objeto, None)
+
+    def test_token_incluye_rol_y_circulos(self):
+        "El token lleva el rol y los círculos a que pertenece el profesor"
+        identidad = self.identidad(self.login("joaquin@uniovi.es"))
+        assert identidad.role == "profesor"
+        with db_session:
+            esperados = sorted(c.id for c in model.Profesor[3].circulos_en_que_esta)
+        assert identidad.circulos == esperados and esperados
+
+    def test_cambio_de_circulos(self):
+        "Al cambiar los miembros de un círculo no se confía en los del token"
+        jose = self.login("jldiaz@uniovi.es")
+        problema = jose.post_json("/problemas", {
+            'cuestiones': [{'enunciado': 'foo', 'respuesta': 'bar'}],
+            'enunciado': 'Enunciado de prueba',
+            'resumen': "Resumen",
+            'tags': ["foo"]
+        }).json["id"]
+        circulo = jose.post_json("/circulos", {"nombre": "Claims"}).json["id"]
+        jose.post("/circulo/{}/id_problemas?problema={}".format(circulo, problema))
+        javier = self.login("javier@uniovi.es")
+        ruta = "/problema/{}".format(problema)
+        assert javier.get(ruta, expect_errors=True).status_code == 403
+
+        jose.post("/circulo/{}/id_miembros?miembro=5".format(circulo))
+        # El mismo token sigue valiendo, y sus círculos se consultan a la BD
+        assert javier.get(ruta).status_code == 200
+        renovado = javier.post('/login/refresh')
+        javier.authorization = tuple(renovado.headers['Authorization'].split())
+        assert circulo in self.identidad(javier).circulos
+        assert javier.get(ruta).status_code == 200
+
+        jose.delete("/circulo/{}/id_miembros?miembro=5".format(circulo))
+        assert javier.get(ruta, expect_errors=True).status_code == 403
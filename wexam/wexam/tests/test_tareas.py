@@ -0,0 +1,547 @@
+"""Test de las tareas de compilación, usando un redis simulado (fakeredis)
+y un worker rq que se ejecuta en el mismo proceso"""
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+
+import pytest
+import yaml
+fakeredis = pytest.importorskip("fakeredis")
+import rq
+import rq.timeouts
+from pony.orm import db_session
+
+from test_app import TestWithMockDatabaseLoggedAsAdmin
+from wexam.model import Tarea
+from wexam.cache import CacheCompilacion
+from wexam import tareas
+from wexam.planificador import crear_planificadores
+from wexam.ejecutores import BackendRQ
+
+
+class WorkerNotificador(rq.SimpleWorker):
+    """Worker que, como el del servicio de compilación, publica el fin de
+    cada trabajo en su canal de notificaciones. Puede ejecutarse fuera del
+    hilo principal, pues no usa señales"""
+    death_penalty_class = rq.timeouts.TimerDeathPenalty
+
+    def _install_signal_handlers(self):
+        pass
+
+    def handle_job_success(self, job, *args, **kwargs):
+        super().handle_job_success(job, *args, **kwargs)
+        tareas.notificar(self.connection, job.id, status="finished")
+
+
+class TestWithRedisLoggedAsAdmin(TestWithMockDatabaseLoggedAsAdmin):
+    """Las clases que hereden de esta tienen una app conectada a un redis
+    simulado y una caché de compilación en una carpeta temporal"""
+    def setup_class(self):
+        TestWithMockDatabaseLoggedAsAdmin.setup_class(self)
+        self.app = self.c.app
+        self.app.redis = fakeredis.FakeStrictRedis()
+        self.app.task_queues = tareas.crear_colas(self.app.redis, None)
+        self.app.task_queue = self.app.task_queues[tareas.COLA_LOTES]
+        self.app.planificadores = crear_planificadores(self.app.task_queues, None)
+        self.app.tareas = BackendRQ(self.app)
+        self.carpeta = tempfile.mkdtemp()
+        self.app.cache = CacheCompilacion(self.carpeta, 10**6)
+
+    def teardown_class(self):
+        TestWithMockDatabaseLoggedAsAdmin.teardown_class(self)
+        shutil.rmtree(self.carpeta)
+
+    def pendientes(self):
+        "Número de trabajos encolados entre todas las colas"
+        return sum(len(cola) for cola in self.app.task_queues.values())
+
+    def ejecutar_worker(self, retraso=0):
+        """Procesa todos los trabajos encolados, como haría el servicio de compilación.
+        Si se especifica un retraso, lo hace en otro hilo pasados esos segundos"""
+        colas = [self.app.task_queues[prioridad] for prioridad in
+                 (tareas.COLA_INTERACTIVA, tareas.COLA_LOTES, tareas.COLA_MANTENIMIENTO)]
+        worker = WorkerNotificador(colas, connection=self.app.redis)
+        if not retraso:
+            worker.work(burst=True)
+            return None
+        def trabajar():
+            time.sleep(retraso)
+            worker.work(burst=True)
+        hilo = threading.Thread(target=trabajar)
+        hilo.start()
+        return hilo
+
+
+class TestCacheCompilacion(TestWithRedisLoggedAsAdmin):
+    """Peticiones de descarga idénticas no deben lanzar nuevas compilaciones"""
+    def test_descarga_repetida_reutiliza_tarea_en_curso(self):
+        "Mientras la compilación está pendiente, se retorna la misma tarea"
+        primera = self.c.get('/examen/1/download?formato=zip')
+        segunda = self.c.get('/examen/1/download?formato=zip')
+        assert primera.json["status"] == "Procesando"
+        assert segunda.json["link"] == primera.json["link"]
+        assert self.pendientes() == 1
+
+    def test_descarga_repetida_usa_cache(self):
+        "Una vez compilado, el resultado se sirve desde la caché"
+        respuesta = self.c.get('/examen/1/download?formato=pdf')
+        self.ejecutar_worker()
+        estado = self.c.get(respuesta.json["link"])
+        assert estado.json["status"] == "Completada"
+        original = self.c.get(estado.json["link"])
+        assert original.body.startswith(b"%PDF examen 1")
+
+        respuesta = self.c.get('/examen/1/download?formato=pdf')
+        assert respuesta.json["status"] == "Completada"
+        assert self.pendientes() == 0
+        resultado = self.c.get('/examen/1/download?formato=pdf&sync=1')
+        assert resultado.body == original.body
+
+    def test_otra_variante_no_comparte_cache(self):
+        "Cambiar el modo de resolución supone una compilación distinta"
+        respuesta = self.c.get('/examen/1/download?formato=pdf&resuelto=si')
+        assert respuesta.json["status"] == "Procesando"
+        assert self.pendientes() == 1
+        self.ejecutar_worker()
+
+    def test_tareas_distintas_comparten_trabajo(self):
+        "Una Tarea nueva para lo que ya se está compilando se asocia al mismo trabajo"
+        primera = self.c.get('/examen/2/download?formato=tgz')
+        # Al borrar la Tarea, la siguiente petición ya no la encuentra, pero el
+        # trabajo sigue en curso y se comparte en lugar de encolar otro
+        with db_session():
+            Tarea.get(id=primera.json["link"].split("/")[-1]).delete()
+        segunda = self.c.get('/examen/2/download?formato=tgz')
+        assert segunda.json["link"] != primera.json["link"]
+        assert self.pendientes() == 1
+        self.ejecutar_worker()
+        estado = self.c.get(segunda.json["link"])
+        assert estado.json["status"] == "Completada"
+
+    def test_resultado_purgado_se_compila_de_nuevo(self):
+        "Si la caché purgó el resultado y el trabajo expiró, no se reutiliza la tarea"
+        respuesta = self.c.get('/examen/2/download?formato=pdf&resuelto=explicado')
+        self.ejecutar_worker()
+        link = respuesta.json["link"]
+        assert self.c.get(link).json["status"] == "Completada"
+        with db_session():
+            tarea = Tarea.get(id=link.split("/")[-1])
+            os.remove(tarea.fichero)
+            rq.job.Job.fetch(tarea.trabajo, connection=self.app.redis).delete()
+        assert self.c.get(link + "/download", status=404).json["debug"]
+        respuesta = self.c.get('/examen/2/download?formato=pdf&resuelto=explicado')
+        assert respuesta.json["status"] == "Procesando"
+        assert respuesta.json["link"] != link
+        assert self.pendientes() == 1
+        hilo = self.ejecutar_worker(retraso=0.5)
+        resultado = self.c.get('/examen/2/download?formato=pdf&resuelto=explicado&sync=1')
+        hilo.join()
+        assert resultado.body == b"%PDF examen 2 explicado"
+
+    def test_purga_respeta_tamaño_maximo(self):
+        "La caché elimina los resultados menos usados al superar su tamaño"
+        cache = CacheCompilacion(self.carpeta + "/purga", 25)
+        cache.put("a", "pdf", b"x" * 10)
+        cache.put("b", "pdf", b"x" * 10)
+        os.utime(cache.ruta("a", "pdf"), (100, 100))
+        os.utime(cache.ruta("b", "pdf"), (200, 200))
+        cache.usar(cache.get("a", "pdf"))
+        cache.put("c", "pdf", b"x" * 10)
+        assert cache.get("b", "pdf") is None
+        assert cache.leer("c", "pdf") == b"x" * 10
+
+
+class TestDescargaSincrona(TestWithRedisLoggedAsAdmin):
+    """Las descargas con sync=1 esperan a la notificación de fin del trabajo"""
+    def test_espera_despierta_con_la_notificacion(self):
+        "La respuesta llega en cuanto el worker notifica, sin esperar al sondeo"
+        intervalo = tareas.INTERVALO_CONSULTA
+        tareas.INTERVALO_CONSULTA = 30
+        try:
+            hilo = self.ejecutar_worker(retraso=0.5)
+            inicio = time.monotonic()
+            respuesta = self.c.get('/examen/1/download?formato=pdf&sync=1')
+            duracion = time.monotonic() - inicio
+            hilo.join()
+        finally:
+            tareas.INTERVALO_CONSULTA = intervalo
+        assert respuesta.body.startswith(b"%PDF examen 1")
+        assert duracion < 5
+
+    def test_demasiadas_esperas_responde_asincrono(self):
+        "Si ya hay demasiados hilos esperando, no se bloquea otro"
+        self.app.bloqueos = threading.BoundedSemaphore(1)
+        self.app.bloqueos.acquire()
+        try:
+            respuesta = self.c.get('/examen/1/download?formato=zip&resuelto=si&sync=1')
+        finally:
+            self.app.bloqueos.release()
+            self.app.bloqueos = None
+        assert respuesta.json["status"] == "Procesando"
+        self.ejecutar_worker()
+
+
+def test_bloqueos_dejan_hilos_libres():
+    "Con la configuración por defecto, las esperas no ocupan todos los hilos de uwsgi"
+    with open("lanzar-uwsgi.sh") as script:
+        hilos = int(re.search(r"--threads (\d+)", script.read()).group(1))
+    for nombre in ("default", "amazon-ec2"):
+        with open("settings/{}.yaml".format(nombre)) as config:
+            assert yaml.safe_load(config)["tareas"]["max_bloqueos"] < hilos
+
+
+class TestTrabajosCompartidos:
+    """Peticiones idénticas concurrentes comparten un único trabajo rq"""
+    def setup_method(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        self.cola = rq.Queue('json2latex-task', connection=self.redis)
+
+    def test_misma_clave_comparte_trabajo(self):
+        "Mientras el trabajo está pendiente, la misma clave no encola otro"
+        primero = tareas.encolar(self.cola, "json2pdf", clave="abc",
+                                 data='{"id": 1, "resuelto": "noresuelto"}', formato="pdf")
+        segundo = tareas.encolar(self.cola, "json2pdf", clave="abc",
+                                 data='{"id": 1, "resuelto": "noresuelto"}', formato="pdf")
+        assert primero == segundo
+        assert len(self.cola) == 1
+
+    def test_distinta_clave_no_comparte_trabajo(self):
+        "Claves distintas generan trabajos distintos"
+        primero = tareas.encolar(self.cola, "json2pdf", clave="abc", data="{}")
+        segundo = tareas.encolar(self.cola, "json2pdf", clave="def", data="{}")
+        assert primero != segundo
+        assert len(self.cola) == 2
+
+    def test_trabajo_fallido_no_se_comparte(self):
+        "Si el trabajo con esa clave falló, se encola uno nuevo"
+        primero = tareas.encolar(self.cola, "json2pdf", clave="abc", data="no es json")
+        rq.SimpleWorker([self.cola], connection=self.redis).work(burst=True)
+        segundo = tareas.encolar(self.cola, "json2pdf", clave="abc",
+                                 data='{"id": 1, "resuelto": "noresuelto"}')
+        assert primero != segundo
+        assert len(self.cola) == 1
+
+
+class TestEventosTarea(TestWithRedisLoggedAsAdmin):
+    """/task/{id}/events envía el progreso de la tarea según cambia"""
+    def estados(self, respuesta):
+        return [json.loads(linea[len("data: "):])
+                for linea in respuesta.text.splitlines() if linea.startswith("data: ")]
+
+    def test_eventos_hasta_completar(self):
+        "Se envía el progreso y el flujo termina con el estado final"
+        respuesta = self.c.get('/examen/1/download?formato=pdf')
+        hilo = self.ejecutar_worker(retraso=0.5)
+        eventos = self.c.get(respuesta.json["link"] + "/events")
+        hilo.join()
+        assert eventos.content_type == "text/event-stream"
+        estados = self.estados(eventos)
+        assert [e["status"] for e in estados] == ["Esperando", "Compilando", "Completada"]
+        assert self.c.get(estados[-1]["link"]).body.startswith(b"%PDF examen 1")
+
+    def test_tarea_completada_un_solo_evento(self):
+        "Si la tarea ya ha terminado, se envía sólo su estado"
+        respuesta = self.c.get('/examen/1/download?formato=pdf&resuelto=si')
+        self.ejecutar_worker()
+        estados = self.estados(self.c.get(respuesta.json["link"] + "/events"))
+        assert len(estados) == 1
+        assert estados[0]["status"] == "Completada"
+
+    def test_demasiados_flujos_pide_reconectar(self):
+        "Si se supera el máximo de hilos bloqueados, el cliente debe reconectar"
+        respuesta = self.c.get('/examen/2/download?formato=pdf')
+        self.app.bloqueos = threading.BoundedSemaphore(1)
+        self.app.bloqueos.acquire()
+        try:
+            eventos = self.c.get(respuesta.json["link"] + "/events")
+        finally:
+            self.app.bloqueos.release()
+            self.app.bloqueos = None
+        assert eventos.text.startswith("retry: ")
+        assert [e["status"] for e in self.estados(eventos)] == ["Esperando"]
+        self.ejecutar_worker()
+
+
+class EnvoltorioFichero:
+    """Imita el wsgi.file_wrapper de uwsgi, anotando los ficheros que envía"""
+    enviados = []
+
+    def __init__(self, fichero, bloque):
+        self.fichero = fichero
+        EnvoltorioFichero.enviados.append(fichero.name)
+
+    def __iter__(self):
+        return iter(lambda: self.fichero.read(4096), b"")
+
+    def close(self):
+        self.fichero.close()
+
+
+class TestDescargaFichero(TestWithRedisLoggedAsAdmin):
+    """El resultado se escribe en el almacén de artefactos y se envía desde allí"""
+    def compilar(self, url):
+        respuesta = self.c.get(url)
+        self.ejecutar_worker()
+        return self.c.get(respuesta.json["link"]).json
+
+    def trabajo(self, estado):
+        with db_session():
+            tarea = Tarea.get(id=estado["link"].split("/")[-2])
+            return tarea, rq.job.Job.fetch(tarea.trabajo, connection=self.app.redis)
+
+    def test_resultado_por_redis(self):
+        "Sin almacén compartido, el worker retorna el contenido y el servidor lo guarda"
+        estado = self.compilar('/examen/1/download?formato=tgz&resuelto=si')
+        tarea, job = self.trabajo(estado)
+        assert "destino" not in job.kwargs
+        assert job.result == b"tgz examen 1 resuelto"
+        assert os.path.dirname(tarea.fichero) == self.carpeta
+
+    def test_resultado_no_pasa_por_redis(self):
+        "Con almacén compartido, el worker escribe el fichero y la tarea guarda su ruta y tamaño"
+        self.app.cache.compartida = True
+        try:
+            estado = self.compilar('/examen/1/download?formato=zip')
+        finally:
+            self.app.cache.compartida = False
+        assert estado["bytes"] == len(b"zip examen 1 noresuelto")
+        tarea, job = self.trabajo(estado)
+        assert job.result == tarea.fichero
+        assert os.path.dirname(tarea.fichero) == self.carpeta
+        # Si se purga, la ruta que retornó el worker no se envía como contenido
+        os.remove(tarea.fichero)
+        assert self.c.get(estado["link"], status=404).json["debug"]
+
+    def test_consultar_no_cuenta_como_uso(self):
+        "Sondear el estado no renueva el resultado para la purga; descargarlo sí"
+        estado = self.compilar('/examen/2/download?formato=tgz')
+        tarea, _ = self.trabajo(estado)
+        os.utime(tarea.fichero, (100, 100))
+        self.c.get(estado["link"].rsplit("/", 1)[0])
+        self.c.get('/examen/2/download?formato=tgz')
+        assert os.path.getmtime(tarea.fichero) == 100
+        self.c.get(estado["link"])
+        assert os.path.getmtime(tarea.fichero) > 100
+
+    def test_descarga_con_file_wrapper(self):
+        "Si el servidor ofrece wsgi.file_wrapper, el fichero se le entrega a él"
+        estado = self.compilar('/examen/2/download?formato=pdf')
+        EnvoltorioFichero.enviados.clear()
+        descarga = self.c.get(estado["link"],
+                              extra_environ={"wsgi.file_wrapper": EnvoltorioFichero})
+        assert descarga.body == b"%PDF examen 2 noresuelto"
+        assert descarga.content_length == len(descarga.body)
+        assert descarga.headers["Accept-Ranges"] == "bytes"
+        assert len(EnvoltorioFichero.enviados) == 1
+
+    def test_descarga_parcial(self):
+        "Se atienden las peticiones Range, para reanudar descargas"
+        estado = self.compilar('/examen/2/download?formato=tgz')
+        completa = self.c.get(estado["link"])
+        parcial = self.c.get(estado["link"], headers={"Range": "bytes=4-9"}, status=206)
+        assert parcial.body == completa.body[4:10]
+        assert parcial.headers["Content-Range"] == "bytes 4-9/{}".format(len(completa.body))
+
+    def test_resultado_en_redis_se_guarda_en_el_almacen(self):
+        "Si el worker retorna el contenido en vez de escribirlo, se guarda en el almacén"
+        cache, self.app.cache = self.app.cache, None
+        try:
+            respuesta = self.c.get('/examen/1/download?formato=pdf&resuelto=si')
+        finally:
+            self.app.cache = cache
+        self.ejecutar_worker()
+        estado = self.c.get(respuesta.json["link"]).json
+        assert estado["bytes"] == len(b"%PDF examen 1 resuelto")
+        assert self.c.get(estado["link"]).body == b"%PDF examen 1 resuelto"
+
+
+class TestColasPrioridad(TestWithRedisLoggedAsAdmin):
+    """Las compilaciones se reparten en colas según su prioridad"""
+    def cola(self, prioridad):
+        return self.app.task_queues[prioridad]
+
+    def test_reparto_por_formato_y_sync(self):
+        "Los PDF van a la cola interactiva y las exportaciones a la de lotes"
+        self.c.get('/examen/1/download?formato=pdf')
+        self.c.get('/examen/1/download?formato=zip')
+        assert len(self.cola(tareas.COLA_INTERACTIVA)) == 1
+        assert len(self.cola(tareas.COLA_LOTES)) == 1
+        self.ejecutar_worker()
+
+    def test_espera_sincrona_promueve_trabajo(self):
+        "Un trabajo de lotes pasa a la cola interactiva si alguien lo espera"
+        self.c.get('/examen/2/download?formato=zip')
+        assert len(self.cola(tareas.COLA_LOTES)) == 1
+        hilo = self.ejecutar_worker(retraso=0.5)
+        respuesta = self.c.get('/examen/2/download?formato=zip&sync=1')
+        hilo.join()
+        assert respuesta.body == b"zip examen 2 noresuelto"
+        assert len(self.cola(tareas.COLA_LOTES)) == 0
+
+    def test_promover_trabajo_pendiente(self):
+        "Sólo se mueven los trabajos que siguen en la cola"
+        job_id = tareas.encolar(self.cola(tareas.COLA_LOTES), "json2latex", clave="x",
+                                data='{"id": 1, "resuelto": "noresuelto"}', formato="zip")
+        mismo = tareas.encolar(self.cola(tareas.COLA_INTERACTIVA), "json2latex", clave="x",
+                               promocionar=True,
+                               data='{"id": 1, "resuelto": "noresuelto"}', formato="zip")
+        assert mismo == job_id
+        assert self.cola(tareas.COLA_INTERACTIVA).job_ids == [job_id]
+        assert len(self.cola(tareas.COLA_LOTES)) == 0
+        self.ejecutar_worker()
+
+    def test_estadisticas_colas(self):
+        "/colas informa de los trabajos pendientes y de su espera"
+        self.c.get('/examen/1/download?formato=tgz')
+        colas = self.c.get('/colas').json
+        assert colas[tareas.COLA_LOTES]["pendientes"] == 1
+        assert colas[tareas.COLA_LOTES]["espera"] >= 0
+        assert colas[tareas.COLA_INTERACTIVA]["pendientes"] == 0
+        assert colas[tareas.COLA_MANTENIMIENTO]["nombre"] == "wexam-maintenance"
+        self.ejecutar_worker()
+
+
+class TestPrecompilacion(TestWithRedisLoggedAsAdmin):
+    """Al cerrar o publicar un examen se precompilan sus descargas (sección
+    precompilacion de la configuración: PDF sin resolver y resuelto)"""
+    def cola(self, prioridad):
+        return self.app.task_queues[prioridad]
+
+    def test_cerrar_examen_precompila_variantes(self):
+        "Las variantes configuradas se compilan en la cola de mantenimiento"
+        respuesta = self.c.put_json('/examen/1', {"estado": "cerrado"})
+        assert respuesta.json["estado"] == "cerrado"
+        assert len(self.cola(tareas.COLA_MANTENIMIENTO)) == 2
+        assert len(self.cola(tareas.COLA_INTERACTIVA)) == 0
+        self.ejecutar_worker()
+        for resuelto in ("no", "si"):
+            descarga = self.c.get('/examen/1/download?formato=pdf&resuelto=' + resuelto)
+            assert descarga.json["status"] == "Completada"
+        assert self.pendientes() == 0
+
+    def test_descarga_promueve_precompilacion(self):
+        "Si alguien pide un PDF que aún se está precompilando, pasa a la cola interactiva"
+        self.c.put_json('/examen/2', {"estado": "abierto"})
+        self.c.put_json('/examen/2', {"estado": "cerrado"})
+        assert len(self.cola(tareas.COLA_MANTENIMIENTO)) == 2
+        respuesta = self.c.get('/examen/2/download?formato=pdf&resuelto=si')
+        assert respuesta.json["status"] == "Procesando"
+        assert len(self.cola(tareas.COLA_INTERACTIVA)) == 1
+        assert len(self.cola(tareas.COLA_MANTENIMIENTO)) == 1
+        self.ejecutar_worker()
+
+    def test_descarga_promueve_precompilacion_en_espera(self):
+        "También pasa a la cola interactiva si aún espera su turno en el planificador"
+        # Sin los resultados de los tests anteriores, que podrían coincidir
+        self.app.redis.flushall()
+        self.app.cache = CacheCompilacion(tempfile.mkdtemp(dir=self.carpeta), 10**6)
+        planificador = self.app.planificadores[tareas.COLA_MANTENIMIENTO]
+        planificador.capacidad = 0
+        self.c.put_json('/examen/2', {"estado": "abierto"})
+        self.c.put_json('/examen/2', {"estado": "cerrado"})
+        assert len(self.cola(tareas.COLA_MANTENIMIENTO)) == 0
+        respuesta = self.c.get('/examen/2/download?formato=pdf&resuelto=si')
+        assert respuesta.json["status"] == "Procesando"
+        assert len(self.cola(tareas.COLA_INTERACTIVA)) == 1
+        # Ya no espera en el planificador, por lo que no se despachará dos
+        # veces. Sólo queda el otro PDF
+        promovido = self.cola(tareas.COLA_INTERACTIVA).job_ids[0]
+        otro = planificador.siguiente()
+        assert otro not in (None, promovido)
+        assert planificador.siguiente() is None
+        self.cola(tareas.COLA_MANTENIMIENTO).enqueue_job(self.app.tareas.trabajo(otro))
+        self.ejecutar_worker()
+        assert self.pendientes() == 0
+        descarga = self.c.get('/examen/2/download?formato=pdf&resuelto=si')
+        assert descarga.json["status"] == "Completada"
+
+    def test_precompilacion_no_cuenta_para_el_limite(self):
+        "Los trabajos precompilados no ocupan los huecos del profesor"
+        creador = self.c.get('/examen/2').json["creador"]["id"]
+        self.c.put_json('/examen/2', {"estado": "publicado"})
+        assert self.app.planificadores[tareas.COLA_MANTENIMIENTO].en_curso(creador) == 0
+        self.ejecutar_worker()
+
+
+class TestVariantes(TestWithRedisLoggedAsAdmin):
+    """Varias variantes del examen se compilan en un único trabajo"""
+    def test_variantes_en_un_solo_archivo(self):
+        "Un solo trabajo produce un archivo con una carpeta por variante"
+        url = '/examen/1/download?formato=zip&variantes=explicado,no,resuelto'
+        respuesta = self.c.get(url)
+        assert respuesta.json["status"] == "Procesando"
+        assert self.pendientes() == 1
+        self.ejecutar_worker()
+        descarga = self.c.get(self.c.get(respuesta.json["link"]).json["link"])
+        with zipfile.ZipFile(io.BytesIO(descarga.body)) as archivo:
+            assert archivo.namelist() == ["noresuelto/examen.tex", "resuelto/examen.tex",
+                                          "explicado/examen.tex"]
+            assert archivo.read("explicado/examen.tex") == b"examen 1 explicado"
+
+    def test_misma_seleccion_comparte_resultado(self):
+        "El orden en que se piden las variantes no cambia la compilación"
+        url = '/examen/1/download?formato=zip&variantes=resuelto,explicado,noresuelto'
+        assert self.c.get(url).json["status"] == "Completada"
+        assert self.pendientes() == 0
+
+    def test_una_variante_equivale_a_resuelto(self):
+        "Con una sola variante se compila como la descarga normal"
+        self.c.get('/examen/1/download?formato=tgz&variantes=explicado')
+        assert self.pendientes() == 1
+        self.ejecutar_worker()
+        descarga = self.c.get('/examen/1/download?formato=tgz&resuelto=explicado&sync=1')
+        assert descarga.body == b"tgz examen 1 explicado"
+
+    def test_variantes_requieren_archivo(self):
+        "Varias variantes no pueden descargarse como un único PDF"
+        respuesta = self.c.get('/examen/1/download?formato=pdf&variantes=no,si',
+                               status=422)
+        assert "zip o tgz" in respuesta.json["debug"]
+
+    def test_variantes_desconocidas(self):
+        "Las variantes que no existen se rechazan, en lugar de tomarse por noresuelto"
+        respuesta = self.c.get('/examen/1/download?formato=zip&variantes=no,resulto',
+                               status=422)
+        assert "Variantes no válidas: resulto" in respuesta.json["debug"]
+        respuesta = self.c.get('/examen/1/download?formato=pdf&variantes=Explicada',
+                               status=422)
+        assert "explicada" in respuesta.json["debug"].lower()
+        assert self.pendientes() == 0
+
+
+class TestEstadoTareas(TestWithRedisLoggedAsAdmin):
+    """/profesor/{id}/tareas informa de todas las tareas de una vez"""
+    def test_estado_de_todas_las_tareas(self):
+        "Se consultan todos los trabajos juntos y se borran las tareas caducadas"
+        creador = self.c.get('/examen/1').json["creador"]["id"]
+        self.c.get('/examen/1/download?formato=pdf')
+        self.c.get('/examen/1/download?formato=zip')
+        self.ejecutar_worker()
+        self.c.get('/examen/1/download?formato=pdf&resuelto=si')
+        with db_session():
+            Tarea(id="caducada", nombre="json2pdf", tipo="pdf", creador=creador,
+                  trabajo="no-existe")
+
+        def prohibido(job_id):
+            raise AssertionError("Cada trabajo no debe consultarse por separado")
+        self.app.tareas.trabajo = prohibido
+        try:
+            estados = self.c.get('/profesor/{}/tareas'.format(creador)).json
+        finally:
+            del self.app.tareas.trabajo
+        por_estado = sorted(e["status"] for e in estados)
+        assert por_estado == ["Borrada", "Completada", "Completada", "Esperando"]
+        for estado in estados:
+            if estado["status"] == "Completada":
+                assert self.c.get(estado["download"]).body
+            elif estado["status"] == "Borrada":
+                assert "link" not in estado
+        with db_session():
+            assert Tarea.get(id="caducada") is None
+        self.ejecutar_worker()
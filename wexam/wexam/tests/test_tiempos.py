@@ -0,0 +1,109 @@
+"""Test de la medida de las peticiones (consultas, redis y cabecera Server-Timing)"""
+import json
+from types import SimpleNamespace
+
+from morepath import Identity, NO_IDENTITY
+from pony.orm import db_session
+from webob import Response
+import yaml
+
+from test_app import TestWithMockDatabaseLoggedAsAdmin, TestWithMockDatabaseUnlogged
+from wexam import model, tiempos
+
+
+def crear_tween(cabecera="admins", umbral_tiempo=60, umbral_consultas=50, problemas=1):
+    """Tween sobre una vista que carga el creador de varios problemas uno a
+    uno (un N+1) y habla una vez con redis"""
+    config = SimpleNamespace(cabecera=cabecera, umbral_tiempo=umbral_tiempo,
+                             umbral_consultas=umbral_consultas)
+    app = SimpleNamespace(settings=SimpleNamespace(tiempos=config))
+
+    def handler(request):
+        with db_session:
+            for id_problema in range(1, problemas + 1):
+                model.Problema.get(id=id_problema).creador.email
+        tiempos.anotar_redis(0.002, llamada=True)
+        return Response("ok")
+    return tiempos.medir_peticion(app, handler)
+
+
+def peticion(identidad=NO_IDENTITY):
+    return SimpleNamespace(method="GET", path="/problems", identity=identidad)
+
+
+ADMIN = Identity("admin@example.com", id=6, role="admin")
+PROFESOR = Identity("javier@uniovi.es", id=5, role="profesor")
+
+
+class TestMedirPeticion(TestWithMockDatabaseUnlogged):
+    def test_sin_configuracion(self):
+        "Sin sección tiempos no hay tween"
+        def handler(request):
+            return Response("ok")
+        app = SimpleNamespace(settings=SimpleNamespace())
+        assert tiempos.medir_peticion(app, handler) is handler
+
+    def test_cabecera_para_admins(self):
+        medir = crear_tween()
+        cabecera = medir(peticion(ADMIN)).headers["Server-Timing"]
+        partes = [p.split(";")[0] for p in cabecera.split(", ")]
+        assert partes == ["sql", "redis", "app", "total"]
+        assert 'desc="1 llamadas"' in cabecera
+        assert "Server-Timing" not in medir(peticion(PROFESOR)).headers
+        assert "Server-Timing" not in medir(peticion()).headers
+
+    def test_cabecera_para_todas(self):
+        assert "Server-Timing" in crear_tween("todas")(peticion()).headers
+        assert "Server-Timing" not in crear_tween("ninguna")(peticion(ADMIN)).headers
+
+    def test_cuenta_solo_las_de_la_peticion(self):
+        "Cada petición cuenta sus consultas, no las de las anteriores del mismo hilo"
+        uno = crear_tween("todas", problemas=1)
+        tres = crear_tween("todas", problemas=3)
+        tres(peticion())
+        consultas = uno(peticion()).headers["Server-Timing"].split('"')[1]
+        assert consultas != "0 consultas"
+        assert tres(peticion()).headers["Server-Timing"].split('"')[1] != consultas
+
+    def test_anota_las_lentas(self, capsys):
+        "Las que superan el umbral de consultas se anotan con la más repetida"
+        crear_tween(umbral_consultas=100, problemas=4)(peticion())
+        assert capsys.readouterr().out == ""
+        crear_tween(umbral_consultas=2, problemas=4)(peticion())
+        datos = json.loads(capsys.readouterr().out)
+        assert datos["lenta"] == "GET /problems"
+        assert datos["estado"] == 200
+        assert datos["consultas"] > 2
+        assert datos["redis"] == 1
+        assert datos["repetida"]["veces"] >= 3
+        assert datos["repetida"]["sql"].lstrip().upper().startswith("SELECT")
+
+    def test_fuera_de_peticion(self):
+        "Sin petición en curso, las operaciones con redis no se anotan en ningún sitio"
+        tiempos.anotar_redis(0.1, llamada=True)
+        assert getattr(tiempos.actual, "medida", None) is None
+
+
+class TestServerTiming(TestWithMockDatabaseLoggedAsAdmin):
+    def test_en_la_aplicacion(self):
+        "Con la configuración por defecto la cabecera sólo se envía a los admins"
+        respuesta = self.c.get("/problema/1")
+        assert respuesta.status_code == 200
+        assert respuesta.headers["Server-Timing"].startswith("sql;dur=")
+        autorizacion, self.c.authorization = self.c.authorization, None
+        try:
+            respuesta = self.c.get("/problema/1", expect_errors=True)
+        finally:
+            self.c.authorization = autorizacion
+        assert "Server-Timing" not in respuesta.headers
+
+    def test_perfil_de_desarrollo(self):
+        "Sólo el perfil de desarrollo la envía a todos, y en lo demás es como el de defecto"
+        with open("settings/default.yaml") as config:
+            defecto = yaml.safe_load(config)
+        with open("settings/desarrollo.yaml") as config:
+            desarrollo = yaml.safe_load(config)
+        assert defecto["tiempos"]["cabecera"] == "admins"
+        assert desarrollo["tiempos"]["cabecera"] == "todas"
+        desarrollo["tiempos"]["cabecera"] = "admins"
+        assert desarrollo == defecto
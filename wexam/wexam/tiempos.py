@@ -0,0 +1,121 @@
+"""Medida de lo que cuesta cada petición.
+
+El tween medir_peticion cuenta, en cada petición, las consultas SQL y el
+tiempo que han llevado (a partir de las estadísticas que pony guarda en
+cada hilo, db.local_stats), las operaciones con redis y su tiempo (que
+anotan las conexiones de circuito mediante anotar_redis) y el tiempo total.
+Lo que queda, descontados SQL y redis, es el de las vistas y el de generar
+la respuesta.
+
+Si la configuración tiene sección tiempos, esas medidas se añaden a la
+respuesta en la cabecera Server-Timing, que muestran las herramientas de
+desarrollo de los navegadores (a todas las peticiones o sólo a las de los
+admins, según cabecera), y las peticiones que superan alguno de los
+umbrales (de tiempo o de número de consultas) se anotan en la salida
+estándar en una línea JSON. Esa línea incluye la consulta que más veces se
+ha repetido, que es la pista de los problemas N+1.
+"""
+
+import json
+import threading
+import time
+
+from .app import App
+from .replicas import enrutar_lecturas
+
+TODAS = "todas"
+ADMINS = "admins"
+
+# Medida de la petición que está atendiendo cada hilo
+actual = threading.local()
+
+
+class Medida(object):
+    """Contadores de una petición"""
+
+    def __init__(self):
+        self.inicio = time.perf_counter()
+        self.total = 0.0
+        self.consultas = 0
+        self.tiempo_sql = 0.0
+        self.repetida = None     # (veces, sql) de la consulta más repetida
+        self.redis = 0
+        self.tiempo_redis = 0.0
+
+    def terminar(self, estadisticas):
+        """Toma el tiempo total y las consultas de las estadísticas de pony"""
+        self.total = time.perf_counter() - self.inicio
+        for sql, stat in estadisticas.items():
+            if sql is None:
+                # La entrada None es la suma de todas las demás
+                self.consultas = stat.db_count
+                self.tiempo_sql = stat.sum_time or 0.0
+            elif stat.db_count and (self.repetida is None or stat.db_count > self.repetida[0]):
+                self.repetida = (stat.db_count, sql)
+
+    def server_timing(self):
+        """Valor de la cabecera Server-Timing (tiempos en milisegundos)"""
+        resto = max(0.0, self.total - self.tiempo_sql - self.tiempo_redis)
+        return ", ".join([
+            'sql;dur={:.1f};desc="{} consultas"'.format(1000 * self.tiempo_sql, self.consultas),
+            'redis;dur={:.1f};desc="{} llamadas"'.format(1000 * self.tiempo_redis, self.redis),
+            "app;dur={:.1f}".format(1000 * resto),
+            "total;dur={:.1f}".format(1000 * self.total),
+        ])
+
+    def como_dict(self):
+        datos = {"total_ms": round(1000 * self.total, 1),
+                 "consultas": self.consultas,
+                 "sql_ms": round(1000 * self.tiempo_sql, 1),
+                 "redis": self.redis,
+                 "redis_ms": round(1000 * self.tiempo_redis, 1)}
+        if self.repetida is not None:
+            datos["repetida"] = {"veces": self.repetida[0], "sql": self.repetida[1]}
+        return datos
+
+
+def anotar_redis(segundos, llamada=False):
+    """Suma a la petición que atiende este hilo, si la hay, el tiempo de
+    una operación con redis. llamada indica si es el envío de un comando (o
+    de un pipeline), que es lo que se cuenta"""
+    medida = getattr(actual, "medida", None)
+    if medida is None:
+        return
+    medida.tiempo_redis += segundos
+    if llamada:
+        medida.redis += 1
+
+
+@App.tween_factory(over=enrutar_lecturas)
+def medir_peticion(app, handler):
+    """Mide cada petición. Sin sección tiempos en la configuración no hace nada"""
+    config = getattr(app.settings, "tiempos", None)
+    if config is None:
+        return handler
+    # Se importan aquí para que circuito, que importa este módulo, no dependa del modelo
+    from .model import db      # pylint: disable=import-outside-toplevel
+    from .permissions import es_admin      # pylint: disable=import-outside-toplevel
+    cabecera = getattr(config, "cabecera", ADMINS)
+    umbral_tiempo = getattr(config, "umbral_tiempo", 1)
+    umbral_consultas = getattr(config, "umbral_consultas", 50)
+
+    def medir(request):
+        # Pony acumula las estadísticas de cada hilo indefinidamente. Se
+        # vacían para que reflejen sólo esta petición
+        db.local_stats.clear()
+        medida = actual.medida = Medida()
+        response = None
+        try:
+            response = handler(request)
+        finally:
+            actual.medida = None
+            medida.terminar(db.local_stats)
+            if medida.total > umbral_tiempo or medida.consultas > umbral_consultas:
+                datos = {"lenta": "{} {}".format(request.method, request.path),
+                         "estado": getattr(response, "status_code", None)}
+                datos.update(medida.como_dict())
+                print(json.dumps(datos), flush=True)
+        if cabecera == TODAS or (cabecera == ADMINS and es_admin(request.identity)):
+            response.headers.add("Server-Timing", medida.server_timing())
+        return response
+    return medir
@@ -7,22 +7,24 @@ Este módulo implementa también los permisos y la autenticación con JWT.
 
 from collections import Counter
 import json
-import time
 import collections
 import traceback
 import sys
+import os
 
 import yaml
+import redis
 from pony.orm.core import ObjectNotFound
 import more.pony
 import morepath
 import webob
+from webob.static import FileIter, BLOCK_SIZE
 from morepath.core import date_encode
 from morepath.core import datetime_encode
 from morepath import Response
 from webob.exc import (HTTPUnauthorized, HTTPNotFound,
-        HTTPMethodNotAllowed, HTTPForbidden)
-from passlib.hash import bcrypt
+        HTTPMethodNotAllowed, HTTPForbidden, HTTPInternalServerError,
+        HTTPGatewayTimeout, HTTPTooManyRequests, HTTPServiceUnavailable)
 from more.jwtauth import JWTIdentityPolicy
 
 from .tests.crear_db_ejemplo import crear_db_ejemplo
@@ -30,6 +32,13 @@ from .app import App
 from . import model
 from . import appmodel
 from . import db_collections as coll
+from . import tareas
+from . import metricas
+from . import muestreo
+from . import claves
+from .mixins import redis_no_disponible, TAREAS_COMPILACION, VARIANTES
+from .conexiones import PoolAgotado
+from .sesiones import versiones, revocar_tokens, invalidar_circulos
 from .permissions import *
 
 # ==================== VISTAS "ADMINISTRATIVAS" ==================================
@@ -50,6 +59,14 @@ def view_login_get(self, request): # pylint: disable=unused-argument
     """La ruta /login no debe ser accedida con GET, sino con POST"""
     raise HTTPUnauthorized('Debes suministrar email y clave con POST')
 
+def identidad_de(request, quien):
+    """Identidad que se guarda en el JWT del profesor dado"""
+    # Las de redis, que pueden ir por delante de las de la base de datos
+    version, version_circulos = versiones(request.app, quien.id)
+    return morepath.Identity(quien.email, nombre=quien.nombre, id=quien.id, role=quien.role,
+                             circulos=sorted(c.id for c in quien.circulos_en_que_esta),
+                             ver=version, ver_circulos=version_circulos)
+
 @App.json(model=appmodel.Login, request_method="POST")
 def view_login_post(self, request): # pylint: disable=unused-argument
     """Valida usuario y contraseña y genera JWT, que se envía en una cabecera
@@ -57,12 +74,19 @@ def view_login_post(self, request): # pylint: disable=unused-argument
     email = request.json.get("email", "").lower()
     password = request.json.get("password")
     quien = model.Profesor.get(email=email)
-    if (not quien or not password or not email or
-            not bcrypt.verify(password, quien.password)):
+    if not quien or not password or not email:
+        raise HTTPUnauthorized('Nombre de usuario o contraseña no válidos')
+    try:
+        valida, nuevo_hash = claves.verificar(password, quien.password)
+    except claves.Saturado as e:
+        raise HTTPServiceUnavailable(str(e), headers={"Retry-After": str(e.reintentar)})
+    if not valida:
         raise HTTPUnauthorized('Nombre de usuario o contraseña no válidos')
+    if nuevo_hash is not None:
+        # La clave se cifró con otro coste. Se guarda con el configurado
+        quien.password = nuevo_hash
 
-    identidad = morepath.Identity(email, nombre=quien.nombre,
-                                  id=quien.id, role=quien.role)
+    identidad = identidad_de(request, quien)
 
     @request.after
     def enviar_jwt_a_cliente(response):  # pylint: disable=unused-variable
@@ -74,6 +98,26 @@ def view_login_post(self, request): # pylint: disable=unused-argument
     request.app.remember_identity(fake_response, request, identidad)
     return fake_response.headers['Authorization']
 
+@App.json(model=appmodel.Login, name="refresh", request_method="POST")
+def view_login_refresh(self, request): # pylint: disable=unused-argument
+    """Cambia el JWT de la cabecera Authorization, si aún es válido o caducó
+    hace poco, por uno nuevo. No requiere la clave, por lo que evita el coste
+    de verificarla"""
+    identidad = request.app.politica_identidad.renovable(request)
+    if identidad is None:
+        raise HTTPUnauthorized('El token no puede renovarse. Debes identificarte de nuevo')
+    if getattr(identidad, "circulos", None) is None:
+        # Sus círculos han cambiado, se toman de la base de datos
+        identidad = identidad_de(request, model.Profesor[identidad.id])
+
+    @request.after
+    def enviar_jwt_a_cliente(response):  # pylint: disable=unused-variable
+        request.app.remember_identity(response, request, identidad)
+
+    fake_response = Response()
+    request.app.remember_identity(fake_response, request, identidad)
+    return fake_response.headers['Authorization']
+
 @App.json(model=appmodel.ResetPassword)
 def view_reset_password(self, request):
     """Envía al usuario un email con un enlace para reiniciar la clave"""
@@ -81,6 +125,56 @@ def view_reset_password(self, request):
                                       request.app.settings)
     return {"ok":"mensaje enviado"}
 
+@App.json(model=appmodel.Colas, permission=SerAdmin)
+def view_colas(self, request):   # pylint: disable=unused-argument
+    """Ocupación de cada cola de compilación: trabajos pendientes y en curso, y
+    segundos que lleva esperando el más antiguo"""
+    if request.app.redis is None:
+        raise HTTPNotFound("El servidor no implementa esta funcionalidad")
+    try:
+        return {prioridad: tareas.estadisticas(cola)
+                for prioridad, cola in request.app.task_queues.items()}
+    except redis.exceptions.ConnectionError as e:
+        raise redis_no_disponible(e)
+    except redis.exceptions.RedisError:
+        raise HTTPGatewayTimeout("El backend redis no responde")
+
+@App.view(model=appmodel.Metricas, permission=LeerMetricas)
+def view_metricas(self, request):   # pylint: disable=unused-argument
+    """Métricas de todos los procesos del servidor y ocupación actual de las
+    colas de compilación, en el formato de texto de Prometheus"""
+    if getattr(request.app.settings, "metricas", None) is None:
+        raise HTTPNotFound("El servidor no implementa esta funcionalidad")
+    try:
+        valores = metricas.registro.leer(getattr(request.app, "redis", None))
+        for prioridad, cola in getattr(request.app, "task_queues", {}).items():
+            estado = tareas.estadisticas(cola)
+            for nombre, campo in (("wexam_cola_pendientes", "pendientes"),
+                                  ("wexam_cola_en_curso", "en_curso"),
+                                  ("wexam_cola_espera_segundos", "espera")):
+                valores[metricas.serie(nombre, cola=estado["nombre"],
+                                       prioridad=prioridad)] = estado[campo]
+    except redis.exceptions.ConnectionError as e:
+        raise redis_no_disponible(e)
+    except redis.exceptions.RedisError:
+        raise HTTPGatewayTimeout("El backend redis no responde")
+    return Response(metricas.exposicion(valores), charset="utf-8",
+                    content_type="text/plain; version=0.0.4")
+
+@App.view(model=appmodel.Muestras, permission=SerAdmin)
+def view_muestras(self, request):
+    """Pilas muestreadas en las últimas horas, en formato de pilas colapsadas
+    (para flamegraph.pl, speedscope, etc.)"""
+    if getattr(request.app.settings, "muestreo", None) is None:
+        raise HTTPNotFound("El servidor no implementa esta funcionalidad")
+    try:
+        cuentas = muestreo.muestreador.leer(self.horas)
+    except redis.exceptions.ConnectionError as e:
+        raise redis_no_disponible(e)
+    except redis.exceptions.RedisError:
+        raise HTTPGatewayTimeout("El backend redis no responde")
+    return Response(muestreo.colapsadas(cuentas), content_type="text/plain", charset="utf-8")
+
 @App.html(model=appmodel.ResetPassword, name="ok")
 def view_form_reset_password(self, request): # pylint: disable=unused-argument
     """Verifica el token y admite el reinicio de clave"""
@@ -99,7 +193,7 @@ def view_perform_password_change(self, request):
         raise TypeError("Falta JSON con 'password'")
     todo_ok = self.validate_token(request.GET['token'])
     if todo_ok:
-        self.quien.update({"password": request.json["password"]})
+        self.quien.update({"password": request.json["password"]}, request)
         return {"ok": "contraseña cambiada!"}
     else:
         raise TypeError("El token es inválido")
@@ -125,17 +219,42 @@ with App.json(model=model.Profesor) as view:
             )
         return data
 
+    @view(name="tareas", permission=SerPropietario)
+    def view_profesor_tareas(self, request):
+        "Obtener el estado de todas las tareas de un profesor"
+        estados = []
+        for tarea, datos in self.estado_tareas(request):
+            # Las fallidas o borradas ya no existen, y no tienen enlace
+            if datos["status"] not in ("Fallida", "Borrada"):
+                datos["link"] = request.link(tarea)
+            if datos["status"] == "Completada":
+                datos["download"] = request.link(tarea, name="download")
+            estados.append(datos)
+        return estados
+
     @view(request_method="PUT", permission=SerPropietario)
     def update_profesor(self, request):
         "Modificar datos de un profesor"
-        self.update(request.json)
+        if self.update(request.json, request) and request.identity.id == self.id:
+            # Sus token se han revocado. Se le envía uno nuevo para esta sesión
+            identidad = identidad_de(request, self)
+
+            @request.after
+            def enviar_jwt_a_cliente(response):  # pylint: disable=unused-variable
+                request.app.remember_identity(response, request, identidad)
         return request.view(self)
 
     @view(request_method="DELETE", permission=SerAdmin)
     def delete_profesor(self, request):
         "Eliminar un profesor"
         profesores = coll.Profesores()
-        if profesores.delete_object(self.id) is None:
+        id_profesor = self.id
+        # Los círculos que creó se borran con él
+        miembros = [m.id for c in self.circulos_creados for m in c.miembros]
+        # Antes de borrarlo, pues en redis sus versiones siguen estando
+        revocar_tokens(request.app, id_profesor)
+        invalidar_circulos(request.app, miembros)
+        if profesores.delete_object(id_profesor) is None:
             return None
         return morepath.Response(status=204)
 
@@ -311,21 +430,112 @@ with App.json(model=model.Tarea) as view:
 with App.view(model=model.Tarea) as view:
     @view(name="download", permission=SerPropietario)
     def download_task_result(self, request):
-        content = self.get_result(request)
-        if type(content) == tuple:
-            content = content[-1]
-        if self.tipo == "zip":
+        # El tipo se lee antes de obtener el resultado, que puede borrar la tarea
+        tipo = self.tipo
+        if tipo == "zip":
             mimetype = "application/zip"
-        elif self.tipo == "pdf":
+        elif tipo == "pdf":
             mimetype = "application/pdf"
-        elif self.tipo == "tgz" or self.tipo == "tar.gz":
+        elif tipo == "tgz" or tipo == "tar.gz":
             mimetype = "application/gzip"
         else:
             mimetype = "application/octect-stream"
         headers = {"Content-type": mimetype,
-                    "Content-disposition": 'attachment; filename="examen.{}"'.format(self.tipo)
+                    "Content-disposition": 'attachment; filename="examen.{}"'.format(tipo)
                   }
-        return morepath.Response(body=content, status=200, headers=headers)
+        fichero = None
+        ruta = self.get_fichero(request)
+        if ruta is not None:
+            try:
+                # Una vez abierto, el fichero sigue siendo legible aunque la
+                # purga de la caché lo borre mientras se envía
+                fichero = open(ruta, "rb")
+            except FileNotFoundError:
+                pass
+            else:
+                request.app.cache.usar(ruta)
+        if fichero is None:
+            # Sin almacén de artefactos, el resultado viene del backend de tareas
+            content = self.get_result(request)
+            if type(content) == tuple:
+                content = content[-1]
+            if not isinstance(content, bytes):
+                # No hay contenido, o el trabajo escribió el resultado en el
+                # almacén compartido (y retornó su ruta), del que ya se purgó
+                raise HTTPNotFound("El resultado ya no está disponible. "
+                                   "Debes lanzar de nuevo la conversión")
+            return morepath.Response(body=content, status=200, headers=headers)
+
+        # El fichero se envía por partes sin cargarlo en memoria. La tarea no se
+        # borra, para que el cliente pueda reanudar la descarga (cabecera Range)
+        response = morepath.Response(status=200, headers=headers,
+                                     conditional_response=True)
+        info = os.fstat(fichero.fileno())
+        file_wrapper = request.environ.get("wsgi.file_wrapper")
+        if file_wrapper is not None and request.range is None:
+            # El servidor (p.ej. uwsgi) puede enviarlo con sendfile, sin copias
+            response.app_iter = file_wrapper(fichero, BLOCK_SIZE)
+        else:
+            response.app_iter = FileIter(fichero)
+        response.content_length = info.st_size
+        response.last_modified = info.st_mtime
+        # El nombre del fichero es el hash de su contenido
+        response.etag = self.clave
+        response.accept_ranges = "bytes"
+        return response
+
+    @view(name="events", permission=SerPropietario)
+    def task_events(self, request):
+        """Flujo de eventos (Server-Sent Events) con el estado de la tarea, que
+        se envía cada vez que cambia su progreso. El flujo termina tras enviar
+        el estado final (el mismo JSON que la vista de la tarea), por lo que el
+        cliente debe cerrar el EventSource al recibirlo, o reconectará"""
+        link = request.link(self, name="download")
+        actual = self.get_status(request)
+        if actual is None or actual["status"] in ("Completada", "Fallida", "Borrada",
+                                                   "No disponible"):
+            estados = None
+        else:
+            # El generador se recorre cuando la sesión de la base de datos ya
+            # está cerrada, así que no puede acceder a la tarea
+            estados = self.eventos(request)
+        bloqueos = getattr(request.app, "bloqueos", None)
+
+        def evento(estado):
+            if estado["status"] == "Completada":
+                estado["link"] = link
+            return "data: {}\n\n".format(json.dumps(estado)).encode("utf-8")
+
+        def flujo():
+            # El semáforo se toma dentro del generador, pues si el cliente se
+            # desconecta antes de empezar a recorrerlo, no llegaría a liberarse
+            if estados is None:
+                yield evento(actual)
+                return
+            if bloqueos is not None and not bloqueos.acquire(blocking=False):
+                # Demasiados hilos bloqueados (en flujos o descargas síncronas):
+                # se envía el estado actual y se indica al cliente que reconecte
+                # más tarde
+                yield b"retry: 5000\n"
+                yield evento(actual)
+                return
+            try:
+                for estado in estados:
+                    if estado is None:
+                        yield b": latido\n\n"
+                    else:
+                        yield evento(estado)
+            except redis.exceptions.RedisError:
+                return
+            finally:
+                estados.close()
+                if bloqueos is not None:
+                    bloqueos.release()
+
+        headers = {"Content-type": "text/event-stream; charset=utf-8",
+                   "Cache-Control": "no-cache",
+                   "X-Accel-Buffering": "no"}   # Para que nginx no lo acumule
+        return morepath.Response(app_iter=flujo(), status=200, headers=headers)
 
 with App.json(model=model.Cuestion) as view:
     @view(permission=PoderVer)
@@ -360,6 +570,19 @@ with App.json(model=model.Tag) as view:
         info.update(usado=self.problemas.count())
         return info
 
+def normalizar_resuelto(valor):
+    """Nombre de la variante del examen (noresuelto, resuelto o explicado)
+    indicada por el valor recibido en la petición, o None si no es ninguna"""
+    valor = valor.strip().lower()
+    if valor in ["false", "no", "noresuelto"]:
+        return "noresuelto"
+    if valor in ["true", "si", "sí", "resuelto"]:
+        return "resuelto"
+    if valor == "explicado":
+        return "explicado"
+    return None
+
+
 with App.json(model=model.Examen) as view:
     @view(name="min", permission=SerPropietario)
     def view_examen_min(self, request):
@@ -431,7 +654,7 @@ with App.json(model=model.Examen) as view:
     @view(request_method="PUT", permission=SerPropietario)
     def update_examen(self, request):
         "Modificar datos de un examen"
-        self.update(request.json)
+        self.update(request.json, request)
         return request.view(self)
 
     @view(name="problemas", permission=SerPropietario)
@@ -468,9 +691,9 @@ with App.json(model=model.Examen) as view:
 
     @view(name="download")#, permission=SerPropietario)
     def download_examen(self, request):
-        examen_json = request.view(self, name="data")
         formato = request.GET.get("formato", "json")
-        resuelto = request.GET.get("resuelto", "noresuelto").lower()
+        # Un valor de resuelto desconocido equivale, como siempre, a noresuelto
+        resuelto = normalizar_resuelto(request.GET.get("resuelto", "noresuelto")) or "noresuelto"
         sync = request.GET.get("sync", False)
 
         if sync == "true" or sync == "1":
@@ -478,54 +701,49 @@ with App.json(model=model.Examen) as view:
         else:
             sync = False
 
-        if resuelto in ["false", "no"]:
-            resuelto = "noresuelto"
-        elif resuelto in ["true", "si", "sí"]:
-            resuelto = "resuelto"
-        elif resuelto == "explicado":
-            pass
-        else:
-            resuelto = "noresuelto"
-
-        examen_json["resuelto"] = resuelto
-        examen_json = json.dumps(examen_json)
-
-        if formato=="zip":
-            tarea = self.creador.lanzar_tarea(request, "json2latex",
-                                              data=examen_json, formato="zip")
-        elif formato=="tgz":
-            tarea = self.creador.lanzar_tarea(request, "json2latex",
-                                              data=examen_json, formato="tgz")
-        elif formato=="pdf":
-            tarea = self.creador.lanzar_tarea(request, "json2pdf",
-                                              data=examen_json, formato="pdf")
+        # Varias variantes (variantes=noresuelto,resuelto,...) se compilan en
+        # un único trabajo que las entrega en un solo archivo
+        variantes = request.GET.get("variantes")
+        if variantes:
+            # Las desconocidas se conservan, para que lanzar_variantes las rechace
+            variantes = {normalizar_resuelto(v) or v.strip()
+                         for v in variantes.split(",") if v.strip()}
+            if len(variantes) == 1 and variantes <= set(VARIANTES):
+                resuelto = variantes.pop()
+        if variantes:
+            tarea = self.lanzar_variantes(request, formato, variantes, sync=sync)
+        elif formato in TAREAS_COMPILACION:
+            tarea = self.lanzar_compilacion(request, formato, resuelto, sync=sync)
         else:
             # Retornamos la versión JSON
             headers = {"Content-type": "application/json",
                        "Content-disposition": 'attachment; filename="examen.json"'
                       }
-            return morepath.Response(body=examen_json,
+            return morepath.Response(body=self.json_compilacion(request, resuelto),
                                      status=200, headers=headers)
         if tarea is None:
             raise HTTPNotFound("Tipo de descarga no disponible")
+        respuesta_asincrona = {
+            "status": "Completada" if tarea.completada else "Procesando",
+            "link": request.link(tarea)
+        }
         if not sync:
-            return {
-                "status": "Procesando",
-                "link": request.link(tarea)
-            }
-        # esperar a que acabe la tarea y retornar el resultado
-        wait = 0.1
-        while wait<30:
-            estado = request.view(tarea)
-            if estado["status"] == "Completada":
-                break
-            time.sleep(wait)
-            wait*=2
+            return respuesta_asincrona
+        # esperar a que acabe la tarea y retornar el resultado, pero sin bloquear
+        # más hilos de los permitidos. Si ya hay demasiados bloqueados (aquí o en
+        # flujos de eventos), se responde como si la petición hubiera sido asíncrona
+        bloqueos = getattr(request.app, "bloqueos", None)
+        if bloqueos is not None and not bloqueos.acquire(blocking=False):
+            return respuesta_asincrona
+        try:
+            tarea.esperar(request)
+        finally:
+            if bloqueos is not None:
+                bloqueos.release()
+        estado = request.view(tarea)
         if estado["status"] != "Completada":
             raise HTTPInternalServerError("No se pudo completar la tarea de compilación")
-        resultado = request.view(tarea, name="download")
-        tarea.delete()
-        return resultado
+        return request.view(tarea, name="download")
 
 with App.json(model=model.Asignatura) as view:
     @view(permission=EstarRegistrado)
@@ -574,8 +792,10 @@ with App.json(model=model.Circulo) as view:
     def delete_circulo(self, request):
         """Eliminar un círculo"""
         circulos = coll.Circulos()
+        miembros = [m.id for m in self.miembros]
         if circulos.delete_object(self.id) is None:
             return None
+        invalidar_circulos(request.app, miembros)
         return morepath.Response(status=204)
 
     @view(request_method="PUT", permission=SerPropietario)
@@ -596,12 +816,14 @@ with App.json(model=model.Circulo) as view:
     def add_profesores_to_circulo(self, request):
         """Añadir profesores a este círculo"""
         self.add_profesores(request.json)
+        invalidar_circulos(request.app, [int(p["id"]) for p in request.json["miembros"]])
         return request.view(self, name="miembros")
 
     @view(name="miembros", request_method="DELETE", permission=SerPropietario)
     def delete_profesores_from_circulo(self, request):
         """Eliminar profesores a este círculo"""
         self.remove_profesores(request.json)
+        invalidar_circulos(request.app, [int(p["id"]) for p in request.json["miembros"]])
         return request.view(self, name="miembros")
 
     @view(name="problemas", permission=SerPropietario)
@@ -766,12 +988,16 @@ with App.json(model=coll.SubCollection) as view:
     def post_circulo_miembros(self, request):
         """Añadir un profesor al círculo"""
         self.add_element(request)
+        if isinstance(self, coll.CirculoMiembros):
+            invalidar_circulos(request.app, [self.param])
         return request.view(self)
 
     @view(request_method="DELETE", permission=SerPropietario)
     def delete_circulo_miembros(self, request):
         """Eliminar un profesor del círculo"""
         self.remove_element(request)
+        if isinstance(self, coll.CirculoMiembros):
+            invalidar_circulos(request.app, [self.param])
         return request.view(self)
 
 with App.json(model=coll.ExamenProblemas) as view:
@@ -855,6 +1081,47 @@ def view_HTTPForbidden(self, request):
 
     return {"debug": str(self)}
 
+@App.json(model=HTTPTooManyRequests)
+def view_HTTPTooManyRequests(self, request):
+    """Retornar 429 y json con debug info si se lanzan demasiadas tareas,
+    indicando cuándo reintentar"""
+    @request.after
+    def change_code(r):
+        """Cambia status de la respuesta"""
+        r.status = 429
+        r.headers.add('Access-Control-Allow-Origin', '*')
+        if "Retry-After" in self.headers:
+            r.headers["Retry-After"] = self.headers["Retry-After"]
+
+    return {"debug": str(self)}
+
+@App.json(model=HTTPServiceUnavailable)
+def view_HTTPServiceUnavailable(self, request):
+    """Retornar 503 y json con debug info si un servicio del que se depende
+    (redis) no está disponible, indicando cuándo reintentar"""
+    @request.after
+    def change_code(r):
+        """Cambia status de la respuesta"""
+        r.status = 503
+        r.headers.add('Access-Control-Allow-Origin', '*')
+        if "Retry-After" in self.headers:
+            r.headers["Retry-After"] = self.headers["Retry-After"]
+
+    return {"debug": str(self)}
+
+@App.json(model=PoolAgotado)
+def view_PoolAgotado(self, request):
+    """Retornar 503 y json con debug info si no hay conexiones libres con la
+    base de datos, indicando cuándo reintentar"""
+    @request.after
+    def change_code(r):
+        """Cambia status de la respuesta"""
+        r.status = 503
+        r.headers.add('Access-Control-Allow-Origin', '*')
+        r.headers["Retry-After"] = str(self.reintentar)
+
+    return {"debug": str(self)}
+
 @App.json(model=HTTPUnauthorized)
 def view_HTTPForbidden(self, request):
     """Retornar 401 y json con debug info ante fallo de autenticación"""
@@ -942,8 +1209,11 @@ def reset_database_factory(app, handler):
     def reset_database_maybe(request):
         # Invoca el manejador "normalmente"
         result = handler(request)
-        # Si detecta que se ejecutó la vista view_reset_database, borra la base de datos
-        if result.body == b'"OK. Base de datos restaurada"':
+        # Si detecta que se ejecutó la vista view_reset_database, borra la base de datos.
+        # Sólo se mira el cuerpo de las respuestas JSON, pues leer el de las demás
+        # obligaría a generarlas enteras (y las hay que se envían en streaming)
+        if (result.content_type == "application/json" and
+                result.body == b'"OK. Base de datos restaurada"'):
             model.db.drop_all_tables(with_all_data=True)
             model.db.create_tables()
             crear_db_ejemplo(model.db)